@@ -49,6 +49,9 @@ def main():
         # Power saving
         esp32.wake_on_touch(True)
 
+        if conf.gpio_deferred_commit:
+            gpio.enable_deferred_commit(conf.gpio_commit_frame_ms)
+
         loop = uasyncio.get_event_loop()
         loop.create_task(network.ensure_up())
 
@@ -7,6 +7,22 @@ if sys.implementation.name != 'micropython':
     builtins.const = lambda x: x
 
 from binascii import b2a_base64
+
+# Defaults for options that may be missing from older config files
+sr_backend = "bitbang"
+sr_spi_id = 2
+gpio_deferred_commit = False
+gpio_commit_frame_ms = 0
+touchpad_engine = "object"
+touch_calibration = False
+ntp_host = "pool.ntp.org"
+schedule_utc_offset_min = 0
+persistence_backend = "nvs"
+journal_partition = "journal"
+log_level = "info"
+log_queue_lines = 64
+log_batch_lines = 8
+
 from leviot_conf import *
 
 # Force MQTT off if not on MicroPython due to issues I don't feel like investigating
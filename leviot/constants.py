@@ -12,8 +12,16 @@ TOUCHPADS = {
     "NIGHT": const(33),
 }
 
-TOUCHPADS_POLL_INTERVAL_MS = 25
 TOUCHPAD_HOLD_TIMEOUT_MS = 2000
+# Touch events are dropped if the controller falls this far behind
+TOUCH_EVENT_QUEUE_SIZE = const(16)
+
+# Fan kickstart duration on power on. Speed changes during the kickstart cut it short, but not below the minimum.
+KICKSTART_MS = const(1000)
+KICKSTART_MIN_MS = const(300)
+
+# Commands arriving within this time from the first pending one are merged, only the final state is applied
+COMMAND_COALESCE_MS = const(200)
 
 # Amount of time for which the LEDs will be turned on if lights == OFF but an action was performed
 LIGHTS_OFF_TOUCHPAD_TIMEOUT = const(1200)
@@ -24,14 +32,37 @@ PIN_SR_CLK = const(19)
 PIN_SR_LATCH = const(21)
 PIN_SR_OUTEN = const(17)
 
+# The shift register has no serial output wired back, but the SPI peripheral still wants a MISO pin. This one is unused.
+PIN_SR_SPI_MISO = const(23)
+# 74HC595 can take way more than this, but the GPIO matrix routing and the board traces are the actual limit
+SR_SPI_BAUDRATE = const(1000000)
+
 # Directly connected LED
 PIN_LED_FILTER = const(26)
 
+# Filter LED "breathing" animation. 25 fps is smooth enough for a slow fade and keeps the scheduler mostly idle.
+FILTER_LED_BREATHE_PERIOD_MS = const(4000)
+FILTER_LED_BREATHE_FRAME_MS = const(40)
+FILTER_LED_GAMMA = 2.2
+
 # This has been removed since I calculated Pin.value() takes ~200 us anyway (ew slow)
 # # Shift register propagation
 # # The maximum delay according to the datasheet should be 63 NANOseconds so 1 us is more than enough
 # SR_PROP_DELAY_US = 1
 
+# Interval between checkpoints of the persistence wear counters
+WEAR_CHECKPOINT_INTERVAL_MS = const(6 * 60 * 60 * 1000)
+
+# Interval between updates of the published filter maintenance ETAs
+MAINTENANCE_ETA_INTERVAL_MS = const(60 * 60 * 1000)
+# Published filter maintenance ETAs are only updated when they move by at least this much
+MAINTENANCE_ETA_RESOLUTION_SEC = const(60)
+
+# Interval between Wi-Fi connection checks in station mode, right after connecting. It doubles while the link stays up,
+# up to the max interval.
+WIFI_CHECK_INTERVAL_MS = const(1000)
+WIFI_CHECK_MAX_INTERVAL_MS = const(60 * 1000)
+
 # Wireless auth modes
 WIFI_AUTHMODES = {
     "open": network.AUTH_OPEN,
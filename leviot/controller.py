@@ -6,12 +6,57 @@ from leviot.extgpio import gpio
 from leviot.http.server import HttpServer
 from leviot.mqtt.controller import MQTTController
 from leviot.persistence import persistence
-from leviot.state import state_tracker
-from leviot.touchpad import touchpad_mgr
+from leviot.schedule import scheduler
+from leviot.state import state_tracker, Command, Field, BMASK_TIMER_LEFT
+from leviot.timers import timer_service
+from leviot.touchpad import touchpad_mgr, TouchEvent
 
 log = ulog.Logger("controller")
 
 
+# Shift register LEDs lit for each fan speed while powered on
+_SPEED_LEDS = (
+    1 << constants.LED_NIGHT,
+    1 << constants.LED_FAN | 1 << constants.LED_V1,
+    1 << constants.LED_FAN | 1 << constants.LED_V2,
+    1 << constants.LED_FAN | 1 << constants.LED_V3,
+)
+
+# Shift register LEDs lit for each 2-hour timer bucket, see _timer_bucket()
+_TIMER_LEDS = (
+    0,
+    1 << constants.LED_TIMER | 1 << constants.LED_2H,
+    1 << constants.LED_TIMER | 1 << constants.LED_4H,
+    1 << constants.LED_TIMER | 1 << constants.LED_6H,
+    1 << constants.LED_TIMER | 1 << constants.LED_8H,
+)
+
+
+def _timer_bucket(timer_left: int) -> int:
+    if timer_left <= 0:
+        return 0
+    bucket = (timer_left - 1) // 120 + 1
+    return bucket if bucket < 4 else 4
+
+
+def led_frame(power: bool, speed: int, timer_left: int, lock: bool, lights: bool, feedback: bool) -> int:
+    """
+    Computes the shift register LED bits for the given state. feedback is True if the LEDs are being updated in
+    response to a user action, which lights them up briefly even if lights are off.
+    """
+    frame = 0
+    if lights or feedback:
+        frame = _TIMER_LEDS[_timer_bucket(timer_left)]
+        if power:
+            frame |= 1 << constants.LED_POWER | _SPEED_LEDS[speed]
+        elif not lights:
+            # Provide feedback on poweroff when lights are off
+            frame |= 1 << constants.LED_POWER
+    if lock and power:
+        frame |= 1 << constants.LED_LOCK
+    return frame
+
+
 class LevIoT:
     def __init__(self):
         self.httpd = HttpServer(self)
@@ -20,14 +65,35 @@ class LevIoT:
         self.loop = uasyncio.get_event_loop()
         self.should_stop = False
         self.is_kickstarting = False
-        self.led_feedback_due_at_ms = 0
-        self.timer_task = None
+        # Set when no kickstart is running
+        self.kickstart_done = uasyncio.Event()
+        self.kickstart_done.set()
+        # Set to end the running kickstart early
+        self.kickstart_interrupt = uasyncio.Event()
+        # Speed to switch to at the end of the running kickstart
+        self.kickstart_speed = 0
+        self.led_feedback_timer = None
+        self.countdown_timer = None
+        # Time from a pad being pushed to its event being handled, for the last event and the worst one
+        self.touch_latency_ms = 0
+        self.touch_latency_max_ms = 0
+
+        # Pending [Command, value, cause, prev speed] lists in the order they'll be applied, at most one per command
+        # kind. Speed commands carry the speed that NIGHT and FAN go back to once they're applied, None for others.
+        self.commands = []
+        self.command_flag = uasyncio.Event()
+        self.commands_submitted = 0
+        self.commands_merged = 0
+        self.commands_applied = 0
 
     def stop(self):
         self.should_stop = True
 
     async def mainloop(self):
+        self.loop.create_task(ulog.shipper.run())
+        self.loop.create_task(self.command_loop())
         self.loop.create_task(self.touchpad_loop())
+        scheduler.start(self.on_schedule)
 
         await self.update_leds()
 
@@ -43,189 +109,257 @@ class LevIoT:
         if conf.mqtt_enabled:
             self.loop.create_task(self.start_mqtt())
 
-        while True:
-            await uasyncio.sleep(1)
-            await persistence.track()
+        await timer_service.run()
+
+    def pending(self, kind: int, default):
+        """
+        Returns the value a pending command of the given kind will set, or default if there is none
+        """
+        for cmd in self.commands:
+            if cmd[0] == kind:
+                return cmd[1]
+        return default
+
+    def pending_prev_speed(self) -> int:
+        """
+        Returns the previous speed that will be set by a pending speed command, or the current one if there is none
+        """
+        for cmd in self.commands:
+            if cmd[0] == Command.SPEED:
+                return cmd[3]
+        return state_tracker.prev_speed
+
+    def target_speed(self) -> int:
+        """
+        Returns the current fan speed, or the speed a running kickstart will switch to
+        """
+        return self.kickstart_speed if self.is_kickstarting else state_tracker.speed
+
+    def submit(self, kind: int, value, cause="unknown"):
+        """
+        Queues a command to be applied by the command loop. A pending command of the same kind is replaced, so rapid
+        inputs only apply the final state.
+        """
+        if kind == Command.SPEED and not 0 <= value <= 3:
+            raise ValueError("Fan speed must be within 0 and 3")
+        if kind == Command.TIMER and not 0 <= value <= BMASK_TIMER_LEFT:
+            raise ValueError("Timer minutes must be within 0 and {}".format(BMASK_TIMER_LEFT))
+
+        prev_speed = None
+        if kind == Command.SPEED:
+            speed = self.pending(Command.SPEED, self.target_speed())
+            prev_speed = speed if value != speed else self.pending_prev_speed()
+
+        self.commands_submitted += 1
+        for cmd in self.commands:
+            if cmd[0] == kind:
+                self.commands.remove(cmd)
+                self.commands_merged += 1
+                break
+        self.commands.append([kind, value, cause, prev_speed])
+        self.command_flag.set()
+
+    async def command_loop(self):
+        while not self.should_stop:
+            while not self.commands:
+                self.command_flag.clear()
+                await self.command_flag.wait()
+
+            # Give rapid inputs a chance to be merged
+            await uasyncio.sleep_ms(constants.COMMAND_COALESCE_MS)
+
+            while self.commands:
+                kind, value, cause, prev_speed = self.commands.pop(0)
+                self.commands_applied += 1
+                try:
+                    await self._apply(kind, value, cause, prev_speed)
+                except Exception as e:
+                    log.e(e)
+
+    async def _apply(self, kind: int, value, cause: str, prev_speed):
+        if kind == Command.POWER:
+            if value != state_tracker.power:
+                await self.set_power(value, cause=cause)
+        elif kind == Command.SPEED:
+            await self.set_fan_speed(value, cause=cause)
+            # Merged commands may have skipped the speed NIGHT and FAN should go back to
+            state_tracker.set(Field.PREV_SPEED, prev_speed, cause)
+        elif kind == Command.TIMER:
+            await self.set_timer(value, cause=cause)
+        elif kind == Command.LIGHTS:
+            if value != state_tracker.lights:
+                await self.set_lights(value, cause=cause)
+        elif kind == Command.LOCK:
+            if value != state_tracker.lock:
+                await self.set_lock(value, cause=cause)
 
     async def start_mqtt(self):
         await self.mqtt.start()
         ulog.set_mqtt(self.mqtt)
 
     async def set_timer(self, time: int, cause="unknown"):
-        log.i("Set timer to {} minutes (cause: {})".format(time, cause))
-        timer_running = state_tracker.timer_left > 0
-        state_tracker.timer_left = time
+        log.i("Set timer to {} minutes (cause: {})", time, cause)
+        timer_running = self.countdown_timer is not None
+        state_tracker.set(Field.TIMER_LEFT, time, cause)
 
         with gpio:
             await self.update_leds()
 
-        if conf.mqtt_enabled:
-            await self.mqtt.notify_timer()
-
         if not timer_running and time > 0:
-            self.timer_task = self.loop.create_task(self.timer_loop())
-
-        if time == 0 and self.timer_task:
-            self.timer_task.cancel()
-
-    async def timer_loop(self):
-        try:
             if not state_tracker.power:
                 await self.set_power(True, cause="timer")
+            self.countdown_timer = timer_service.call_every(60 * 1000, self._countdown)
 
-            t1 = t2 = 0
-            while state_tracker.timer_left > 0:
-                await uasyncio.sleep_ms(60 * 1000 - (t2 - t1))
-                # Timer time might have changed by the time we get here
-                if state_tracker.timer_left <= 0:
-                    break
-                t1 = utime.time_ns() // 1000
-                state_tracker.timer_left -= 1
-                log.i("Timer {} minutes left".format(state_tracker.timer_left))
+        if time == 0 and self.countdown_timer:
+            self._stop_countdown()
+            log.i("Timer cancelled")
 
-                if conf.mqtt_enabled:
-                    await self.mqtt.notify_timer()
-                t2 = utime.time_ns() // 1000
+    def _stop_countdown(self):
+        if self.countdown_timer:
+            self.countdown_timer.cancel()
+            self.countdown_timer = None
+
+    async def _countdown(self):
+        # Timer time might have changed in the meantime
+        if state_tracker.timer_left <= 0:
+            self._stop_countdown()
+            return
 
+        state_tracker.set(Field.TIMER_LEFT, state_tracker.timer_left - 1, "timer")
+        log.i("Timer {} minutes left", state_tracker.timer_left)
+
+        if state_tracker.timer_left == 0:
+            self._stop_countdown()
             if state_tracker.power:
                 await self.set_power(False, cause="timer")
             log.i("Timer done")
-        except uasyncio.CancelledError:
-            log.i("Timer cancelled")
-        finally:
-            self.timer_task = None
 
     async def touchpad_loop(self):
         self.loop.create_task(touchpad_mgr.async_loop())
 
         try:
             while not self.should_stop:
-                pressed = touchpad_mgr.active_touchpads
-
-                if 'LOCK' in pressed:
-                    pad = pressed["LOCK"]
-                    _, hold_t = pad.read()
-                    if hold_t >= constants.TOUCHPAD_HOLD_TIMEOUT_MS:
-                        pad.ack()
-                        await self.set_lock(not state_tracker.lock, cause='touchpad')
-
-                if not state_tracker.lock:
-                    for name, pad in pressed.items():
-                        if name == "FILTER":
-                            _, hold_t = pad.read()
-                            if hold_t >= constants.TOUCHPAD_HOLD_TIMEOUT_MS:
-                                pad.ack()
-                                if persistence.replacement_due or persistence.dusting_due or state_tracker.user_maint:
-                                    persistence.notify_maintenance()
-                                else:
-                                    state_tracker.user_maint = False
-                                with gpio:
-                                    await self.update_leds(cause='touchpad')
-                        elif name == "POWER":
-                            pad.ack()
-                            await self.set_power(not state_tracker.power, cause="touchpad")
-
-                        elif name == "FAN":
-                            pad.ack()
-                            if state_tracker.speed == 0:
-                                await self.set_fan_speed(state_tracker.prev_speed or 1, cause="touchpad")
-                            else:
-                                await self.set_fan_speed(1 + (state_tracker.speed % 3), cause="touchpad")
-
-                        elif name == "NIGHT":
-                            pad.ack()
-                            if state_tracker.speed == 0:
-                                await self.set_fan_speed(state_tracker.prev_speed, cause="touchpad")
-                            else:
-                                await self.set_fan_speed(0, cause="touchpad")
-
-                        elif name == "LIGHT":
-                            pad.ack()
-                            await self.set_lights(not state_tracker.lights, cause="touchpad")
-
-                        elif name == "TIMER":
-                            pad.ack()
-                            newtime = state_tracker.timer_left + 2 * 60
-                            if newtime > 9 * 60:
-                                newtime = 0
-                            await self.set_timer(newtime, cause="touchpad")
-
-                await uasyncio.sleep_ms(constants.TOUCHPADS_POLL_INTERVAL_MS)
-
+                event, pad = await touchpad_mgr.next_event()
+                if event == TouchEvent.PRESS:
+                    latency = utime.ticks_diff(utime.ticks_ms(), pad.event_start)
+                    self.touch_latency_ms = latency
+                    if latency > self.touch_latency_max_ms:
+                        self.touch_latency_max_ms = latency
+                await self.on_touch_event(event, pad)
         finally:
             touchpad_mgr.stop()
 
-    async def _led_feedback_worker(self):
-        while True:
-            t = utime.ticks_ms()
-            if self.led_feedback_due_at_ms <= t:
-                break
-            await uasyncio.sleep_ms(self.led_feedback_due_at_ms - t)
+    async def on_touch_event(self, event: int, pad):
+        name = pad.name
 
-        self.led_feedback_due_at_ms = 0
-        with gpio:
-            await self.update_leds('action_feedback')
+        if event == TouchEvent.HOLD and name == "LOCK":
+            pad.ack()
+            self.submit(Command.LOCK, not self.pending(Command.LOCK, state_tracker.lock), cause='touchpad')
+            return
 
-    async def _led_feedback(self):
-        cur_ms = self.led_feedback_due_at_ms
-        self.led_feedback_due_at_ms = utime.ticks_ms() + constants.LIGHTS_OFF_TOUCHPAD_TIMEOUT
-
-        if cur_ms == 0:
-            self.loop.create_task(self._led_feedback_worker())
+        if state_tracker.lock:
+            return
 
-    async def update_leds(self, cause="unknown"):
-        if cause not in ("touchpad", "kickstart") and not state_tracker.lights:
-            gpio.leds(False)
-        else:
-            gpio.value(constants.LED_POWER, state_tracker.power)
-            # Provide feedback on poweroff when lights are off
-            if cause in ("touchpad", "kickstart") and not state_tracker.power and not state_tracker.lights:
-                gpio.on(constants.LED_POWER)
+        if event == TouchEvent.HOLD and name == "FILTER":
+            pad.ack()
+            if persistence.replacement_due or persistence.dusting_due or state_tracker.user_maint:
+                persistence.notify_maintenance()
+                if conf.mqtt_enabled:
+                    self.loop.create_task(self.mqtt.notify_filter())
+            else:
+                state_tracker.set(Field.USER_MAINT, False, "touchpad")
+            with gpio:
+                await self.update_leds(cause='touchpad')
 
-            gpio.value(constants.LED_FAN, state_tracker.speed > 0 and state_tracker.power)
+        elif event != TouchEvent.PRESS:
+            return
 
-            gpio.value(constants.LED_NIGHT, state_tracker.speed == 0 and state_tracker.power)
-            gpio.value(constants.LED_V1, state_tracker.speed == 1 and state_tracker.power)
-            gpio.value(constants.LED_V2, state_tracker.speed == 2 and state_tracker.power)
-            gpio.value(constants.LED_V3, state_tracker.speed == 3 and state_tracker.power)
+        elif name == "POWER":
+            pad.ack()
+            self.submit(Command.POWER, not self.pending(Command.POWER, state_tracker.power), cause="touchpad")
 
-            gpio.value(constants.LED_TIMER, state_tracker.timer_left > 0)
-            gpio.value(constants.LED_2H, 0 < state_tracker.timer_left <= 2 * 60)
-            gpio.value(constants.LED_4H, 2 * 60 < state_tracker.timer_left <= 4 * 60)
-            gpio.value(constants.LED_6H, 4 * 60 < state_tracker.timer_left <= 6 * 60)
-            gpio.value(constants.LED_8H, 6 * 60 < state_tracker.timer_left)
+        elif name == "FAN":
+            pad.ack()
+            speed = self.pending(Command.SPEED, self.target_speed())
+            if speed == 0:
+                self.submit(Command.SPEED, self.pending_prev_speed() or 1, cause="touchpad")
+            else:
+                self.submit(Command.SPEED, 1 + (speed % 3), cause="touchpad")
 
-            if persistence.replacement_due or state_tracker.user_maint:
-                gpio.value(constants.LED_FILTER, "blink")
+        elif name == "NIGHT":
+            pad.ack()
+            if self.pending(Command.SPEED, self.target_speed()) == 0:
+                self.submit(Command.SPEED, self.pending_prev_speed(), cause="touchpad")
             else:
-                gpio.value(constants.LED_FILTER, persistence.dusting_due)
+                self.submit(Command.SPEED, 0, cause="touchpad")
+
+        elif name == "LIGHT":
+            pad.ack()
+            self.submit(Command.LIGHTS, not self.pending(Command.LIGHTS, state_tracker.lights), cause="touchpad")
+
+        elif name == "TIMER":
+            pad.ack()
+            newtime = self.pending(Command.TIMER, state_tracker.timer_left) + 2 * 60
+            if newtime > 9 * 60:
+                newtime = 0
+            self.submit(Command.TIMER, newtime, cause="touchpad")
+
+    def on_schedule(self, power, speed):
+        log.i("Scheduled transition: power {}, speed {}", power, speed)
+        if power is not None:
+            self.submit(Command.POWER, power, cause="schedule")
+        if speed is not None:
+            self.submit(Command.SPEED, speed, cause="schedule")
+
+    async def _led_feedback_done(self):
+        self.led_feedback_timer = None
+        with gpio:
+            await self.update_leds('action_feedback')
 
-            if cause in ("touchpad", "kickstart") and not state_tracker.lights:
-                await self._led_feedback()
+    async def _led_feedback(self):
+        if self.led_feedback_timer is not None:
+            self.led_feedback_timer.cancel()
+        self.led_feedback_timer = timer_service.call_later(constants.LIGHTS_OFF_TOUCHPAD_TIMEOUT,
+                                                           self._led_feedback_done)
 
-        gpio.value(constants.LED_LOCK, state_tracker.lock and state_tracker.power)
+    async def update_leds(self, cause="unknown"):
+        feedback = cause in ("touchpad", "kickstart")
+        gpio.set_leds(led_frame(state_tracker.power, state_tracker.speed, state_tracker.timer_left, state_tracker.lock,
+                                state_tracker.lights, feedback))
 
-    async def set_power(self, on: bool, cause="unknown"):
-        state_tracker.power = on
+        if not feedback and not state_tracker.lights:
+            gpio.value(constants.LED_FILTER, False)
+            return
 
-        if conf.mqtt_enabled:
-            self.loop.create_task(self.mqtt.notify_power())
+        if persistence.replacement_due or state_tracker.user_maint:
+            gpio.value(constants.LED_FILTER, "blink")
+        else:
+            gpio.value(constants.LED_FILTER, persistence.dusting_due)
+
+        if feedback and not state_tracker.lights:
+            await self._led_feedback()
+
+    async def set_power(self, on: bool, cause="unknown"):
+        state_tracker.set(Field.POWER, on, cause)
 
-        log.i("Set power to {} (cause: {})".format(on, cause))
+        log.i("Set power to {} (cause: {})", on, cause)
 
         if on:
             # Kickstart fan asynchronously
-            async def kickstart_fan():
-                speed = state_tracker.speed
-                await self.set_fan_speed(3, cause="kickstart")
-                await uasyncio.sleep(1)
-                await self.set_fan_speed(speed, cause="kickstart")
-
-            uasyncio.get_event_loop().create_task(kickstart_fan())
+            if not self.is_kickstarting:
+                self.is_kickstarting = True
+                # Set before the task runs, so set_fan_speed() calls until then update it instead of being lost
+                self.kickstart_speed = state_tracker.speed
+                self.kickstart_done.clear()
+                self.kickstart_interrupt.clear()
+                self.loop.create_task(self.kickstart_fan())
             persistence.notify_poweron()
 
         else:
-            state_tracker.timer_left = 0
+            # Cut a running kickstart short, there's no point in spinning up anymore
+            self.kickstart_interrupt.set()
+            state_tracker.set(Field.TIMER_LEFT, 0, cause)
+            self._stop_countdown()
             with gpio:
                 gpio.value(constants.FAN_CTL0, False)
                 gpio.value(constants.FAN_CTL1, False)
@@ -235,53 +369,70 @@ class LevIoT:
 
             persistence.notify_poweroff()
 
+    async def kickstart_fan(self):
+        """
+        Spins the fan up at max speed for KICKSTART_MS, then switches to kickstart_speed. Speed requests arriving
+        meanwhile replace the final speed and shorten the kickstart to KICKSTART_MIN_MS.
+        """
+        try:
+            await self.set_fan_speed(3, cause="kickstart")
+            start = utime.ticks_ms()
+            try:
+                await uasyncio.wait_for(self.kickstart_interrupt.wait(), constants.KICKSTART_MS / 1000)
+                remaining = constants.KICKSTART_MIN_MS - utime.ticks_diff(utime.ticks_ms(), start)
+                if remaining > 0 and state_tracker.power:
+                    await uasyncio.sleep_ms(remaining)
+            except uasyncio.TimeoutError:
+                pass
+            await self.set_fan_speed(self.kickstart_speed, cause="kickstart")
+        finally:
+            self.is_kickstarting = False
+            self.kickstart_done.set()
+
     async def set_fan_speed(self, speed: int, cause="unknown"):
         if not 0 <= speed <= 3:
             raise ValueError("Fan speed must be within 0 and 3")
 
-        if cause == "kickstart":
-            self.is_kickstarting = True
-        else:
-            while self.is_kickstarting:
-                log.d("Set speed delayed due to kickstart")
-                await uasyncio.sleep(1)
-
-        try:
-            state_tracker.prev_speed = state_tracker.speed
-            state_tracker.speed = speed
+        if cause != "kickstart" and self.is_kickstarting:
+            # The kickstart will switch to this speed once done. Don't wait for it, so that the command loop can apply
+            # other commands meanwhile.
+            log.d("Set speed to {} after kickstart (cause: {})", speed, cause)
+            state_tracker.set(Field.PREV_SPEED, self.kickstart_speed, cause)
+            self.kickstart_speed = speed
+            self.kickstart_interrupt.set()
+            return
 
-            log.i("Set speed to {} (cause: {})".format(speed, cause))
+        # The kickstart's temporary full speed isn't one to go back to
+        if cause != "kickstart":
+            state_tracker.set(Field.PREV_SPEED, state_tracker.speed, cause)
+        state_tracker.set(Field.SPEED, speed, cause)
 
-            if conf.mqtt_enabled:
-                self.loop.create_task(self.mqtt.notify_speed())
+        log.i("Set speed to {} (cause: {})", speed, cause)
 
-            if not state_tracker.power:
-                return
+        if not state_tracker.power:
+            return
 
-            with gpio:
-                gpio.value(constants.FAN_CTL0, state_tracker.speed == 0 and state_tracker.power)
-                gpio.value(constants.FAN_CTL1, state_tracker.speed == 1 and state_tracker.power)
-                gpio.value(constants.FAN_CTL2, state_tracker.speed == 2 and state_tracker.power)
-                gpio.value(constants.FAN_CTL3, state_tracker.speed == 3 and state_tracker.power)
-                await self.update_leds(cause)
-        finally:
-            if cause == "kickstart":
-                self.is_kickstarting = False
+        with gpio:
+            gpio.value(constants.FAN_CTL0, state_tracker.speed == 0 and state_tracker.power)
+            gpio.value(constants.FAN_CTL1, state_tracker.speed == 1 and state_tracker.power)
+            gpio.value(constants.FAN_CTL2, state_tracker.speed == 2 and state_tracker.power)
+            gpio.value(constants.FAN_CTL3, state_tracker.speed == 3 and state_tracker.power)
+            await self.update_leds(cause)
 
     async def set_lights(self, lights: bool, cause="unknown"):
-        state_tracker.lights = lights
+        state_tracker.set(Field.LIGHTS, lights, cause)
         with gpio:
             await self.update_leds()  # Cause explicitly not provided so we don't get feedback
 
-        log.i("Set lights to {} (cause: {})".format(lights, cause))
+        log.i("Set lights to {} (cause: {})", lights, cause)
 
     async def set_lock(self, lock: bool, cause="unknown"):
         # Lock only if it's possible to see it is locked, fail with an info otherwise
         if state_tracker.power == True and state_tracker.lights == True:
-            state_tracker.lock = lock
+            state_tracker.set(Field.LOCK, lock, cause)
             with gpio:
                 await self.update_leds(cause)
 
-            log.i("Set lock to {} (cause: {})".format(lock, cause))
+            log.i("Set lock to {} (cause: {})", lock, cause)
         else:
             log.i("Cannot lock the screen while the lights are off or the motor is not running")
\ No newline at end of file
@@ -1,8 +1,11 @@
 import micropython
 import uasyncio
-from machine import Pin, Signal, PWM
+from array import array
+from machine import Pin, Signal, PWM, SPI
 
-from leviot import constants
+from leviot import constants, conf, ulog
+
+log = ulog.Logger("extgpio")
 
 
 @micropython.native
@@ -11,6 +14,79 @@ def pulse(pin: Signal):
     pin.off()
 
 
+# Bit-reversed byte lookup table: the shift register expects bit 0 to be shifted out first, while the SPI peripheral
+# always sends the most significant bit of each byte first
+def _bitrev_table() -> bytes:
+    table = bytearray(256)
+    for i in range(256):
+        r = 0
+        for b in range(8):
+            r = (r << 1) | ((i >> b) & 1)
+        table[i] = r
+    return bytes(table)
+
+
+_BITREV = _bitrev_table()
+
+
+class BitBangSRBackend:
+    """
+    Shifts the shift register word out one bit at a time through the data and clock GPIOs. Slow, since every
+    Pin.value() call takes ~200 us, but it works on any pin.
+    """
+
+    def __init__(self):
+        self.sr_shift = Signal(Pin(constants.PIN_SR_DS, Pin.OUT), invert=False)
+        self.sr_clock = Signal(Pin(constants.PIN_SR_CLK, Pin.OUT), invert=False)
+        self.sr_clock.off()
+        self.sr_shift.off()
+
+    @micropython.native
+    def write(self, word: int) -> None:
+        for bit in range(16):
+            self.sr_shift.value((word >> bit) & 1 == 1)
+            pulse(self.sr_clock)
+
+
+class SPISRBackend:
+    """
+    Pushes the whole shift register word in a single hardware SPI write, with the data and clock GPIOs routed to the
+    SPI peripheral's MOSI and SCK.
+    """
+
+    def __init__(self):
+        self.spi = SPI(conf.sr_spi_id, baudrate=constants.SR_SPI_BAUDRATE, polarity=0, phase=0, bits=8,
+                       firstbit=SPI.MSB, sck=Pin(constants.PIN_SR_CLK), mosi=Pin(constants.PIN_SR_DS),
+                       miso=Pin(constants.PIN_SR_SPI_MISO))
+        self.buf = bytearray(2)
+
+    @micropython.native
+    def write(self, word: int) -> None:
+        buf = self.buf
+        buf[0] = _BITREV[word & 0xff]
+        buf[1] = _BITREV[(word >> 8) & 0xff]
+        self.spi.write(buf)
+
+
+# Gamma-corrected PWM duty values for half a breathing cycle of the filter LED, from off to fully on. The blink loop
+# walks it back and forth at a low frame rate instead of stepping the duty linearly every couple of milliseconds.
+_BREATHE_STEPS = constants.FILTER_LED_BREATHE_PERIOD_MS // constants.FILTER_LED_BREATHE_FRAME_MS // 2
+_BREATHE_DUTY = array("H", (int(1023 * (i / _BREATHE_STEPS) ** constants.FILTER_LED_GAMMA + 0.5)
+                            for i in range(_BREATHE_STEPS + 1)))
+
+
+def make_sr_backend(name: str):
+    if name == "spi":
+        try:
+            return SPISRBackend()
+        except (OSError, ValueError) as e:
+            log.e("Unable to set up SPI for the shift register, falling back to bit-banging")
+            log.e(e)
+    elif name != "bitbang":
+        log.w("Unknown shift register backend '{}', using bit-banging", name)
+    return BitBangSRBackend()
+
+
 class GPIOManager:
     """
     Helper class to handle the connected shift register + GPIOs transparently.
@@ -22,15 +98,20 @@ class GPIOManager:
         self.filter_led_cur = False
         self.filter_led_staging = False
 
+        # Deferred commit mode: "with gpio:" blocks only mark the state as dirty and a single flush task latches the
+        # shift register once per event loop turn (or once per frame_ms)
+        self.deferred = False
+        self.frame_ms = 0
+        self._flush_pending = False
+        self.commits_requested = 0
+        self.commits_latched = 0
+
         self.s_filter_led = Pin(constants.PIN_LED_FILTER, Pin.OUT)
         self.s_filter_led.off()
 
-        self.sr_shift = Signal(Pin(constants.PIN_SR_DS, Pin.OUT), invert=False)
         self.sr_latch = Signal(Pin(constants.PIN_SR_LATCH, Pin.OUT), invert=False)
-        self.sr_clock = Signal(Pin(constants.PIN_SR_CLK, Pin.OUT), invert=False)
         self.sr_outen = Signal(Pin(constants.PIN_SR_OUTEN, Pin.OUT), invert=True)
-        self.sr_clock.off()
-        self.sr_shift.off()
+        self.sr_backend = make_sr_backend(conf.sr_backend)
         self.sr_latch.off()
         self.sr_outen.off()
 
@@ -38,6 +119,31 @@ class GPIOManager:
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.commits_requested += 1
+        if self.deferred:
+            self.schedule_flush()
+        else:
+            self.commit()
+
+    def enable_deferred_commit(self, frame_ms: int = 0):
+        """
+        Coalesce commits from "with gpio:" blocks. Can be enabled before the event loop runs, but then nothing is
+        latched until it starts and the flush task gets to run.
+        """
+        self.frame_ms = frame_ms
+        self.deferred = True
+
+    def schedule_flush(self):
+        if self._flush_pending:
+            return
+        self._flush_pending = True
+        uasyncio.get_event_loop().create_task(self._flush())
+
+    async def _flush(self):
+        try:
+            await uasyncio.sleep_ms(self.frame_ms)
+        finally:
+            self._flush_pending = False
         self.commit()
 
     def init(self):
@@ -61,11 +167,10 @@ class GPIOManager:
             return
 
         self.sr_latch.off()
-        for bit in range(16):
-            self.sr_shift.value((self.sr_staging >> bit) & 1 == 1)
-            pulse(self.sr_clock)
+        self.sr_backend.write(self.sr_staging)
         pulse(self.sr_latch)
         self.sr_cur = self.sr_staging
+        self.commits_latched += 1
 
     def value(self, bit: int, value):
         if bit == constants.LED_FILTER:
@@ -83,6 +188,19 @@ class GPIOManager:
     def off(self, bit: int):
         self.value(bit, False)
 
+    def set_leds(self, frame: int):
+        """
+        Replace all shift register LED bits at once with the ones set in frame, leaving fan control bits alone
+        """
+        self.sr_staging = (self.sr_staging & ~constants.ALL_SR_LEDS) | (frame & constants.ALL_SR_LEDS)
+
+    def as_dict(self) -> dict:
+        return {
+            "deferred_commit": self.deferred,
+            "commits_requested": self.commits_requested,
+            "commits_latched": self.commits_latched,
+        }
+
     def leds(self, value: bool):
         """
         Helper function to set all LEDs to some value
@@ -102,15 +220,12 @@ class GPIOManager:
 
     async def blink_loop(self):
         pwm = PWM(self.s_filter_led)
-        increment = 1
-        duty = 0
+        cycle = 2 * _BREATHE_STEPS
+        frame = 0
         while self.filter_led_cur == "blink":
-            while self.filter_led_cur == "blink" and 0 <= duty <= 1023:
-                pwm.duty(duty)
-                duty += increment
-                await uasyncio.sleep_ms(2)
-            increment *= -1
-            duty += increment
+            pwm.duty(_BREATHE_DUTY[frame if frame <= _BREATHE_STEPS else cycle - frame])
+            frame = (frame + 1) % cycle
+            await uasyncio.sleep_ms(constants.FILTER_LED_BREATHE_FRAME_MS)
 
         pwm.deinit()
         self.s_filter_led.value(self.filter_led_cur)
@@ -0,0 +1,181 @@
+from array import array
+
+import ustruct
+import utime
+from micropython import const
+
+from leviot import ulog
+
+log = ulog.Logger("history")
+
+# Runtime history: seconds spent at each fan speed, in hourly buckets.
+#
+# Buckets live in a fixed-size ring indexed by UTC hour, so hour h always lands in the same slot and old data is simply
+# overwritten. The ring is split in days, each stored in its own NVS blob next to the state record:
+#   UTC day number since the epoch (I), then 24 hours x 4 speeds of seconds (H)
+# A day blob (196 bytes, about 9 NVS entries) is only written when an hour is over or the device is turned off, instead
+# of every minute like the lifetime counters, so the history adds about 5% to the NVS wear.
+#
+# Times come from the RTC, so the history is only meaningful once the clock has been set over NTP.
+
+HISTORY_DAYS = const(14)
+SPEEDS = const(4)
+
+_HOURS_PER_DAY = const(24)
+_DAY_SIZE = const(24 * 4)
+_SECONDS_PER_HOUR = const(60 * 60)
+_SECONDS_PER_DAY = const(24 * 60 * 60)
+
+_BLOB = "<I" + "H" * _DAY_SIZE
+_BLOB_SIZE = const(4 + 2 * 24 * 4)
+
+RESOLUTIONS = ("hour", "day", "week")
+
+
+def _blob_key(slot: int) -> str:
+    return "Hist{}".format(slot)
+
+
+class UsageHistory:
+    """
+    Ring of hourly runtime buckets per fan speed, persisted one day per NVS blob. Blobs are written with the given NVS
+    handle but not committed: the caller commits them along with its own values.
+    """
+
+    def __init__(self, nvs):
+        self.nvs = nvs
+        self.seconds = array("H", bytearray(HISTORY_DAYS * _DAY_SIZE * 2))
+        # UTC day held by each slot, 0 if empty
+        self.days = array("I", bytearray(HISTORY_DAYS * 4))
+        # Bit mask of the slots changed since the last flush
+        self.dirty = 0
+        self.flushed_hour = utime.time() // _SECONDS_PER_HOUR
+
+        # Optional WearStats, set if the blobs share the flash of the persistence storage
+        self.stats = None
+
+        self._load()
+
+    def _load(self):
+        buf = bytearray(_BLOB_SIZE)
+        loaded = 0
+        for slot in range(HISTORY_DAYS):
+            try:
+                size = self.nvs.get_blob(_blob_key(slot), buf)
+            except OSError:
+                continue
+            if size != _BLOB_SIZE:
+                log.w("History blob {} has the wrong size: {}", slot, size)
+                continue
+            fields = ustruct.unpack(_BLOB, buf)
+            if fields[0] % HISTORY_DAYS != slot:
+                continue
+            self.days[slot] = fields[0]
+            base = slot * _DAY_SIZE
+            for i in range(_DAY_SIZE):
+                self.seconds[base + i] = fields[1 + i]
+            loaded += 1
+        log.d("Loaded {} days of usage history", loaded)
+
+    def _slot(self, day: int) -> int:
+        slot = day % HISTORY_DAYS
+        if self.days[slot] != day:
+            base = slot * _DAY_SIZE
+            for i in range(base, base + _DAY_SIZE):
+                self.seconds[i] = 0
+            self.days[slot] = day
+        self.dirty |= 1 << slot
+        return slot
+
+    def add(self, start: int, end: int, speed: int):
+        """
+        Accounts the time between start and end to speed, split across the hours it spans
+        """
+        # Time older than the ring would be overwritten anyway, and after the clock is first set it can be decades
+        start = max(start, end - HISTORY_DAYS * _SECONDS_PER_DAY)
+        while start < end:
+            hour_end = (start // _SECONDS_PER_HOUR + 1) * _SECONDS_PER_HOUR
+            chunk = min(end, hour_end) - start
+            slot = self._slot(start // _SECONDS_PER_DAY)
+            i = (slot * _HOURS_PER_DAY + start % _SECONDS_PER_DAY // _SECONDS_PER_HOUR) * SPEEDS + speed
+            self.seconds[i] = min(self.seconds[i] + chunk, 0xffff)
+            start += chunk
+
+    def flush(self, force: bool = False) -> bool:
+        """
+        Writes the changed days once per hour, or right away if force is True. Returns True if anything was written.
+        """
+        hour = utime.time() // _SECONDS_PER_HOUR
+        if not self.dirty or (not force and hour == self.flushed_hour):
+            return False
+
+        buf = bytearray(_BLOB_SIZE)
+        for slot in range(HISTORY_DAYS):
+            if not self.dirty & (1 << slot):
+                continue
+            base = slot * _DAY_SIZE
+            ustruct.pack_into("<I", buf, 0, self.days[slot])
+            for i in range(_DAY_SIZE):
+                ustruct.pack_into("<H", buf, 4 + 2 * i, self.seconds[base + i])
+            self.nvs.set_blob(_blob_key(slot), buf)
+            if self.stats is not None:
+                self.stats.wrote(None, _BLOB_SIZE)
+
+        self.dirty = 0
+        self.flushed_hour = hour
+        return True
+
+    def totals(self, days: int = HISTORY_DAYS):
+        """
+        Returns the seconds spent at each speed over the last days, and the seconds elapsed since the start of the
+        oldest of them with any data
+        """
+        now = utime.time()
+        today = now // _SECONDS_PER_DAY
+        totals = [0] * SPEEDS
+        since = now
+        for day in range(today - min(days, HISTORY_DAYS) + 1, today + 1):
+            slot = day % HISTORY_DAYS
+            if self.days[slot] != day:
+                continue
+            since = min(since, day * _SECONDS_PER_DAY)
+            base = slot * _DAY_SIZE
+            for i in range(_DAY_SIZE):
+                totals[i % SPEEDS] += self.seconds[base + i]
+        return totals, now - since
+
+    def rows(self, resolution: str = "hour"):
+        """
+        Yields (start time, seconds at each speed) from the oldest to the newest bucket, summed by day or week (starting
+        on Monday) if requested. Days without any data are skipped.
+        """
+        if resolution not in RESOLUTIONS:
+            raise ValueError("Unknown history resolution: {}".format(resolution))
+
+        today = utime.time() // _SECONDS_PER_DAY
+        start = None
+        sums = [0] * SPEEDS
+        for day in range(today - HISTORY_DAYS + 1, today + 1):
+            slot = day % HISTORY_DAYS
+            if self.days[slot] != day:
+                continue
+            base = slot * _DAY_SIZE
+
+            if resolution == "hour":
+                for hour in range(_HOURS_PER_DAY):
+                    i = base + hour * SPEEDS
+                    yield day * _SECONDS_PER_DAY + hour * _SECONDS_PER_HOUR, list(self.seconds[i:i + SPEEDS])
+                continue
+
+            period = day
+            if resolution == "week":
+                period -= utime.gmtime(day * _SECONDS_PER_DAY)[6]
+            if start is not None and period * _SECONDS_PER_DAY != start:
+                yield start, sums
+                sums = [0] * SPEEDS
+            start = period * _SECONDS_PER_DAY
+            for i in range(_DAY_SIZE):
+                sums[i % SPEEDS] += self.seconds[base + i]
+
+        if start is not None:
+            yield start, sums
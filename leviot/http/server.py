@@ -1,12 +1,19 @@
 import machine
 import uasyncio as asyncio
+import ujson
 import usys
 
 from leviot import conf, ulog
 from leviot.constants import FAN_SPEED_MAP
+from leviot.extgpio import gpio
 from leviot.http import uhttp, html, ufirewall
 from leviot.http.uhttp import HTTPError
-from leviot.state import state_tracker
+from leviot.history import RESOLUTIONS
+from leviot.persistence import persistence
+from leviot.schedule import scheduler
+from leviot.state import state_tracker, Command
+from leviot.touchpad import touchpad_mgr
+from leviot.utils.iso8601 import timestamp_to_datetime
 
 log = ulog.Logger("http_server")
 
@@ -25,7 +32,7 @@ class HttpServer:
 
     async def serve(self):
         await asyncio.start_server(self.on_http_connection, conf.http_listen, conf.http_port)
-        log.i("HTTP server up at {}:{}".format(conf.http_listen, conf.http_port))
+        log.i("HTTP server up at {}:{}", conf.http_listen, conf.http_port)
 
     async def on_http_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         # noinspection PyBroadException
@@ -33,14 +40,14 @@ class HttpServer:
             ip, port = reader.get_extra_info('peername')
 
             if not ufirewall.is_allowed(ip):
-                log.w("IP not allowed: {}".format(ip))
+                log.w("IP not allowed: {}", ip)
                 await close_streams(writer)
                 return
 
             req = await uhttp.HTTPRequest.parse(reader)
 
-            log.d("New connection from {}:{}".format(ip, port))
-            log.d("{} {}".format(req.method, req.path))
+            log.d("New connection from {}:{}", ip, port)
+            log.d("{} {}", req.method, req.path)
 
             if getattr(conf, 'http_basic_auth'):
                 if not req.check_basic_auth(conf.http_basic_auth):
@@ -60,6 +67,22 @@ class HttpServer:
                     await self.handle_priv_set_power(writer, False)
                 elif req.path == "/priv-api/timer":
                     await self.handle_priv_set_timer(req, writer)
+                elif req.path == "/priv-api/wear":
+                    await self.handle_priv_wear(writer)
+                elif req.path == "/priv-api/maintenance":
+                    await self.handle_priv_maintenance(writer)
+                elif req.path == "/priv-api/history":
+                    await self.handle_priv_history(req, writer)
+                elif req.path == "/priv-api/log":
+                    await self.handle_priv_log(writer)
+                elif req.path == "/priv-api/log-level":
+                    await self.handle_priv_log_level(req, writer)
+                elif req.path == "/priv-api/schedule":
+                    await self.handle_priv_schedule(req, writer)
+                elif req.path == "/priv-api/touch":
+                    await self.handle_priv_touch(writer)
+                elif req.path == "/priv-api/calibrate-touch":
+                    await self.handle_priv_calibrate_touch(writer)
                 elif req.path == "/priv-api/reset":
                     await self.handle_priv_reset(writer)
                 else:
@@ -77,13 +100,14 @@ class HttpServer:
 
     @staticmethod
     async def handle_http_index(req: uhttp.HTTPRequest, writer: asyncio.StreamWriter):
+        state = state_tracker.snapshot()
 
         await uhttp.HTTPResponse(
             200,
             body=html.index.format(
-                power='ON' if state_tracker.power else "OFF",
-                speed=FAN_SPEED_MAP[state_tracker.speed],
-                timer=state_tracker.timer_left
+                power='ON' if state.power else "OFF",
+                speed=FAN_SPEED_MAP[state.speed],
+                timer=state.timer_left
             ),
             headers={'Content-Type': 'text/html;charset=utf-8'}
         ).write_into(writer)
@@ -94,7 +118,7 @@ class HttpServer:
             return await uhttp.HTTPResponse.bad_request(writer)
         try:
             speed = int(speed_str)
-            await self.leviot.set_fan_speed(speed, cause="http")
+            self.leviot.submit(Command.SPEED, speed, cause="http")
         except Exception as e:
             print(e)
             return await uhttp.HTTPResponse.bad_request(writer)
@@ -103,7 +127,7 @@ class HttpServer:
 
     async def handle_priv_set_power(self, writer: asyncio.StreamWriter, power: bool):
         try:
-            await self.leviot.set_power(power, cause="http")
+            self.leviot.submit(Command.POWER, power, cause="http")
         except Exception as e:
             log.e(e)
             return await uhttp.HTTPResponse.internal_server_error(writer)
@@ -116,13 +140,127 @@ class HttpServer:
             return await uhttp.HTTPResponse.bad_request(writer)
         try:
             timer = int(timer_str)
-            await self.leviot.set_timer(timer, cause="http")
+            self.leviot.submit(Command.TIMER, timer, cause="http")
         except Exception as e:
             print(e)
             return await uhttp.HTTPResponse.bad_request(writer)
 
         await uhttp.HTTPResponse.see_other(writer, "/")
 
+    @staticmethod
+    async def handle_priv_wear(writer: asyncio.StreamWriter):
+        await uhttp.HTTPResponse(
+            200,
+            body=ujson.dumps(persistence.wear.as_dict()),
+            headers={'Content-Type': 'application/json'}
+        ).write_into(writer)
+
+    @staticmethod
+    async def handle_priv_maintenance(writer: asyncio.StreamWriter):
+        dusting_eta = persistence.dusting_eta
+        replacement_eta = persistence.replacement_eta
+        await uhttp.HTTPResponse(
+            200,
+            body=ujson.dumps({
+                "dusting_due": persistence.dusting_due,
+                "replacement_due": persistence.replacement_due,
+                "dusting_eta": timestamp_to_datetime(dusting_eta) if dusting_eta >= 0 else None,
+                "replacement_eta": timestamp_to_datetime(replacement_eta) if replacement_eta >= 0 else None,
+            }),
+            headers={'Content-Type': 'application/json'}
+        ).write_into(writer)
+
+    @staticmethod
+    async def handle_priv_history(req: uhttp.HTTPRequest, writer: asyncio.StreamWriter):
+        resolution = req.query.get("resolution", "hour")
+        fmt = req.query.get("format", "csv")
+        if resolution not in RESOLUTIONS or fmt not in ("csv", "json"):
+            return await uhttp.HTTPResponse.bad_request(writer)
+
+        rows = persistence.history.rows(resolution)
+        if fmt == "json":
+            body = ujson.dumps({
+                "resolution": resolution,
+                "speeds": FAN_SPEED_MAP,
+                "rows": [{"time": timestamp_to_datetime(t), "seconds": seconds} for t, seconds in rows],
+            })
+            content_type = 'application/json'
+        else:
+            lines = ["time," + ",".join(FAN_SPEED_MAP)]
+            for t, seconds in rows:
+                lines.append(timestamp_to_datetime(t) + "," + ",".join(str(s) for s in seconds))
+            body = "\n".join(lines) + "\n"
+            content_type = 'text/csv;charset=utf-8'
+
+        await uhttp.HTTPResponse(
+            200,
+            body=body,
+            headers={'Content-Type': content_type}
+        ).write_into(writer)
+
+    @staticmethod
+    async def handle_priv_schedule(req: uhttp.HTTPRequest, writer: asyncio.StreamWriter):
+        rules = req.query.get("rules", None)
+        if rules is not None:
+            try:
+                scheduler.load(rules)
+            except ValueError as e:
+                log.w(e)
+                return await uhttp.HTTPResponse.bad_request(writer)
+
+        await uhttp.HTTPResponse(
+            200,
+            body=scheduler.rules,
+            headers={'Content-Type': 'text/plain;charset=utf-8'}
+        ).write_into(writer)
+
+    @staticmethod
+    async def handle_priv_log(writer: asyncio.StreamWriter):
+        stats = ulog.shipper.as_dict()
+        # Shift register commits, to check how many "with gpio:" blocks were coalesced
+        stats["gpio"] = gpio.as_dict()
+        await uhttp.HTTPResponse(
+            200,
+            body=ujson.dumps(stats),
+            headers={'Content-Type': 'application/json'}
+        ).write_into(writer)
+
+    @staticmethod
+    async def handle_priv_log_level(req: uhttp.HTTPRequest, writer: asyncio.StreamWriter):
+        levels = req.query.get("levels", None)
+        if levels is not None:
+            try:
+                ulog.set_levels(levels)
+            except ValueError as e:
+                log.w(e)
+                return await uhttp.HTTPResponse.bad_request(writer)
+
+        await uhttp.HTTPResponse(
+            200,
+            body=ulog.levels(),
+            headers={'Content-Type': 'text/plain;charset=utf-8'}
+        ).write_into(writer)
+
+    async def handle_priv_touch(self, writer: asyncio.StreamWriter):
+        stats = touchpad_mgr.as_dict()
+        stats["latency_ms"] = self.leviot.touch_latency_ms
+        stats["latency_max_ms"] = self.leviot.touch_latency_max_ms
+        await uhttp.HTTPResponse(
+            200,
+            body=ujson.dumps(stats),
+            headers={'Content-Type': 'application/json'}
+        ).write_into(writer)
+
+    @staticmethod
+    async def handle_priv_calibrate_touch(writer: asyncio.StreamWriter):
+        try:
+            touchpad_mgr.start_calibration()
+        except OSError as e:
+            log.e(e)
+            return await uhttp.HTTPResponse.internal_server_error(writer)
+
+        await uhttp.HTTPResponse.see_other(writer, "/")
+
     @staticmethod
     async def handle_priv_reset(writer: asyncio.StreamWriter):
         await uhttp.HTTPResponse().write_into(writer)
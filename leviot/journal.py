@@ -0,0 +1,296 @@
+import ustruct
+from micropython import const
+
+from leviot import ulog
+
+log = ulog.Logger("journal")
+
+# Append-only journal of unsigned 32 bit values, stored in a raw flash partition used as a ring of sectors.
+#
+# NVS spends a 32 byte entry on every value written, so updating two counters every minute fills and erases a 4 KB page
+# about every hour. The journal instead appends small delta records to erased flash, which can be programmed without
+# erasing it first. A sector is only erased when the ring wraps around to it.
+#
+# Sector layout:
+#   header (8 bytes): magic "LJ", version (B), CRC-8 of the other header bytes (B), sequence number (I)
+#   records, starting with a checkpoint of every known value, up to the first erased (0xff) slot
+#
+# Records are made of 4 byte slots. The first byte holds the record kind in the high nibble and the key id in the low
+# one, the second a CRC-8 of all the other bytes in the record:
+#   SET:      (B kind|key, B crc, H unused), then I value
+#   ADD:      (B kind|key, B crc, h delta)
+#   ADD_PAIR: (B kind|key, B crc, B delta to key, B delta to key + 1)
+#
+# The header is written after the checkpoint, so a sector that was erased but not completely initialized before a power
+# loss is ignored and the previous one is used instead. Records that fail their CRC are skipped on replay.
+
+JOURNAL_MAGIC = b"LJ"
+JOURNAL_VERSION = const(1)
+
+_HEADER = "<2sBBI"
+_HEADER_SIZE = const(8)
+_SLOT_SIZE = const(4)
+
+KIND_SET = const(1)
+KIND_ADD = const(2)
+KIND_ADD_PAIR = const(3)
+
+# Block device ioctls
+_IOCTL_BLOCK_COUNT = const(4)
+_IOCTL_BLOCK_SIZE = const(5)
+_IOCTL_BLOCK_ERASE = const(6)
+
+
+def _crc8_table() -> bytes:
+    table = bytearray(256)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xff if crc & 0x80 else (crc << 1) & 0xff
+        table[i] = crc
+    return bytes(table)
+
+
+_CRC8_TABLE = _crc8_table()
+
+
+def crc8(data, start: int = 0, crc: int = 0) -> int:
+    """
+    CRC-8 with polynomial 0x07 of data[start:], continuing from crc
+    """
+    for i in range(start, len(data)):
+        crc = _CRC8_TABLE[crc ^ data[i]]
+    return crc
+
+
+def _record_crc(record) -> int:
+    # Covers every byte but the CRC itself
+    return crc8(record, 2, _CRC8_TABLE[record[0]])
+
+
+class Journal:
+    """
+    Persistence storage backend. Values set since the last commit() are appended as one batch of records when it's
+    called.
+    """
+
+    def __init__(self, partition, keys: tuple):
+        """
+        keys are the names of the values that can be stored, at most 16. Their position is their id in the records.
+        """
+        if len(keys) > 16:
+            raise ValueError("Too many journal keys")
+        self.partition = partition
+        # The journal doesn't write to NVS, see leviot.staterecord
+        self.nvs = None
+        self.keys = keys
+        self.sectors = partition.ioctl(_IOCTL_BLOCK_COUNT, 0)
+        self.sector_size = partition.ioctl(_IOCTL_BLOCK_SIZE, 0)
+        if self.sectors < 2:
+            raise ValueError("The journal needs at least 2 sectors")
+
+        # Committed values, None if never set
+        self.values = [None] * len(keys)
+        self.pending = {}
+        self.sector = 0
+        self.seq = 0
+        self.pos = 0
+
+        self.records_written = 0
+        self.bytes_written = 0
+        self.sectors_erased = 0
+
+        # Optional WearStats, and the (key, second key, size) of the records encoded but not reported to it yet
+        self.stats = None
+        self.unreported = []
+        self.erase_unit_bytes = self.sector_size
+        self.wear_sectors = self.sectors
+
+        self._replay()
+
+    @property
+    def empty(self) -> bool:
+        return self.pos == 0
+
+    def _read_header(self, sector: int):
+        buf = bytearray(_HEADER_SIZE)
+        self.partition.readblocks(sector, buf, 0)
+        magic, version, crc, seq = ustruct.unpack(_HEADER, buf)
+        if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION:
+            return None
+        buf[3] = 0
+        if crc8(buf) != crc:
+            return None
+        return seq
+
+    def _replay(self):
+        head = None
+        for sector in range(self.sectors):
+            seq = self._read_header(sector)
+            if seq is not None and (head is None or seq > self.seq):
+                head = sector
+                self.seq = seq
+        if head is None:
+            log.i("Journal is empty")
+            return
+        self.sector = head
+
+        data = bytearray(self.sector_size)
+        self.partition.readblocks(head, data, 0)
+        pos = _HEADER_SIZE
+        skipped = 0
+        while pos + _SLOT_SIZE <= self.sector_size:
+            if data[pos] == 0xff and data[pos + 1] == 0xff and data[pos + 2] == 0xff and data[pos + 3] == 0xff:
+                break
+            kind, key = data[pos] >> 4, data[pos] & 0xf
+            size = 2 * _SLOT_SIZE if kind == KIND_SET else _SLOT_SIZE
+            record = data[pos:pos + size]
+            pos += size
+            if len(record) != size or _record_crc(record) != record[1] or key >= len(self.keys):
+                skipped += 1
+                continue
+
+            if kind == KIND_SET:
+                self.values[key] = ustruct.unpack_from("<I", record, 4)[0]
+            elif kind == KIND_ADD:
+                self.values[key] = (self.values[key] or 0) + ustruct.unpack_from("<h", record, 2)[0]
+            elif kind == KIND_ADD_PAIR and key + 1 < len(self.keys):
+                self.values[key] = (self.values[key] or 0) + record[2]
+                self.values[key + 1] = (self.values[key + 1] or 0) + record[3]
+            else:
+                skipped += 1
+        self.pos = pos
+
+        log.i("Journal replayed from sector {} (seq {}), {} bytes used", head, self.seq, pos)
+        if skipped:
+            log.w("Skipped {} corrupted journal records", skipped)
+
+    def get(self, key: str) -> int:
+        value = self.pending.get(key, None)
+        if value is None:
+            value = self.values[self.keys.index(key)]
+        if value is None:
+            raise OSError("Journal key not found: {}".format(key))
+        return value
+
+    def set(self, key: str, value: int):
+        self.keys.index(key)
+        self.pending[key] = value
+
+    def _encode_pending(self) -> bytearray:
+        ids = sorted(self.keys.index(key) for key in self.pending)
+        out = bytearray()
+        i = 0
+        while i < len(ids):
+            key = ids[i]
+            new = self.pending[self.keys[key]]
+            old = self.values[key]
+            delta = new - old if old is not None else None
+
+            if delta == 0:
+                pass
+            elif i + 1 < len(ids) and ids[i + 1] == key + 1 and delta is not None and 0 <= delta <= 0xff:
+                new2 = self.pending[self.keys[key + 1]]
+                old2 = self.values[key + 1]
+                if old2 is not None and 0 <= new2 - old2 <= 0xff:
+                    out.extend(self._record(ustruct.pack("<BBBB", KIND_ADD_PAIR << 4 | key, 0, delta, new2 - old2),
+                                            key, key + 1))
+                    i += 2
+                    continue
+                out.extend(self._record(ustruct.pack("<BBh", KIND_ADD << 4 | key, 0, delta), key))
+            elif delta is not None and -0x8000 <= delta < 0x8000:
+                out.extend(self._record(ustruct.pack("<BBh", KIND_ADD << 4 | key, 0, delta), key))
+            else:
+                out.extend(self._record(ustruct.pack("<BBHI", KIND_SET << 4 | key, 0, 0, new & 0xffffffff), key))
+            i += 1
+        return out
+
+    def _record(self, record: bytes, key: int, key2: int = None) -> bytearray:
+        record = bytearray(record)
+        record[1] = _record_crc(record)
+        self.records_written += 1
+        if self.stats is not None:
+            self.unreported.append((key, key2, len(record)))
+        return record
+
+    def _report(self):
+        for key, key2, size in self.unreported:
+            if key2 is None:
+                self.stats.wrote(key, size)
+            else:
+                self.stats.wrote(key, size // 2)
+                self.stats.wrote(key2, size // 2)
+        self.unreported.clear()
+
+    def _checkpoint(self) -> bytearray:
+        out = bytearray()
+        for key in range(len(self.keys)):
+            if self.values[key] is not None:
+                out.extend(self._record(ustruct.pack("<BBHI", KIND_SET << 4 | key, 0, 0, self.values[key] & 0xffffffff),
+                                        key))
+        return out
+
+    def _write(self, data):
+        self.partition.writeblocks(self.sector, data, self.pos)
+        self.pos += len(data)
+        self.bytes_written += len(data)
+
+    def _rotate(self):
+        """
+        Starts the next sector with a checkpoint of the committed values
+        """
+        sector = (self.sector + 1) % self.sectors
+        self.partition.ioctl(_IOCTL_BLOCK_ERASE, sector)
+        self.sectors_erased += 1
+
+        self.sector = sector
+        self.seq += 1
+        self.pos = _HEADER_SIZE
+        self.unreported.clear()
+        self._write(self._checkpoint())
+
+        header = bytearray(ustruct.pack(_HEADER, JOURNAL_MAGIC, JOURNAL_VERSION, 0, self.seq))
+        header[3] = crc8(header)
+        self.partition.writeblocks(sector, header, 0)
+        self.bytes_written += _HEADER_SIZE
+        if self.stats is not None:
+            self.stats.wrote(None, _HEADER_SIZE)
+
+    def needs_commit(self) -> bool:
+        return bool(self.pending)
+
+    def commit(self):
+        if not self.pending:
+            return
+        records = self._encode_pending()
+        if not self.empty and self.pos + len(records) <= self.sector_size:
+            if records:
+                self._write(records)
+            for key, value in self.pending.items():
+                self.values[self.keys.index(key)] = value
+        else:
+            # The checkpoint at the start of the next sector already holds the new values
+            for key, value in self.pending.items():
+                self.values[self.keys.index(key)] = value
+            self._rotate()
+        self.pending.clear()
+        if self.stats is not None:
+            self._report()
+            self.stats.committed()
+
+    def migrate(self, storage):
+        """
+        Seeds an empty journal with the values held by another storage backend
+        """
+        if not self.empty:
+            return
+        found = 0
+        for key in self.keys:
+            try:
+                self.set(key, storage.get(key))
+                found += 1
+            except OSError:
+                pass
+        if found:
+            self.commit()
+            log.i("Migrated {} values to the journal", found)
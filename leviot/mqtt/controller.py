@@ -1,7 +1,10 @@
 import uasyncio
 
-from leviot import conf, ulog
-from leviot.state import state_tracker
+from leviot import conf, constants, ulog
+from leviot.persistence import persistence
+from leviot.schedule import scheduler
+from leviot.state import state_tracker, Command, Field, BMASK_TIMER_LEFT
+from leviot.timers import timer_service
 from leviot.utils import iso8601
 from mqtt_as.timeout import MQTTClient
 
@@ -31,6 +34,12 @@ class MQTTController:
         })
 
         self.client = MQTTClient(conf.mqtt_config)
+        state_tracker.subscribe(self._on_state_change)
+        # Started once connected, see _on_connect()
+        self.wear_timer = None
+        self.filter_timer = None
+        # Dusting and replacement ETAs last published, see notify_filter()
+        self.filter_etas = None
 
     async def start(self):
         self.loop.create_task(self.connect_loop())
@@ -42,7 +51,7 @@ class MQTTController:
                 await self.client.connect()
                 break
             except Exception as e:
-                log.e("MQTT connect error, retrying in 5 seconds: {}".format(str(e)))
+                log.e("MQTT connect error, retrying in 5 seconds: {}", str(e))
                 await uasyncio.sleep(5)
         log.i("MQTT started")
 
@@ -52,6 +61,8 @@ class MQTTController:
         await self.client.subscribe(self.base_topic + "/fan/power/set")
         await self.client.subscribe(self.base_topic + "/timer/minutes/set")
         await self.client.subscribe(self.base_topic + "/timer/iso8601/set")
+        await self.client.subscribe(self.base_topic + "/system/schedule/set")
+        await self.client.subscribe(self.base_topic + "/system/log-level/set")
 
         await self.client.publish(self.state_topic, "init", retain=True, timeout=60)
 
@@ -59,7 +70,7 @@ class MQTTController:
             # Device attributes
             await self.client.publish(self.base_topic + "/$homie", "4.0.0", retain=True, timeout=60)
             await self.client.publish(self.base_topic + "/$name", conf.homie_friendly_name, retain=True, timeout=60)
-            await self.client.publish(self.base_topic + "/$nodes", "fan,timer,system", retain=True, timeout=60)
+            await self.client.publish(self.base_topic + "/$nodes", "fan,timer,filter,system", retain=True, timeout=60)
             await self.client.publish(self.base_topic + "/$implementation", "LevIoT Snek", retain=True, timeout=60)
 
             ## Fan speed node attributes
@@ -100,11 +111,29 @@ class MQTTController:
             await self.client.publish(prop + "/$datatype", "duration", retain=True, timeout=60)
             await self.client.publish(prop + "/$settable", "true", retain=True, timeout=60)
 
+            ## Filter node attributes
+            node = self.base_topic + "/filter"
+            await self.client.publish(node + "/$name", "Filter", retain=True, timeout=60)
+            await self.client.publish(node + "/$type", "Air purifier", retain=True, timeout=60)
+            await self.client.publish(node + "/$properties", "dusting-eta,replacement-eta", retain=True, timeout=60)
+
+            ### Dusting ETA property attributes
+            prop = node + "/dusting-eta"
+            await self.client.publish(prop + "/$name", "Dusting due", retain=True, timeout=60)
+            await self.client.publish(prop + "/$datatype", "datetime", retain=True, timeout=60)
+            await self.client.publish(prop + "/$settable", "false", retain=True, timeout=60)
+
+            ### Replacement ETA property attributes
+            prop = node + "/replacement-eta"
+            await self.client.publish(prop + "/$name", "Replacement due", retain=True, timeout=60)
+            await self.client.publish(prop + "/$datatype", "datetime", retain=True, timeout=60)
+            await self.client.publish(prop + "/$settable", "false", retain=True, timeout=60)
+
             ## System node attributes
             node = self.base_topic + "/system"
             await self.client.publish(node + "/$name", "System", retain=True, timeout=60)
             await self.client.publish(node + "/$type", "Air purifier", retain=True, timeout=60)
-            await self.client.publish(node + "/$properties", "log", retain=True, timeout=60)
+            await self.client.publish(node + "/$properties", "log,log-level,schedule,flash-endurance", retain=True, timeout=60)
 
             ### Log property attributes
             prop = node + "/log"
@@ -112,12 +141,40 @@ class MQTTController:
             await self.client.publish(prop + "/$datatype", "string", retain=True, timeout=60)
             await self.client.publish(prop + "/$settable", "false", retain=True, timeout=60)
 
+            ### Log level property attributes
+            prop = node + "/log-level"
+            await self.client.publish(prop + "/$name", "Log levels", retain=True, timeout=60)
+            await self.client.publish(prop + "/$datatype", "string", retain=True, timeout=60)
+            await self.client.publish(prop + "/$settable", "true", retain=True, timeout=60)
+
+            ### Schedule property attributes
+            prop = node + "/schedule"
+            await self.client.publish(prop + "/$name", "Weekly schedule", retain=True, timeout=60)
+            await self.client.publish(prop + "/$datatype", "string", retain=True, timeout=60)
+            await self.client.publish(prop + "/$settable", "true", retain=True, timeout=60)
+
+            ### Flash endurance property attributes
+            prop = node + "/flash-endurance"
+            await self.client.publish(prop + "/$name", "Projected flash endurance", retain=True, timeout=60)
+            await self.client.publish(prop + "/$datatype", "float", retain=True, timeout=60)
+            await self.client.publish(prop + "/$unit", "years", retain=True, timeout=60)
+            await self.client.publish(prop + "/$settable", "false", retain=True, timeout=60)
+
         await self.notify_power()
         await self.notify_speed()
         await self.notify_timer()
+        await self.notify_filter(force=True)
+        await self.notify_schedule()
+        await self.notify_log_level()
+        await self.notify_wear()
         await self.client.publish(self.state_topic, "ready", retain=True, timeout=60)
         log.i("MQTT ready")
 
+        if self.wear_timer is None:
+            self.wear_timer = timer_service.call_every(constants.WEAR_CHECKPOINT_INTERVAL_MS, self._update_wear)
+        if self.filter_timer is None:
+            self.filter_timer = timer_service.call_every(constants.MAINTENANCE_ETA_INTERVAL_MS, self._update_filter)
+
     async def _on_wlan_change(self, connected: bool):
         if connected and self.client.isconnected():
             await self.client.publish(self.state_topic, "ready", retain=True, timeout=60)
@@ -130,25 +187,43 @@ class MQTTController:
         if topic.endswith("/fan/power/set"):
             if payload not in (b"true", b"false"):
                 raise ValueError("Invalid MQTT payload for Homie bool: {}".format(payload))
-            await self.leviot.set_power(payload == b"true", cause="mqtt")
+            self.leviot.submit(Command.POWER, payload == b"true", cause="mqtt")
 
         elif topic.endswith("/fan/speed/set"):
             speed = int(payload)
             if not 0 <= speed <= 3:
                 raise ValueError("Invalid MQTT fan speed: {}".format(speed))
-            await self.leviot.set_fan_speed(speed, cause="mqtt")
+            self.leviot.submit(Command.SPEED, speed, cause="mqtt")
 
         elif topic.endswith("/timer/minutes/set"):
             mins = int(payload)
-            if mins < 0:
-                raise ValueError("Invalid MQTT negative timer minutes: {}".format(mins))
-            await self.leviot.set_timer(mins, cause="mqtt")
+            if not 0 <= mins <= BMASK_TIMER_LEFT:
+                raise ValueError("Invalid MQTT timer minutes: {}".format(mins))
+            self.leviot.submit(Command.TIMER, mins, cause="mqtt")
 
         elif topic.endswith("/timer/iso8601/set"):
             mins = iso8601.duration_to_number(payload.decode()) // 60
-            if mins < 0:
-                raise ValueError("Invalid MQTT negative timer time: {}".format((payload.decode())))
-            await self.leviot.set_timer(mins, cause="mqtt")
+            if not 0 <= mins <= BMASK_TIMER_LEFT:
+                raise ValueError("Invalid MQTT timer time: {}".format((payload.decode())))
+            self.leviot.submit(Command.TIMER, mins, cause="mqtt")
+
+        elif topic.endswith("/system/schedule/set"):
+            scheduler.load(payload.decode())
+            await self.notify_schedule()
+
+        elif topic.endswith("/system/log-level/set"):
+            ulog.set_levels(payload.decode())
+            await self.notify_log_level()
+
+    def _on_state_change(self, field: int, old, new, cause: str):
+        if field == Field.POWER:
+            self.loop.create_task(self.notify_power())
+            self.loop.create_task(self.notify_filter())
+        elif field == Field.SPEED:
+            self.loop.create_task(self.notify_speed())
+            self.loop.create_task(self.notify_filter())
+        elif field == Field.TIMER_LEFT:
+            self.loop.create_task(self.notify_timer())
 
     async def notify_power(self):
         await self.client.publish(self.base_topic + "/fan/power", str(state_tracker.power).lower(), retain=True,
@@ -163,8 +238,42 @@ class MQTTController:
             self.base_topic + "/timer/iso8601",
             iso8601.number_to_duration(state_tracker.timer_left * 60), retain=True, timeout=60)
 
-    async def log_async(self, message: str):
-        await self.client.publish(self.base_topic + "/system/log", message, retain=True, timeout=60)
+    async def _update_filter(self):
+        # Like _update_wear()
+        if self.client.isconnected():
+            await self.notify_filter()
+
+    async def notify_filter(self, force=False):
+        """
+        Publishes the filter maintenance ETAs, unless force is False and neither moved by MAINTENANCE_ETA_RESOLUTION_SEC
+        since they were last published
+        """
+        etas = (persistence.dusting_eta, persistence.replacement_eta)
+        if not force and self.filter_etas is not None:
+            for eta, prev in zip(etas, self.filter_etas):
+                if abs(eta - prev) >= constants.MAINTENANCE_ETA_RESOLUTION_SEC:
+                    break
+            else:
+                return
+        self.filter_etas = etas
+        for prop, eta in (("dusting-eta", etas[0]), ("replacement-eta", etas[1])):
+            await self.client.publish(self.base_topic + "/filter/" + prop,
+                                      iso8601.timestamp_to_datetime(eta) if eta >= 0 else "", retain=True, timeout=60)
+
+    async def notify_schedule(self):
+        await self.client.publish(self.base_topic + "/system/schedule", scheduler.rules, retain=True, timeout=60)
+
+    async def notify_log_level(self):
+        await self.client.publish(self.base_topic + "/system/log-level", ulog.levels(), retain=True, timeout=60)
+
+    async def _update_wear(self):
+        # Publishing while disconnected would wait for the connection to come back
+        if self.client.isconnected():
+            await self.notify_wear()
+
+    async def notify_wear(self):
+        await self.client.publish(self.base_topic + "/system/flash-endurance",
+                                  "{:.1f}".format(persistence.wear.endurance_years), retain=True, timeout=60)
 
-    def log(self, message: str):
-        self.loop.create_task(self.log_async(message))
\ No newline at end of file
+    async def log_async(self, message: str):
+        await self.client.publish(self.base_topic + "/system/log", message, retain=True, timeout=60)
\ No newline at end of file
@@ -1,11 +1,17 @@
 import network
+import ntptime
 import uasyncio
 import usys
+import utime
 
 import leviot_conf
 from leviot import conf as cfg, constants, ulog
 from leviot.extgpio import gpio
+from leviot.persistence import persistence
+from leviot.schedule import scheduler
 from leviot.state import state_tracker
+from leviot.timers import timer_service
+from leviot.utils import dnscache
 
 wlan = None
 
@@ -55,6 +61,9 @@ async def up() -> network.WLAN:
                     log.e(e)
                     pass
         log.i("Connected with IP " + wlan.ifconfig()[0])
+        # Names are only resolved here, right after connecting, or after failures: lookups block the event loop
+        sync_time()
+        ulog.link_up()
 
     elif cfg.wifi_mode == "ap":
         wlan.config(
@@ -71,18 +80,48 @@ async def up() -> network.WLAN:
     return wlan
 
 
-async def ensure_up():
+def sync_time():
+    if not cfg.ntp_host:
+        return
+    try:
+        # Through the shared DNS cache, so the name isn't resolved again on every reconnection. Like settime(), a
+        # lookup blocks the event loop until it completes or times out.
+        ntptime.host = dnscache.resolve(cfg.ntp_host, 123)[0]
+        before = utime.time()
+        ntptime.settime()
+        # Off by at most the NTP round trip, which is well under a second
+        persistence.clock_changed(utime.time() - before)
+        log.i("Clock set from {}", cfg.ntp_host)
+        scheduler.clock_changed()
+    except Exception as e:
+        log.e("Failed to set the clock from {}", cfg.ntp_host)
+        log.e(e)
+
+
+# Delay until the next link check. It doubles after every check finding the link up, so an idle device rarely wakes up
+# for it, and goes back to WIFI_CHECK_INTERVAL_MS after a reconnection.
+_check_interval_ms = constants.WIFI_CHECK_INTERVAL_MS
+
+
+async def _check_up():
+    global _check_interval_ms
     wlan = get_wlan()
+    if wlan.isconnected():
+        _check_interval_ms = min(_check_interval_ms * 2, constants.WIFI_CHECK_MAX_INTERVAL_MS)
+    else:
+        # Turn off Wi-Fi first
+        wlan.active(False)
+        await uasyncio.sleep(1)
 
-    if cfg.wifi_mode == "ap":
-        return
+        await up()
+        _check_interval_ms = constants.WIFI_CHECK_INTERVAL_MS
 
-    while True:
-        if not wlan.isconnected():
-            # Turn off Wi-Fi first
-            wlan.active(False)
-            await uasyncio.sleep(1)
+    # Only scheduled once the check is done, so a slow reconnection can't overlap with the next check
+    timer_service.call_later(_check_interval_ms, _check_up)
 
-            await up()
 
-        await uasyncio.sleep(1)
+async def ensure_up():
+    if cfg.wifi_mode == "ap":
+        return
+
+    await _check_up()
@@ -2,8 +2,13 @@ import esp32
 import usys
 from utime import time
 
-from leviot import ulog
-from leviot.state import state_tracker
+from leviot import conf, constants, ulog
+from leviot.history import UsageHistory
+from leviot.journal import Journal
+from leviot.staterecord import NVSKeyStore, StateRecordStore
+from leviot.state import state_tracker, Field
+from leviot.timers import timer_service
+from leviot.wearstats import WearStats
 
 log = ulog.Logger("persistence")
 
@@ -15,28 +20,24 @@ log = ulog.Logger("persistence")
 #
 # Considering that this only happens only when the air purifier is actually running and that when it is, a fan is
 # blowing (which effectively cools down the ESP32 chip and extends the flash lifetime, this could be even longer.
+#
+# If persistence_backend is "record", the values are stored together in a single CRC-protected record instead (see
+# leviot.staterecord), so they stay consistent across power losses. Every flush then writes 3 NVS entries instead of 2,
+# which is about 17.3 page erases per day instead of 11.5 at 12 hours of use per day.
+#
+# If persistence_backend is "journal", the same values are appended as small delta records to a dedicated flash
+# partition instead (see leviot.journal), which erases flash about 16 times less often than separate NVS keys.
+#
+# Runtime per fan speed is also kept as hourly history (see leviot.history), flushed along with these values.
 
 DEVICE_NAMESPACE = "LevIoT"
 
 ## Device lifetime in seconds
 DEVICE_LIFETIME = "Lifetime"
 
-## Setting bits
+## Setting bits, see the BIT_* layout in leviot.state
 DEVICE_SETTINGS = "Settings"
 
-BIT_SPEED = 0
-BIT_PREV_SPEED = 2
-BIT_POWER = 4
-BIT_LIGHTS = 5
-BIT_LOCK = 6
-BIT_USERMAINT = 7
-# Bits from 8 to 12 are reserved for later use
-# Timer is 16 bits, in minutes, ~45 days is more than enough
-BIT_TIMER_LEFT = 16
-
-BMASK_SPEED = 0b11
-BMASK_TIMER_LEFT = 0xffff
-
 # Unfortunately none of the values below are able to fit within 16 bits in meaningful ways,
 # so we have to use an entire 32 bit slot for each value.
 # We can therefore write the time in seconds, there's enough space for that.
@@ -65,10 +66,54 @@ DUST_TIMEOUT = 60 * 60 * 12 * 7 * 4
 # Every 6 months if used 12h per day at max speed
 REPLACE_TIMEOUT = 60 * 60 * 12 * 30 * 6
 
+# Days of usage history the maintenance ETAs are extrapolated from
+MAINTENANCE_ETA_DAYS = 7
+
+
+# Order of the stored values. The settings word must come first for the state record. In the journal, key ids are
+# their position: Lifetime and FilterRelLftime must stay next to each other, so their per-minute updates fit into a
+# single record.
+STORAGE_KEYS = (DEVICE_SETTINGS, DEVICE_LIFETIME, FILTER_RELATIVE_LIFETIME, FILTER_INSTALL_TIME, FILTER_LAST_DUST)
+
+
+def _open_storage(nvs):
+    if conf.persistence_backend == "record":
+        return StateRecordStore(nvs, STORAGE_KEYS)
+
+    keys = NVSKeyStore(nvs, STORAGE_KEYS)
+    if keys.empty:
+        # Values written by the "record" backend
+        record = StateRecordStore(nvs, STORAGE_KEYS)
+        keys.migrate(record)
+        if not keys.empty:
+            record.erase()
+    if conf.persistence_backend != "journal":
+        return keys
+
+    try:
+        partitions = esp32.Partition.find(esp32.Partition.TYPE_DATA, label=conf.journal_partition)
+        if not partitions:
+            raise OSError("Partition not found: {}".format(conf.journal_partition))
+        journal = Journal(partitions[0], STORAGE_KEYS)
+    except (OSError, ValueError) as e:
+        log.e("Cannot open the journal, falling back to NVS")
+        log.e(e)
+        return keys
+
+    journal.migrate(keys)
+    return journal
+
 
 class Persistence:
     def __init__(self):
-        self.nvs = esp32.NVS(DEVICE_NAMESPACE)
+        nvs = esp32.NVS(DEVICE_NAMESPACE)
+        self.storage = _open_storage(nvs)
+        self.wear = WearStats(STORAGE_KEYS, self.storage.erase_unit_bytes, self.storage.wear_sectors)
+        self.storage.stats = self.wear
+        self.history = UsageHistory(nvs)
+        if not isinstance(self.storage, Journal):
+            self.history.stats = self.wear
+        timer_service.call_every(constants.WEAR_CHECKPOINT_INTERVAL_MS, self.wear.checkpoint)
         self.last_update = time()
         self.last_dust = 0
         self.filter_install = 0
@@ -77,36 +122,38 @@ class Persistence:
         self._relative_filter_lifetime = 0
         self._last_persist_settings_time = time() - USER_ACTION_TIMEOUT_SEC
         self._last_not_presisted_settings = 0
+        # True while a settings change is waiting for the user to stop pressing buttons
+        self._settings_pending = False
+        self._track_timer = None
+        self.track_count = 0
+        # Absolute times when dusting and replacement are due, None if never while the device is off. They only
+        # change with the power and speed, or on maintenance, so they're recomputed lazily after those.
+        self._dust_deadline = None
+        self._replace_deadline = None
+        self._deadlines_valid = False
 
         loaded = 0
 
         try:
-            _settings = self.nvs.get_i32(DEVICE_SETTINGS)
-            state_tracker.power = (_settings >> BIT_POWER) & 1 == 1
-            state_tracker.speed = (_settings >> BIT_SPEED) & BMASK_SPEED
-            state_tracker.prev_speed = (_settings >> BIT_PREV_SPEED) & BMASK_SPEED
-            state_tracker.lights = (_settings >> BIT_LIGHTS) & 1 == 1
-            state_tracker.lock = (_settings >> BIT_LOCK) & 1 == 1
-            state_tracker.user_maint = (_settings >> BIT_USERMAINT) & 1 == 1
-            state_tracker.timer_left = (_settings >> BIT_TIMER_LEFT) & BMASK_TIMER_LEFT
+            state_tracker.bits = self.storage.get(DEVICE_SETTINGS)
             loaded += 1
         except OSError as e:
             log.e(e)
 
         try:
-            self._lifetime = self.nvs.get_i32(DEVICE_LIFETIME)
+            self._lifetime = self.storage.get(DEVICE_LIFETIME)
             loaded += 1
         except OSError as e:
             log.e(e)
 
         try:
-            self._relative_filter_lifetime = self.nvs.get_i32(FILTER_RELATIVE_LIFETIME)
+            self._relative_filter_lifetime = self.storage.get(FILTER_RELATIVE_LIFETIME)
             loaded += 1
         except OSError as e:
             log.e(e)
 
         try:
-            self.filter_install = self.nvs.get_i32(FILTER_INSTALL_TIME)
+            self.filter_install = self.storage.get(FILTER_INSTALL_TIME)
             loaded += 1
         except OSError as e:
             log.e(e)
@@ -118,8 +165,8 @@ class Persistence:
                 self._relative_filter_lifetime = self.lifetime
             if self.filter_install == 0:
                 self.filter_install = self.lifetime
-            self.nvs.set_i32(FILTER_INSTALL_TIME, self.filter_install)
-            self.nvs.set_i32(FILTER_LAST_DUST, self.last_dust)
+            self.storage.set(FILTER_INSTALL_TIME, self.filter_install)
+            self.storage.set(FILTER_LAST_DUST, self.last_dust)
             self._persist_settings()
             self._persist_lifetime()
             self._commit()
@@ -130,31 +177,27 @@ class Persistence:
             log.i("Restored missing values to defaults")
 
         self.stats()
+        state_tracker.subscribe(self._on_state_change)
 
     def stats(self):
+        if not log.enabled(ulog.INFO):
+            return
         log.i("Stats:")
-        log.i(" - Lifetime: {} seconds".format(self.lifetime))
-        log.i(" - Filter installated at {} seconds".format(self.filter_install))
-        log.i(" - Filter relative lifetime: {} (NOT seconds)".format(self.relative_filter_lifetime))
-        log.i(" - Last dust at {} rel lifetime".format(self.last_dust))
+        log.i(" - Lifetime: {} seconds", self.lifetime)
+        log.i(" - Filter installated at {} seconds", self.filter_install)
+        log.i(" - Filter relative lifetime: {} (NOT seconds)", self.relative_filter_lifetime)
+        log.i(" - Last dust at {} rel lifetime", self.last_dust)
         log.i("Settings:")
-        log.i(" - Power: {}".format(state_tracker.power and "on" or "off"))
-        log.i(" - Lights: {}".format(state_tracker.lights and "on" or "off"))
-        log.i(" - Lock: {}".format(state_tracker.lock and "on" or "off"))
-        log.i(" - Speed: {}".format(state_tracker.speed))
-        log.i(" - Prev speed: {}".format(state_tracker.prev_speed))
-        log.i(" - Timer left: {} minutes".format(state_tracker.timer_left))
-        log.i(" - User maintenance reminder: {}".format(state_tracker.user_maint))
+        log.i(" - Power: {}", state_tracker.power and "on" or "off")
+        log.i(" - Lights: {}", state_tracker.lights and "on" or "off")
+        log.i(" - Lock: {}", state_tracker.lock and "on" or "off")
+        log.i(" - Speed: {}", state_tracker.speed)
+        log.i(" - Prev speed: {}", state_tracker.prev_speed)
+        log.i(" - Timer left: {} minutes", state_tracker.timer_left)
+        log.i(" - User maintenance reminder: {}", state_tracker.user_maint)
 
     def _persist_settings(self) -> bool:
-        _settings = 0
-        _settings |= 1 << BIT_POWER if state_tracker.power else 0
-        _settings |= 1 << BIT_LIGHTS if state_tracker.lights else 0
-        _settings |= 1 << BIT_LOCK if state_tracker.lock else 0
-        _settings |= 1 << BIT_USERMAINT if state_tracker.user_maint else 0
-        _settings |= (state_tracker.speed & BMASK_SPEED) << BIT_SPEED
-        _settings |= (state_tracker.prev_speed & BMASK_SPEED) << BIT_PREV_SPEED
-        _settings |= ((state_tracker.timer_left & BMASK_TIMER_LEFT) << BIT_TIMER_LEFT) if state_tracker.timer_left else 0
+        _settings = state_tracker.bits
 
         if _settings != self._prev_settings:
             # Do not commit if user is having fun with buttons
@@ -162,26 +205,37 @@ class Persistence:
                 if _settings != self._last_not_presisted_settings:
                     self._last_persist_settings_time = time()
                 self._last_not_presisted_settings = _settings
+                self._settings_pending = True
                 return False
 
             self._last_persist_settings_time = time()
-            self.nvs.set_i32(DEVICE_SETTINGS, _settings)
+            self.storage.set(DEVICE_SETTINGS, _settings)
             self._prev_settings = _settings
+            self._settings_pending = False
             return True
+        self._settings_pending = False
         return False
 
     def _persist_lifetime(self):
         log.d("Persistence._persist_lifetime()")
+        self.history.add(self.last_update, time(), state_tracker.speed)
         self._lifetime += time() - self.last_update
         self._relative_filter_lifetime += self._time_to_rel_time(time() - self.last_update, state_tracker.speed)
         self.last_update = time()
 
-        self.nvs.set_i32(DEVICE_LIFETIME, self.lifetime)
-        self.nvs.set_i32(FILTER_RELATIVE_LIFETIME, self._lifetime)
+        self.storage.set(DEVICE_LIFETIME, self.lifetime)
+        self.storage.set(FILTER_RELATIVE_LIFETIME, self._lifetime)
 
     def _commit(self):
         log.d("Commit persistence storage")
-        self.nvs.commit()
+        history_written = self.history.flush(force=not state_tracker.power)
+        if self.storage.needs_commit():
+            self.storage.commit()
+            # NVS backends share the NVS handle of the history, so their commit covers both
+            if self.storage.nvs is self.history.nvs:
+                history_written = False
+        if history_written:
+            self.history.nvs.commit()
 
     @property
     def lifetime(self):
@@ -200,16 +254,73 @@ class Persistence:
     def _time_to_rel_time(time, speed):
         return int(time / (4 - speed))
 
+    def _deadline(self, threshold: int):
+        """
+        Time when the relative filter lifetime exceeds threshold, None if it never will at the current power and speed
+        """
+        remaining = threshold - self._relative_filter_lifetime
+        if not state_tracker.power:
+            return 0 if remaining < 0 else None
+        # relative_filter_lifetime truncates, so it's only above threshold once a whole unit past it
+        return self.last_update + (remaining + 1) * (4 - state_tracker.speed)
+
+    def _invalidate_deadlines(self):
+        self._deadlines_valid = False
+
+    def _update_deadlines(self):
+        self._dust_deadline = self._deadline(self.last_dust + DUST_TIMEOUT)
+        self._replace_deadline = self._deadline(REPLACE_TIMEOUT)
+        self._deadlines_valid = True
+
     @property
     def dusting_due(self) -> bool:
-        return self.relative_filter_lifetime - self.last_dust > DUST_TIMEOUT
+        if not self._deadlines_valid:
+            self._update_deadlines()
+        return self._dust_deadline is not None and time() >= self._dust_deadline
 
     @property
     def replacement_due(self) -> bool:
-        return self.relative_filter_lifetime > REPLACE_TIMEOUT
+        if not self._deadlines_valid:
+            self._update_deadlines()
+        return self._replace_deadline is not None and time() >= self._replace_deadline
+
+    def _eta(self, threshold: int) -> int:
+        """
+        Predicts when the relative filter lifetime exceeds threshold if the device keeps being used like in the last
+        MAINTENANCE_ETA_DAYS, -1 if there's not enough usage history to tell
+        """
+        now = time()
+        remaining = threshold - self.relative_filter_lifetime
+        if remaining < 0:
+            return now
+
+        totals, window = self.history.totals(MAINTENANCE_ETA_DAYS)
+        # Relative lifetime gained per second of wall clock time
+        rate = sum(totals[speed] / (4 - speed) for speed in range(len(totals))) / window if window > 0 else 0
+        if rate <= 0:
+            return -1
+        return now + int(remaining / rate)
+
+    @property
+    def dusting_eta(self) -> int:
+        return self._eta(self.last_dust + DUST_TIMEOUT)
+
+    @property
+    def replacement_eta(self) -> int:
+        return self._eta(REPLACE_TIMEOUT)
+
+    def clock_changed(self, delta: int):
+        """
+        Must be called right after the wall clock is set, with the seconds it moved, so the jump isn't counted as runtime
+        """
+        self.last_update += delta
+        self._last_persist_settings_time += delta
+        self._invalidate_deadlines()
 
     def notify_poweron(self):
         self.last_update = time()
+        self._invalidate_deadlines()
+        self.wake()
 
     def notify_maintenance(self):
         self.stats()
@@ -219,22 +330,61 @@ class Persistence:
             self._persist_lifetime()
             self.last_dust = 0
             self.filter_install = self.lifetime
-            self.nvs.set_i32(FILTER_INSTALL_TIME, self.filter_install)
-            self.nvs.set_i32(FILTER_LAST_DUST, self.last_dust)
+            self.storage.set(FILTER_INSTALL_TIME, self.filter_install)
+            self.storage.set(FILTER_LAST_DUST, self.last_dust)
             self._relative_filter_lifetime = 0
             self._persist_lifetime()
         else:
             self.last_dust = self.relative_filter_lifetime
 
+        self._invalidate_deadlines()
         self._commit()
 
     def notify_poweroff(self):
         self._persist_settings()
         self._persist_lifetime()
         self._commit()
+        self._schedule_next()
+
+    def wake(self):
+        """
+        Tracks the state as soon as possible
+        """
+        self._schedule(0)
+
+    def _on_state_change(self, field: int, old, new, cause: str):
+        if field == Field.POWER or field == Field.SPEED:
+            self._invalidate_deadlines()
+        self.wake()
+
+    def _schedule(self, delay_ms: int):
+        if self._track_timer is not None:
+            self._track_timer.cancel()
+        self._track_timer = timer_service.call_later(delay_ms, self.track)
+
+    def _schedule_next(self):
+        """
+        Sleep until the next lifetime update or the end of the settings debounce time, whichever comes first. Nothing
+        is scheduled if the device is off and no settings are waiting to be persisted.
+        """
+        now = time()
+        delays = []
+        if self._settings_pending:
+            delays.append(self._last_persist_settings_time + USER_ACTION_TIMEOUT_SEC - now)
+        if state_tracker.power:
+            delays.append(self.last_update + LIFETIME_UPDATE_INTERVAL_SEC - now)
+
+        if not delays:
+            if self._track_timer is not None:
+                self._track_timer.cancel()
+                self._track_timer = None
+            return
+        self._schedule(max(min(delays), 1) * 1000)
 
     # This is async so it can be scheduled in the asyncio event loop
     async def track(self):
+        self._track_timer = None
+        self.track_count += 1
         changed = self._persist_settings()
         if state_tracker.power:
             delta = time() - self.last_update
@@ -244,6 +394,7 @@ class Persistence:
         if changed:
             self.stats()
             self._commit()
+        self._schedule_next()
 
 
 persistence = Persistence()
@@ -0,0 +1,232 @@
+from array import array
+
+import utime
+from micropython import const
+
+from leviot import conf, ulog
+from leviot.timers import timer_service
+
+log = ulog.Logger("schedule")
+
+# Weekly schedules are written as rules separated by commas, semicolons or newlines. Each rule looks like
+#
+#   DAYS@HH:MM=ACTION
+#
+# DAYS is "*", a day ("mon" ... "sun"), a range ("mon-fri", "fri-mon") or several of those joined by "+" ("sat+sun").
+# ACTION is "on", "off" or a fan speed from 0 (night mode) to 3. For instance:
+#
+#   mon-fri@08:30=on,mon-fri@08:30=3,*@23:00=0,*@01:00=off
+#
+# Rules are compiled into a table of transitions sorted by minute of the week. Rules falling on the same minute are
+# merged into one transition, later rules overriding earlier ones.
+
+SCHEDULE_FILE = "schedule.txt"
+
+# Upper bound on the compiled table, to keep uploaded schedules from eating the heap
+MAX_TRANSITIONS = const(256)
+# Never sleep longer than this before checking the clock again, so NTP adjustments are picked up and ticks_ms deadlines
+# stay well within their range
+MAX_SLEEP_SEC = const(60 * 60)
+
+MINUTES_PER_DAY = const(24 * 60)
+MINUTES_PER_WEEK = const(7 * 24 * 60)
+
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+# Transition action bits
+ACTION_SPEED_MASK = const(0b11)
+ACTION_SET_SPEED = const(1 << 2)
+ACTION_SET_POWER = const(1 << 3)
+ACTION_POWER_ON = const(1 << 4)
+
+
+def _parse_days(days: str) -> list:
+    if days == "*":
+        return list(range(7))
+
+    result = []
+    for part in days.split("+"):
+        if "-" in part:
+            first, last = part.split("-", 1)
+            first, last = DAYS.index(first), DAYS.index(last)
+            if first <= last:
+                result.extend(range(first, last + 1))
+            else:
+                result.extend(range(first, 7))
+                result.extend(range(0, last + 1))
+        else:
+            result.append(DAYS.index(part))
+    return result
+
+
+def _parse_action(action: str) -> int:
+    if action == "on":
+        return ACTION_SET_POWER | ACTION_POWER_ON
+    if action == "off":
+        return ACTION_SET_POWER
+    speed = int(action)
+    if not 0 <= speed <= 3:
+        raise ValueError("Fan speed must be within 0 and 3")
+    return ACTION_SET_SPEED | speed
+
+
+def _merge(old: int, new: int) -> int:
+    if new & ACTION_SET_POWER:
+        old = (old & ~(ACTION_SET_POWER | ACTION_POWER_ON)) | (new & (ACTION_SET_POWER | ACTION_POWER_ON))
+    if new & ACTION_SET_SPEED:
+        old = (old & ~(ACTION_SET_SPEED | ACTION_SPEED_MASK)) | (new & (ACTION_SET_SPEED | ACTION_SPEED_MASK))
+    return old
+
+
+def split_rules(text: str) -> list:
+    return [rule.strip() for rule in text.replace(";", ",").replace("\n", ",").split(",") if rule.strip()]
+
+
+def compile_rules(text: str) -> tuple:
+    """
+    Compiles a schedule into (minutes, actions) arrays, sorted by minute of the week. Raises ValueError if the schedule
+    is invalid.
+    """
+    table = {}
+    for rule in split_rules(text):
+        try:
+            days, rest = rule.lower().split("@", 1)
+            clock, action = rest.split("=", 1)
+            hour, minute = clock.split(":", 1)
+            hour, minute = int(hour), int(minute)
+            if not (0 <= hour < 24 and 0 <= minute < 60):
+                raise ValueError()
+            action = _parse_action(action.strip())
+            days = _parse_days(days.strip())
+        except ValueError:
+            raise ValueError("Invalid schedule rule: {}".format(rule))
+
+        for day in days:
+            key = day * MINUTES_PER_DAY + hour * 60 + minute
+            table[key] = _merge(table.get(key, 0), action)
+
+    if len(table) > MAX_TRANSITIONS:
+        raise ValueError("Too many schedule transitions: {} > {}".format(len(table), MAX_TRANSITIONS))
+
+    keys = sorted(table)
+    return array("H", keys), array("B", (table[key] for key in keys))
+
+
+def decode_action(action: int) -> tuple:
+    """
+    Returns the (power, speed) set by a transition action, either being None if it's left unchanged
+    """
+    power = (action & ACTION_POWER_ON != 0) if action & ACTION_SET_POWER else None
+    speed = (action & ACTION_SPEED_MASK) if action & ACTION_SET_SPEED else None
+    return power, speed
+
+
+def minute_of_week(now: int) -> tuple:
+    """
+    Returns the (minute of the week, second) of a utime.time() timestamp, in local time
+    """
+    t = utime.localtime(now + conf.schedule_utc_offset_min * 60)
+    return t[6] * MINUTES_PER_DAY + t[3] * 60 + t[4], t[5]
+
+
+class Scheduler:
+    """
+    Applies a weekly schedule. Instead of checking the rules every minute, it looks up the next transition in the
+    compiled table and sleeps on the timer service until it's due.
+    """
+
+    def __init__(self):
+        self.rules = ""
+        self.minutes = array("H")
+        self.actions = array("B")
+        self.callback = None
+        self.timer = None
+        self.transitions_applied = 0
+        # Rules are only evaluated once the clock has been set, it starts from the epoch on boot
+        self.clock_set = False
+
+    def load(self, text: str, save: bool = True):
+        """
+        Replaces the schedule. Raises ValueError and keeps the current one if text is invalid.
+        """
+        self.minutes, self.actions = compile_rules(text)
+        self.rules = ",".join(split_rules(text))
+        log.i("Loaded schedule with {} transitions", len(self.minutes))
+
+        if save:
+            with open(SCHEDULE_FILE, "w") as f:
+                f.write(self.rules)
+        self._arm()
+
+    def load_saved(self):
+        try:
+            with open(SCHEDULE_FILE) as f:
+                text = f.read()
+        except OSError:
+            return
+        try:
+            self.load(text, save=False)
+        except ValueError as e:
+            log.e(e)
+
+    def start(self, callback):
+        """
+        Starts applying the schedule. callback(power, speed) is called on each transition, see decode_action().
+        """
+        self.callback = callback
+        self._arm()
+
+    def clock_changed(self):
+        """
+        Must be called when the wall clock is set, to look up the next transition again
+        """
+        self.clock_set = True
+        self._arm()
+
+    def next_index(self, minute: int) -> int:
+        """
+        Binary searches the first transition strictly after the given minute of the week, wrapping around at the end
+        """
+        minutes = self.minutes
+        lo, hi = 0, len(minutes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if minutes[mid] <= minute:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(minutes) else 0
+
+    def next_transition(self, now: int) -> tuple:
+        """
+        Returns (seconds until the next transition, its index) for a utime.time() timestamp
+        """
+        minute, second = minute_of_week(now)
+        index = self.next_index(minute)
+        until = (self.minutes[index] - minute) % MINUTES_PER_WEEK or MINUTES_PER_WEEK
+        return until * 60 - second, index
+
+    def _arm(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.callback is None or not self.minutes or not self.clock_set:
+            return
+
+        delay, index = self.next_transition(utime.time())
+        if delay > MAX_SLEEP_SEC:
+            self.timer = timer_service.call_later(MAX_SLEEP_SEC * 1000, self._arm)
+        else:
+            self.timer = timer_service.call_later(delay * 1000, self._fire, index)
+
+    def _fire(self, index: int):
+        self.timer = None
+        self.transitions_applied += 1
+        try:
+            self.callback(*decode_action(self.actions[index]))
+        finally:
+            self._arm()
+
+
+scheduler = Scheduler()
+scheduler.load_saved()
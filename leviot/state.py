@@ -1,3 +1,5 @@
+from micropython import const
+
 from leviot import ulog
 
 import usys
@@ -5,23 +7,114 @@ import usys
 log = ulog.Logger("state")
 
 
+class Command:
+    """
+    Kinds of state change commands that can be submitted to LevIoT
+    """
+    POWER = const(0)
+    SPEED = const(1)
+    TIMER = const(2)
+    LIGHTS = const(3)
+    LOCK = const(4)
+
+
+# Packed state layout, also used as-is by the persistence settings word
+BIT_SPEED = const(0)
+BIT_PREV_SPEED = const(2)
+BIT_POWER = const(4)
+BIT_LIGHTS = const(5)
+BIT_LOCK = const(6)
+BIT_USERMAINT = const(7)
+# Bits from 8 to 12 are reserved for later use
+# Timer is 16 bits, in minutes, ~45 days is more than enough
+BIT_TIMER_LEFT = const(16)
+
+BMASK_SPEED = const(0b11)
+BMASK_TIMER_LEFT = const(0xffff)
+
+
+class Field:
+    """
+    StateTracker fields, as reported to change subscribers
+    """
+    POWER = const(0)
+    LOCK = const(1)
+    SPEED = const(2)
+    PREV_SPEED = const(3)
+    LIGHTS = const(4)
+    USER_MAINT = const(5)
+    TIMER_LEFT = const(6)
+
+
+# (shift, mask, is boolean) of each field, indexed by Field
+_LAYOUT = (
+    (BIT_POWER, 1, True),
+    (BIT_LOCK, 1, True),
+    (BIT_SPEED, BMASK_SPEED, False),
+    (BIT_PREV_SPEED, BMASK_SPEED, False),
+    (BIT_LIGHTS, 1, True),
+    (BIT_USERMAINT, 1, True),
+    (BIT_TIMER_LEFT, BMASK_TIMER_LEFT, False),
+)
+
+# Lights on, speed and previous speed 1
+_DEFAULT_BITS = (1 << BIT_LIGHTS) | (1 << BIT_SPEED) | (1 << BIT_PREV_SPEED)
+
+
+def _field(field: int):
+    shift, mask, is_bool = _LAYOUT[field]
+
+    if is_bool:
+        def getter(self):
+            return (self.bits >> shift) & 1 == 1
+    else:
+        def getter(self):
+            return (self.bits >> shift) & mask
+
+    def setter(self, value):
+        self.set(field, value)
+
+    return property(getter, setter)
+
+
 class StateTracker:
-    def __init__(self):
-        self.power = False
-        self.lock = False
-        self.speed = 1
-        self.prev_speed = 1
-        self.lights = True
-        self.user_maint = False
-        self._timer_left = 0
-
-    @property
-    def timer_left(self):
-        return self._timer_left > 0 and self._timer_left or 0
-
-    @timer_left.setter
-    def timer_left(self, value):
-        if value < 0:
+    """
+    Holds the device state, packed into a single int with the BIT_* layout. Writes that actually change a field are
+    reported to the subscribers as callback(field, old, new, cause), so consumers can react to changes instead of
+    polling.
+
+    Fields can be assigned like attributes; use set() to also report the cause of the change. Values that don't fit
+    their field raise ValueError.
+    """
+    __slots__ = ("bits", "_subscribers")
+
+    def __init__(self, bits: int = _DEFAULT_BITS):
+        self.bits = bits
+        self._subscribers = []
+
+    power = _field(Field.POWER)
+    lock = _field(Field.LOCK)
+    speed = _field(Field.SPEED)
+    prev_speed = _field(Field.PREV_SPEED)
+    lights = _field(Field.LIGHTS)
+    user_maint = _field(Field.USER_MAINT)
+    timer_left = _field(Field.TIMER_LEFT)
+
+    def snapshot(self) -> "StateTracker":
+        """
+        Returns a copy of the current state, without subscribers
+        """
+        return StateTracker(self.bits)
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def set(self, field: int, value, cause="unknown"):
+        if field == Field.TIMER_LEFT and value < 0:
             try:
                 # Trick to print stack trace
                 raise ValueError()
@@ -29,7 +122,27 @@ class StateTracker:
                 log.e("Provided value for timer_left is < 0, which is invalid!")
                 log.e(e)
             value = 0
-        self._timer_left = value
+
+        shift, mask, is_bool = _LAYOUT[field]
+        new = int(value)
+        if not is_bool and not 0 <= new <= mask:
+            # Masking would silently store another value
+            raise ValueError("Value {} does not fit field {}".format(value, field))
+        new &= mask
+        bits = self.bits
+        old = (bits >> shift) & mask
+        if old == new:
+            return
+        self.bits = (bits & ~(mask << shift)) | (new << shift)
+
+        if is_bool:
+            old = old == 1
+            new = new == 1
+        for callback in self._subscribers:
+            try:
+                callback(field, old, new, cause)
+            except Exception as e:
+                log.e(e)
 
 
 state_tracker = StateTracker()
@@ -0,0 +1,282 @@
+import esp32
+import ubinascii
+import ustruct
+from micropython import const
+
+from leviot import ulog
+
+log = ulog.Logger("staterecord")
+
+# NVS storage backends for the values of Persistence.
+#
+# NVSKeyStore keeps each value in its own i32 key. It's the default: the per-minute flush only changes the two lifetime
+# counters, which takes two NVS entries.
+#
+# StateRecordStore keeps all of them in a single versioned binary record, written alternately to two NVS blob keys.
+# Each flush is a single blob write, so a power loss can't leave values from different flushes mixed together: at worst
+# the slot being written is corrupted and the other one, one flush older, is used. A blob write takes three NVS entries
+# though, so it wears the flash 1.5 times faster: upy_test_stubs/journal_sim.py measures 17.3 page erases per day
+# against 11.5 for separate keys, at 12 hours of use per day.
+#
+# Layout (little endian, 30 bytes with the CRC so NVS stores it in a single 32 byte data entry):
+#   version (B), sequence number (B)
+#   settings word (I)
+#   four 40 bit counters, each as low 32 bits (I) then high 8 bits (B)
+#   CRC-32 of all the previous bytes (I)
+#
+# Like the journal, both have get(), set(), needs_commit() and commit(). nvs is the NVS handle their commit() commits,
+# which also covers anything else written through it since the last commit.
+
+RECORD_VERSION = const(1)
+SLOT_KEYS = ("StateA", "StateB")
+
+# A blob write takes three NVS entries: blob index, data header and data
+NVS_ENTRY_SIZE = const(32)
+NVS_ENTRIES_PER_RECORD = const(3)
+NVS_ENTRIES_PER_PAGE = const(126)
+# nvs partition of the default MicroPython partition table (0x6000), used if the actual one can't be found
+NVS_PAGES = const(6)
+
+
+def nvs_pages() -> int:
+    """
+    Returns the number of pages NVS spreads writes across: all of them except the one kept free for compaction
+    """
+    try:
+        return esp32.Partition.find(esp32.Partition.TYPE_DATA, label="nvs")[0].ioctl(4, 0) - 1
+    except (IndexError, OSError, AttributeError):
+        return NVS_PAGES - 1
+
+
+class NVSKeyStore:
+    """
+    Stores the values of Persistence in one i32 NVS key each. Only the values changed since the last commit are written.
+    Values are unsigned 32 bit, stored as the i32 with the same bits.
+    """
+
+    def __init__(self, nvs, keys: tuple):
+        self.nvs = nvs
+        self.keys = keys
+        self.values = [None] * len(keys)
+        # Bit mask of the values changed since the last commit
+        self.dirty = 0
+        self.writes = 0
+
+        # Optional WearStats
+        self.stats = None
+        self.erase_unit_bytes = NVS_ENTRY_SIZE * NVS_ENTRIES_PER_PAGE
+        self.wear_sectors = nvs_pages()
+
+        for i in range(len(keys)):
+            try:
+                self.values[i] = nvs.get_i32(keys[i]) & 0xffffffff
+            except OSError:
+                pass
+
+    @property
+    def empty(self) -> bool:
+        return all(value is None for value in self.values)
+
+    def get(self, key: str) -> int:
+        value = self.values[self.keys.index(key)]
+        if value is None:
+            raise OSError("NVS key not found: {}".format(key))
+        return value
+
+    def set(self, key: str, value: int):
+        i = self.keys.index(key)
+        if self.values[i] != value:
+            self.values[i] = value
+            self.dirty |= 1 << i
+
+    def needs_commit(self) -> bool:
+        return self.dirty != 0
+
+    def commit(self):
+        if not self.dirty:
+            return
+
+        for i in range(len(self.keys)):
+            if self.dirty & (1 << i):
+                value = self.values[i] & 0xffffffff
+                self.nvs.set_i32(self.keys[i], value - 0x100000000 if value & 0x80000000 else value)
+                if self.stats is not None:
+                    self.stats.wrote(i, NVS_ENTRY_SIZE)
+        self.nvs.commit()
+
+        if self.stats is not None:
+            self.stats.committed()
+        self.dirty = 0
+        self.writes += 1
+
+    def migrate(self, storage):
+        """
+        Seeds an empty store with the values held by another storage backend
+        """
+        if not self.empty:
+            return
+        found = 0
+        for key in self.keys:
+            try:
+                self.set(key, storage.get(key))
+                found += 1
+            except OSError:
+                pass
+        if found:
+            self.commit()
+            log.i("Migrated {} values to NVS keys", found)
+
+
+_RECORD = "<BBI" + "IB" * 4
+_RECORD_SIZE = const(26)
+_COUNTERS = const(4)
+
+
+def _newer(seq_a: int, seq_b: int) -> bool:
+    # Sequence numbers wrap around at 256, the two slots are always one apart
+    return (seq_a - seq_b) & 0xff < 0x80
+
+
+class StateRecordStore:
+    """
+    Stores the values of Persistence in an A/B pair of NVS blobs. keys are the names of the stored values: the first one
+    is the settings word, the others are counters.
+    """
+
+    def __init__(self, nvs, keys: tuple):
+        if len(keys) != _COUNTERS + 1:
+            raise ValueError("StateRecordStore needs the settings word and {} counters".format(_COUNTERS))
+        self.nvs = nvs
+        self.keys = keys
+        self.values = [None] * len(keys)
+        self.seq = 0
+        self.slot = 0
+        # Bit mask of the values changed since the last commit
+        self.dirty = 0
+        # i32 keys to erase once their values are safely stored in a record
+        self.migrated = []
+        self.writes = 0
+
+        # Optional WearStats
+        self.stats = None
+        self.erase_unit_bytes = NVS_ENTRY_SIZE * NVS_ENTRIES_PER_PAGE
+        self.wear_sectors = nvs_pages()
+
+        self._load()
+
+    def _read_slot(self, slot: int):
+        buf = bytearray(_RECORD_SIZE + 4)
+        try:
+            size = self.nvs.get_blob(SLOT_KEYS[slot], buf)
+        except OSError:
+            return None
+        if size != _RECORD_SIZE + 4:
+            log.w("State record {} has the wrong size: {}", SLOT_KEYS[slot], size)
+            return None
+        if ubinascii.crc32(buf[:_RECORD_SIZE]) != ustruct.unpack_from("<I", buf, _RECORD_SIZE)[0]:
+            log.w("State record {} is corrupted", SLOT_KEYS[slot])
+            return None
+        fields = ustruct.unpack_from(_RECORD, buf)
+        if fields[0] != RECORD_VERSION:
+            log.w("State record {} has unknown version {}", SLOT_KEYS[slot], fields[0])
+            return None
+        return fields
+
+    def _load(self):
+        records = [self._read_slot(0), self._read_slot(1)]
+        if records[0] is None and records[1] is None:
+            self._migrate()
+            return
+
+        if records[1] is None or (records[0] is not None and _newer(records[0][1], records[1][1])):
+            self.slot = 0
+        else:
+            self.slot = 1
+        fields = records[self.slot]
+        self.seq = fields[1]
+        self.values[0] = fields[2]
+        for i in range(_COUNTERS):
+            self.values[i + 1] = fields[3 + 2 * i] | (fields[4 + 2 * i] << 32)
+
+    def _migrate(self):
+        for i in range(len(self.keys)):
+            try:
+                self.values[i] = self.nvs.get_i32(self.keys[i]) & 0xffffffff
+                self.migrated.append(self.keys[i])
+                self.dirty |= 1 << i
+            except OSError:
+                pass
+        if self.migrated:
+            log.i("Migrating {} values from NVS keys to the state record", len(self.migrated))
+
+    def erase(self):
+        """
+        Erases both slots, once their values have been migrated to another backend
+        """
+        for key in SLOT_KEYS:
+            try:
+                self.nvs.erase_key(key)
+            except OSError:
+                pass
+        self.nvs.commit()
+
+    def get(self, key: str) -> int:
+        value = self.values[self.keys.index(key)]
+        if value is None:
+            raise OSError("State record key not found: {}".format(key))
+        return value
+
+    def set(self, key: str, value: int):
+        i = self.keys.index(key)
+        if self.values[i] != value:
+            self.values[i] = value
+            self.dirty |= 1 << i
+
+    def needs_commit(self) -> bool:
+        return self.dirty != 0
+
+    def commit(self):
+        if not self.dirty:
+            return
+
+        seq = (self.seq + 1) & 0xff
+        slot = self.slot ^ 1
+        fields = [RECORD_VERSION, seq, (self.values[0] or 0) & 0xffffffff]
+        for value in self.values[1:]:
+            value = value or 0
+            fields.append(value & 0xffffffff)
+            fields.append((value >> 32) & 0xff)
+
+        buf = bytearray(_RECORD_SIZE + 4)
+        ustruct.pack_into(_RECORD, buf, 0, *fields)
+        ustruct.pack_into("<I", buf, _RECORD_SIZE, ubinascii.crc32(buf[:_RECORD_SIZE]))
+        self.nvs.set_blob(SLOT_KEYS[slot], buf)
+        self.nvs.commit()
+
+        if self.stats is not None:
+            self._report(self.stats)
+
+        self.seq = seq
+        self.slot = slot
+        self.dirty = 0
+        self.writes += 1
+
+        if self.migrated:
+            for key in self.migrated:
+                try:
+                    self.nvs.erase_key(key)
+                except OSError:
+                    pass
+            self.nvs.commit()
+            self.migrated = []
+
+    def _report(self, stats):
+        """
+        Splits the flash bytes of a record write among the values that changed
+        """
+        nbytes = NVS_ENTRY_SIZE * NVS_ENTRIES_PER_RECORD
+        changed = [i for i in range(len(self.keys)) if self.dirty & (1 << i)]
+        for i in changed:
+            stats.wrote(i, nbytes // len(changed))
+        stats.wrote(None, nbytes % len(changed))
+        stats.committed()
@@ -0,0 +1,94 @@
+import uasyncio
+import utime
+
+from leviot import ulog
+
+log = ulog.Logger("timers")
+
+
+class Timer:
+    def __init__(self, service: "TimerService", deadline: int, period: int, callback, args: tuple):
+        self.service = service
+        self.deadline = deadline
+        self.period = period
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        self.service.cancel(self)
+
+
+class TimerService:
+    """
+    Runs callbacks at ticks_ms deadlines from a single task, instead of having every delayed or periodic job sleep in
+    its own loop. Callbacks may be plain functions or coroutine functions; coroutines are run in a new task.
+
+    Timers are kept in a list sorted by deadline. There are only a handful of them, so this is cheaper than a bucketed
+    wheel and the task only wakes up when the earliest deadline is due.
+    """
+
+    def __init__(self):
+        self.timers = []
+        self.wake = uasyncio.Event()
+        # Times the task slept until a deadline, the wakeups it causes by itself
+        self.wakeups = 0
+        self.fired = 0
+
+    def call_at(self, deadline: int, callback, *args) -> Timer:
+        return self._insert(Timer(self, deadline, 0, callback, args))
+
+    def call_later(self, delay_ms: int, callback, *args) -> Timer:
+        return self.call_at(utime.ticks_add(utime.ticks_ms(), delay_ms), callback, *args)
+
+    def call_every(self, period_ms: int, callback, *args) -> Timer:
+        """
+        Calls callback every period_ms. Each deadline is computed from the previous one, so it never drifts.
+        """
+        timer = Timer(self, utime.ticks_add(utime.ticks_ms(), period_ms), period_ms, callback, args)
+        return self._insert(timer)
+
+    def cancel(self, timer: Timer):
+        if timer in self.timers:
+            self.timers.remove(timer)
+
+    def _insert(self, timer: Timer) -> Timer:
+        i = 0
+        while i < len(self.timers) and utime.ticks_diff(self.timers[i].deadline, timer.deadline) <= 0:
+            i += 1
+        self.timers.insert(i, timer)
+        if i == 0:
+            # The earliest deadline changed
+            self.wake.set()
+        return timer
+
+    def _fire(self, timer: Timer):
+        self.fired += 1
+        if timer.period:
+            timer.deadline = utime.ticks_add(timer.deadline, timer.period)
+            self._insert(timer)
+        try:
+            result = timer.callback(*timer.args)
+            if hasattr(result, "send"):
+                uasyncio.get_event_loop().create_task(result)
+        except Exception as e:
+            log.e(e)
+
+    async def run(self):
+        while True:
+            self.wake.clear()
+            if not self.timers:
+                await self.wake.wait()
+                continue
+
+            delay = utime.ticks_diff(self.timers[0].deadline, utime.ticks_ms())
+            if delay > 0:
+                try:
+                    await uasyncio.wait_for(self.wake.wait(), delay / 1000)
+                except uasyncio.TimeoutError:
+                    self.wakeups += 1
+                continue
+
+            self._fire(self.timers.pop(0))
+
+
+timer_service = TimerService()
@@ -0,0 +1,124 @@
+import esp32
+import utime
+
+from leviot import ulog
+
+log = ulog.Logger("touchcal")
+
+# Per-unit touchpad sensitivities, measured by TouchCalibrator. They replace the ones in leviot_conf once stored.
+
+CALIBRATION_NAMESPACE = "LevIoTTouch"
+
+## Set to 1 once a calibration has completed, so it doesn't run again at boot
+CALIBRATION_DONE = "CalDone"
+
+## Prefix of the keys holding each pad's sensitivity, in parts per million
+SENSITIVITY_PREFIX = "Sens"
+
+# Polls used to measure the noise floor. The panel must not be touched meanwhile.
+NOISE_SAMPLES = 100
+# Touched samples needed to estimate a pad's touch delta
+TOUCH_SAMPLES = 20
+# A sample is considered touched if it is this many standard deviations below the untouched mean
+TOUCH_GATE_SIGMA = 8
+# Reject a sensitivity if its noise threshold would be closer than this many standard deviations to the noise
+MIN_NOISE_MARGIN_SIGMA = 3
+# Give up on pads that haven't been touched after this long
+CALIBRATION_TIMEOUT_MS = 60 * 1000
+
+nvs = esp32.NVS(CALIBRATION_NAMESPACE)
+
+
+def load_sensitivity(name: str, default: float) -> float:
+    try:
+        return nvs.get_i32(SENSITIVITY_PREFIX + name) / 1000000
+    except OSError:
+        return default
+
+
+def is_calibrated() -> bool:
+    try:
+        return nvs.get_i32(CALIBRATION_DONE) == 1
+    except OSError:
+        return False
+
+
+class TouchCalibrator:
+    """
+    Measures each pad's noise floor and touch delta from the raw readings of every poll, keeping only running
+    statistics. First the untouched mean and standard deviation are measured, then the user touches each pad in turn.
+    """
+
+    def __init__(self, names: list, noise_margin: float):
+        """
+        noise_margin is the ratio between a pad's noise threshold and its sensitivity.
+        """
+        self.names = names
+        self.noise_margin = noise_margin
+        self.start_ms = utime.ticks_ms()
+        self.samples = 0
+        # Welford's running mean and sum of squared differences of untouched readings
+        self.mean = [0.0] * len(names)
+        self.m2 = [0.0] * len(names)
+        self.gate = [0.0] * len(names)
+        # Running count and sum of touched readings' relative drop
+        self.touch_count = [0] * len(names)
+        self.touch_sum = [0.0] * len(names)
+
+    def std(self, i: int) -> float:
+        return (self.m2[i] / (self.samples - 1)) ** 0.5 if self.samples > 1 else 0
+
+    def feed(self, readings: list) -> bool:
+        """
+        Feeds one raw reading per pad. Returns True once the calibration is complete.
+        """
+        if self.samples < NOISE_SAMPLES:
+            self.samples += 1
+            for i in range(len(readings)):
+                delta = readings[i] - self.mean[i]
+                self.mean[i] += delta / self.samples
+                self.m2[i] += delta * (readings[i] - self.mean[i])
+
+            if self.samples == NOISE_SAMPLES:
+                for i in range(len(readings)):
+                    self.gate[i] = TOUCH_GATE_SIGMA * max(self.std(i), 1)
+                log.i("Noise floor measured, now touch and hold each pad for a moment")
+            return False
+
+        done = True
+        for i in range(len(readings)):
+            drop = self.mean[i] - readings[i]
+            if drop > self.gate[i]:
+                self.touch_count[i] += 1
+                self.touch_sum[i] += drop / self.mean[i]
+            if self.touch_count[i] < TOUCH_SAMPLES:
+                done = False
+
+        return done or utime.ticks_diff(utime.ticks_ms(), self.start_ms) >= CALIBRATION_TIMEOUT_MS
+
+    def finish(self) -> dict:
+        """
+        Stores the sensitivities of the pads that could be calibrated and returns them
+        """
+        result = {}
+        for i in range(len(self.names)):
+            name = self.names[i]
+            if self.touch_count[i] < TOUCH_SAMPLES:
+                log.w("Pad {} was not touched, keeping its current sensitivity", name)
+                continue
+
+            sensitivity = self.touch_sum[i] / self.touch_count[i]
+            noise_rate = self.std(i) / self.mean[i]
+            if sensitivity * self.noise_margin < MIN_NOISE_MARGIN_SIGMA * noise_rate:
+                log.w("Pad {} is too noisy (sensitivity {}, noise {}), keeping its current sensitivity",
+                      name, sensitivity, noise_rate)
+                continue
+
+            log.i("Pad {}: sensitivity {}, noise {}", name, sensitivity, noise_rate)
+            nvs.set_i32(SENSITIVITY_PREFIX + name, int(sensitivity * 1000000))
+            result[name] = sensitivity
+
+        nvs.set_i32(CALIBRATION_DONE, 1)
+        nvs.commit()
+        log.i("Touch calibration complete, new sensitivities are used from the next boot")
+        return result
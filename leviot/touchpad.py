@@ -2,11 +2,19 @@ import esp32
 import micropython
 import uasyncio
 import utime
+from array import array
 from machine import Pin, TouchPad
 from micropython import const
 import usys
 
-from leviot import ulog, constants, conf
+from leviot import ulog, constants, conf, touchcal
+from leviot.state import state_tracker
+from leviot.touchtrace import TraceWriter, TracingTouchPad
+
+try:
+    from math import nextafter
+except ImportError:
+    nextafter = None
 
 log = ulog.Logger("touchpad")
 
@@ -40,6 +48,18 @@ class TouchpadState:
     PUSH = const(3)
 
 
+class TouchEvent:
+    PRESS = const(0)
+    HOLD = const(1)
+    RELEASE = const(2)
+
+
+class PollTier:
+    TOUCH = const(0)
+    IDLE = const(1)
+    DEEP_IDLE = const(2)
+
+
 class TPConsts:
     # Period of IIR filter in ms when sensor is not touched.
     FILTER_IDLE_PERIOD = const(100)
@@ -47,6 +67,12 @@ class TPConsts:
     # Period of IIR filter in ms when sensor is being touched. Shouldn't change this value.
     FILTER_TOUCH_PERIOD = const(10)
 
+    # Period of IIR filter in ms when nothing has been touched for DEEP_IDLE_TIMEOUT ms, or the lights are off.
+    FILTER_DEEP_IDLE_PERIOD = const(400)
+
+    # 5 minutes; Time without any activity before switching to the deep idle period
+    DEEP_IDLE_TIMEOUT = const(5 * 60 * 1000)
+
     # 20ms; Debounce threshold
     STATE_SWITCH_DEBOUNCE = const(20)
 
@@ -74,6 +100,10 @@ class TPConsts:
     BASELINE_RESET_THRESHOLD_PERCENT = 0.20
 
 
+# Touch filter polling period for each PollTier
+_TIER_PERIODS = (TPConsts.FILTER_TOUCH_PERIOD, TPConsts.FILTER_IDLE_PERIOD, TPConsts.FILTER_DEEP_IDLE_PERIOD)
+
+
 class FilteredTouchpad:
     def __init__(self, name: str, pin: Pin, sensitivity: float):
         self.name = name
@@ -197,13 +227,350 @@ class FilteredTouchpad:
         return action_flag
 
 
+# Thresholds are stored as _FIX_LIMBS fixed-point fractions of _FIX_BITS bits each, most significant first. Each limb
+# times a baseline below 2^15 stays a small int.
+_FIX_BITS = const(14)
+_FIX_LIMBS = const(6)
+_FIX_MASK = const(0x3fff)
+
+
+def _fixed(threshold: float, rounding: int) -> tuple:
+    """
+    Converts a threshold to fixed-point limbs, half a float step below it if rounding < 0, or above if > 0.
+
+    A ratio diff / baseline computed by FilteredTouchpad is rounded to the nearest float before being compared, so it
+    reaches threshold exactly when the unrounded ratio is above the midpoint with the previous float. No such ratio can
+    sit on a midpoint, so comparing with it gives the same decisions with integers only. Where math.nextafter() isn't
+    available (MicroPython), the threshold itself is used.
+    """
+    total_bits = _FIX_BITS * _FIX_LIMBS
+    # Scaling by a power of 2 is exact, and so is the difference between two neighbouring floats
+    value = int(threshold * 2 ** total_bits) * 2
+    if rounding and nextafter is not None:
+        neighbour = nextafter(threshold, threshold + rounding)
+        value += int(abs(neighbour - threshold) * 2 ** total_bits) * (1 if rounding > 0 else -1)
+    value >>= 1
+    return tuple((value >> (_FIX_BITS * (_FIX_LIMBS - 1 - i))) & _FIX_MASK for i in range(_FIX_LIMBS))
+
+
+@micropython.native
+def _scale(fixed: tuple, baseline: int) -> int:
+    """
+    Returns floor(fixed * baseline), from the least significant limb up so that nothing exceeds a small int
+    """
+    acc = 0
+    for i in range(_FIX_LIMBS - 1, -1, -1):
+        acc = (acc >> _FIX_BITS) + fixed[i] * baseline
+    return acc >> _FIX_BITS
+
+
+class FixedPointTouchpad(FilteredTouchpad):
+    """
+    Integer-only variant of FilteredTouchpad. The thresholds on the ratio diff / baseline are converted to fixed point
+    once, then to raw reading units whenever the baseline changes, so each poll only compares small ints and allocates
+    nothing.
+
+    The fixed-point thresholds account for the rounding of FilteredTouchpad's float division, so both filters take the
+    same decisions for every reading. The only difference is the first baseline, the average of three readings, which is
+    rounded to an int until it's updated.
+    """
+
+    def __init__(self, name: str, pin: Pin, sensitivity: float):
+        super().__init__(name, pin, sensitivity)
+        self.baseline = int(self.baseline + 0.5)
+        self.diff = 0
+        self.low_sense = self.touch_change < TPConsts.TOUCH_LOW_SENSE_THRESHOLD
+
+        # Each level is the last diff on the near side of its threshold: ratio >= thr is reached above the midpoint
+        # with the previous float, ratio > thr above the midpoint with the next one
+        self.push_fix = _fixed(self.touch_thr + self.hyst_thr, -1)
+        self.hold_fix = _fixed(self.touch_thr - self.hyst_thr, 1)
+        self.noise_fix = _fixed(self.noise_thr, 1)
+        self.release_noise_fix = _fixed(self.noise_thr, -1)
+        self.baseline_reset_fix = _fixed(self.baseline_reset_thr, -1)
+        self._update_levels()
+
+    @micropython.native
+    def _update_levels(self):
+        baseline = self.baseline
+        self.push_lvl = _scale(self.push_fix, baseline) + 1
+        self.hold_lvl = _scale(self.hold_fix, baseline)
+        self.noise_lvl = _scale(self.noise_fix, baseline)
+        self.release_noise_lvl = _scale(self.release_noise_fix, baseline)
+        self.baseline_reset_lvl = _scale(self.baseline_reset_fix, baseline) + 1
+
+    # Returns updated "action_flag"
+    @micropython.native
+    def update(self, action_flag: bool) -> bool:
+        reading = self.tp.read()
+        filtered_reading = self.tp.read_filtered()
+
+        diff = self.baseline - reading
+        self.diff = diff
+
+        if self.state == TouchpadState.IDLE or self.state == TouchpadState.RELEASE:
+            self.state = TouchpadState.IDLE
+
+            if -self.noise_lvl <= diff <= self.noise_lvl:
+                self.bl_reset_count = 0
+                self.debounce_count = 0
+                self.bl_update_count += 1
+
+                if self.bl_update_count > self.bl_update_count_thr:
+                    if action_flag is None:
+                        action_flag = False
+                    self.bl_update_count = 0
+                    self.baseline = filtered_reading
+                    self._update_levels()
+            else:
+                action_flag = True
+                self.bl_update_count = 0
+                self.debounce_count += 1
+
+                if diff >= self.push_lvl:
+                    self.bl_reset_count = 0
+
+                    if self.debounce_count >= self.debounce_thr or self.low_sense:
+                        self.debounce_count = 0
+                        self.state = TouchpadState.PUSH
+                        self.event_start = utime.ticks_ms()
+
+                elif diff <= -self.baseline_reset_lvl:
+                    self.debounce_count = 0
+                    self.bl_reset_count += 1
+                    if self.bl_reset_count > self.bl_reset_count_thr:
+                        self.bl_reset_count = 0
+                        self.baseline = reading
+                        self._update_levels()
+
+                else:
+                    self.debounce_count = 0
+                    self.bl_reset_count = 0
+
+        else:
+            action_flag = True
+            if diff > self.hold_lvl:
+                self.sum_ms += self.filter_value
+                if self.serial_thres_sec > 0 and self.sum_ms - self.filter_value < self.serial_thres_sec * 1000 <= self.sum_ms:
+                    self.state = TouchpadState.PRESS
+            else:
+                self.debounce_count += 1
+                if self.debounce_count >= self.debounce_thr or \
+                        -self.release_noise_lvl <= diff <= self.release_noise_lvl or \
+                        self.low_sense:
+                    self.debounce_count = 0
+                    self.sum_ms = 0
+                    self.state = TouchpadState.RELEASE
+                    self.acknowledged = False
+        return action_flag
+
+
+class BatchedTouchpad:
+    """
+    Handle to a touchpad whose state lives in a BatchedTouchpadEngine. Same read()/ack() interface as
+    FilteredTouchpad.
+    """
+
+    def __init__(self, engine: "BatchedTouchpadEngine", index: int, name: str):
+        self.engine = engine
+        self.index = index
+        self.name = name
+
+    @property
+    def acknowledged(self) -> bool:
+        return self.engine.acknowledged[self.index] == 1
+
+    @property
+    def state(self) -> int:
+        return self.engine.state[self.index]
+
+    @property
+    def event_start(self) -> int:
+        return self.engine.event_start[self.index]
+
+    def read(self) -> tuple:
+        state = self.engine.state[self.index]
+        return (
+            state,
+            (utime.ticks_ms() - self.engine.event_start[self.index])
+            if state in (TouchpadState.PRESS, TouchpadState.PUSH) else 0
+        )
+
+    def ack(self) -> None:
+        if self.engine.state[self.index] in (TouchpadState.PUSH, TouchpadState.PRESS):
+            self.engine.acknowledged[self.index] = 1
+
+
+class BatchedTouchpadEngine:
+    """
+    Same state machine as FilteredTouchpad, but the state of all pads is kept in parallel arrays indexed by pad
+    number and every pad is processed in a single pass, instead of doing a dozen attribute loads and stores on each
+    FilteredTouchpad instance.
+    """
+
+    def __init__(self):
+        self.pads = []
+        self.tps = []
+
+        self.baseline = array("f")
+        self.touch_thr = array("f")
+        self.noise_thr = array("f")
+        self.hyst_thr = array("f")
+        self.baseline_reset_thr = array("f")
+        # Whether touch_change is below TOUCH_LOW_SENSE_THRESHOLD, computed before it's rounded to a float32
+        self.low_sense = array("B")
+
+        self.state = array("B")
+        self.acknowledged = array("B")
+        self.event_start = array("l")
+        self.sum_ms = array("l")
+        self.bl_reset_count = array("H")
+        self.bl_update_count = array("H")
+        self.debounce_count = array("H")
+
+        self.filter_value = TPConsts.FILTER_TOUCH_PERIOD
+        self.serial_thres_ms = 0
+        self.debounce_thr = TPConsts.STATE_SWITCH_DEBOUNCE // TPConsts.FILTER_TOUCH_PERIOD
+        self.bl_reset_count_thr = TPConsts.BASELINE_RESET_COUNT_THRESHOLD
+        self.bl_update_count_thr = TPConsts.BASELINE_UPDATE_COUNT_THRESHOLD // TPConsts.FILTER_IDLE_PERIOD
+
+    def add(self, name: str, pin: Pin, sensitivity: float) -> BatchedTouchpad:
+        tp = TouchPad(pin)
+        baseline = 0
+        for i in range(3):
+            baseline += tp.read()
+
+        touch_thr = sensitivity * TPConsts.TOUCH_THRESHOLD_PERCENT
+
+        self.tps.append(tp)
+        self.baseline.append(baseline / 3)
+        self.low_sense.append(sensitivity < TPConsts.TOUCH_LOW_SENSE_THRESHOLD)
+        self.touch_thr.append(touch_thr)
+        self.noise_thr.append(touch_thr * TPConsts.NOISE_THRESHOLD_PERCENT)
+        self.hyst_thr.append(touch_thr * TPConsts.HYSTERESIS_THRESHOLD_PERCENT)
+        self.baseline_reset_thr.append(touch_thr * TPConsts.BASELINE_RESET_THRESHOLD_PERCENT)
+        for buf in (self.state, self.acknowledged, self.event_start, self.sum_ms, self.bl_reset_count,
+                    self.bl_update_count, self.debounce_count):
+            buf.append(0)
+
+        pad = BatchedTouchpad(self, len(self.pads), name)
+        self.pads.append(pad)
+        return pad
+
+    # Returns the "action_flag" for all pads
+    @micropython.native
+    def update(self) -> bool:
+        action_flag = False
+
+        tps = self.tps
+        baseline = self.baseline
+        low_sense = self.low_sense
+        touch_thr = self.touch_thr
+        noise_thr = self.noise_thr
+        hyst_thr = self.hyst_thr
+        baseline_reset_thr = self.baseline_reset_thr
+        states = self.state
+        debounce_count = self.debounce_count
+        bl_reset_count = self.bl_reset_count
+        bl_update_count = self.bl_update_count
+        sum_ms = self.sum_ms
+        debounce_thr = self.debounce_thr
+        filter_value = self.filter_value
+        serial_thres_ms = self.serial_thres_ms
+
+        for i in range(len(tps)):
+            tp = tps[i]
+            reading = tp.read()
+            filtered_reading = tp.read_filtered()
+
+            diff_rate = (baseline[i] - reading) / baseline[i]
+            state = states[i]
+
+            if state == TouchpadState.IDLE or state == TouchpadState.RELEASE:
+                state = TouchpadState.IDLE
+
+                if abs(diff_rate) <= noise_thr[i]:
+                    bl_reset_count[i] = 0
+                    debounce_count[i] = 0
+                    count = bl_update_count[i] + 1
+                    if count > self.bl_update_count_thr:
+                        count = 0
+                        baseline[i] = filtered_reading
+                    bl_update_count[i] = count
+                else:
+                    action_flag = True
+                    bl_update_count[i] = 0
+                    debounce = debounce_count[i] + 1
+
+                    if diff_rate >= touch_thr[i] + hyst_thr[i]:
+                        bl_reset_count[i] = 0
+                        if debounce >= debounce_thr or low_sense[i]:
+                            debounce = 0
+                            state = TouchpadState.PUSH
+                            self.event_start[i] = utime.ticks_ms()
+
+                    elif diff_rate <= 0 - baseline_reset_thr[i]:
+                        debounce = 0
+                        count = bl_reset_count[i] + 1
+                        if count > self.bl_reset_count_thr:
+                            count = 0
+                            baseline[i] = reading
+                        bl_reset_count[i] = count
+
+                    else:
+                        debounce = 0
+                        bl_reset_count[i] = 0
+
+                    debounce_count[i] = debounce
+
+            else:
+                action_flag = True
+                if diff_rate > touch_thr[i] - hyst_thr[i]:
+                    total = sum_ms[i] + filter_value
+                    sum_ms[i] = total
+                    if serial_thres_ms > 0 and total - filter_value < serial_thres_ms <= total:
+                        state = TouchpadState.PRESS
+                else:
+                    debounce = debounce_count[i] + 1
+                    if debounce >= debounce_thr or \
+                            abs(diff_rate) < noise_thr[i] or \
+                            low_sense[i]:
+                        debounce = 0
+                        sum_ms[i] = 0
+                        state = TouchpadState.RELEASE
+                        self.acknowledged[i] = 0
+                    debounce_count[i] = debounce
+
+            states[i] = state
+
+        return action_flag
+
+
 class TouchpadManager:
     def __init__(self):
         self.poll_interval = TPConsts.FILTER_TOUCH_PERIOD
-        self.touchpads = set()
+        self.tier = PollTier.TOUCH
+        self.last_activity_ms = utime.ticks_ms()
+        # Total polling time spent in each PollTier, and number of polls
+        self.tier_ms = [0, 0, 0]
+        self.polls = 0
+        # Kept in load order so pads are always processed by index
+        self.touchpads = []
+        self.engine = BatchedTouchpadEngine() if conf.touchpad_engine == "batched" else None
         self.running = False
         self.inited = False
 
+        # Bounded queue of (TouchEvent, touchpad) tuples for the controller to await on
+        self.events = []
+        self.events_published = 0
+        self.events_dropped = 0
+        self.event_flag = uasyncio.Event()
+        # Names of the touchpads currently pressed, mapped to whether the HOLD event was already sent
+        self._held = {}
+
+        self.tracer = None
+        self.calibrator = None
+
     # Must be called after at least one touchpad has been loaded and before starting the loop
     def init(self):
         if len(self.touchpads) == 0:
@@ -213,14 +580,70 @@ class TouchpadManager:
 
     # noinspection PyShadowingNames
     def load_touchpad(self, name: str, pin: Pin, sensitivity: float = 1) -> FilteredTouchpad:
-        if usys.implementation.name == 'micropython':
-            tp = FilteredTouchpad(name, pin, sensitivity)
-        else:
+        if usys.implementation.name != 'micropython' and not self._replaying():
             import cpytouchpad
             tp = cpytouchpad.FakeTouchpad(name)
-        self.touchpads.add(tp)
+        elif self.engine is not None:
+            tp = self.engine.add(name, pin, sensitivity)
+        elif conf.touchpad_engine == "fixed":
+            tp = FixedPointTouchpad(name, pin, sensitivity)
+        else:
+            tp = FilteredTouchpad(name, pin, sensitivity)
+        self.touchpads.append(tp)
         return tp
 
+    @staticmethod
+    def _replaying() -> bool:
+        # On CPython, real filters are used if a touch trace is being replayed instead of marker files
+        import cpytouchpad
+        return cpytouchpad.trace is not None
+
+    def _sensors(self) -> list:
+        if self.engine is not None:
+            return self.engine.tps
+        if any(not hasattr(pad, "tp") for pad in self.touchpads):
+            raise OSError("Touchpads have no sensors to trace")
+        return [pad.tp for pad in self.touchpads]
+
+    def _set_sensors(self, sensors: list):
+        if self.engine is not None:
+            self.engine.tps = sensors
+        else:
+            for pad, tp in zip(self.touchpads, sensors):
+                pad.tp = tp
+
+    def start_trace(self, path: str, max_samples: int = 0):
+        """
+        Record the raw and filtered readings seen by the touch filter on every poll into path, see leviot.touchtrace
+        """
+        if self.tracer is not None:
+            self.stop_trace()
+        sensors = self._sensors()
+        self.tracer = TraceWriter(path, [(pad.name, constants.TOUCHPADS[pad.name]) for pad in self.touchpads],
+                                  max_samples)
+        self._set_sensors([TracingTouchPad(sensors[i], self.tracer, i) for i in range(len(sensors))])
+        log.i("Recording touch trace to {}", path)
+
+    def stop_trace(self):
+        if self.tracer is None:
+            return
+        self._set_sensors([tp.tp for tp in self._sensors()])
+        self.tracer.close()
+        log.i("Touch trace stopped after {} samples", self.tracer.samples)
+        self.tracer = None
+
+    def start_calibration(self):
+        """
+        Measure each pad's sensitivity and store it in NVS, see leviot.touchcal. Touch events are not dispatched while
+        calibrating.
+        """
+        self._sensors()
+        self.calibrator = touchcal.TouchCalibrator(
+            [pad.name for pad in self.touchpads],
+            TPConsts.TOUCH_THRESHOLD_PERCENT * TPConsts.NOISE_THRESHOLD_PERCENT
+        )
+        log.i("Touch calibration started, do not touch the panel")
+
     def set_poll_interval(self, value: int):
         if not self.inited:
             raise OSError("Must be inited first")
@@ -229,16 +652,104 @@ class TouchpadManager:
         self.poll_interval = value
         esp32.touch_filter_set_period(value)
 
+        # Baseline updates are counted in polls. Keep them happening every BASELINE_UPDATE_COUNT_THRESHOLD ms when
+        # polling slower than the idle period.
+        bl_update_count_thr = TPConsts.BASELINE_UPDATE_COUNT_THRESHOLD // max(value, TPConsts.FILTER_IDLE_PERIOD)
+        bl_update_count_thr = max(bl_update_count_thr, 1)
+        if self.engine is not None:
+            self.engine.bl_update_count_thr = bl_update_count_thr
+        else:
+            for tp in self.touchpads:
+                tp.bl_update_count_thr = bl_update_count_thr
+
+    def _select_tier(self, action_flag: bool) -> int:
+        now = utime.ticks_ms()
+        if action_flag or self.calibrator is not None:
+            self.last_activity_ms = now
+            return PollTier.TOUCH
+        if not state_tracker.lights or utime.ticks_diff(now, self.last_activity_ms) >= TPConsts.DEEP_IDLE_TIMEOUT:
+            return PollTier.DEEP_IDLE
+        return PollTier.IDLE
+
+    @property
+    def wakeups_per_sec(self) -> float:
+        total_ms = sum(self.tier_ms)
+        return self.polls * 1000 / total_ms if total_ms else 0
+
+    def as_dict(self) -> dict:
+        return {
+            "engine": conf.touchpad_engine,
+            "tier": self.tier,
+            "tier_ms": self.tier_ms,
+            "polls": self.polls,
+            "wakeups_per_sec": self.wakeups_per_sec,
+            "events_published": self.events_published,
+            "events_dropped": self.events_dropped,
+            "calibrating": self.calibrator is not None,
+        }
+
     def update(self):
         if not self.inited:
             raise OSError("Must be inited first")
 
-        action_flag = None
-
-        for tp in self.touchpads:
-            action_flag = tp.update(action_flag)
-
-        self.set_poll_interval(TPConsts.FILTER_TOUCH_PERIOD if action_flag else TPConsts.FILTER_IDLE_PERIOD)
+        if self.engine is not None:
+            action_flag = self.engine.update()
+        else:
+            action_flag = None
+            for tp in self.touchpads:
+                action_flag = tp.update(action_flag)
+
+        if self.calibrator is not None and self.calibrator.feed([tp.read() for tp in self._sensors()]):
+            self.calibrator.finish()
+            self.calibrator = None
+
+        if self.tracer is not None:
+            self.tracer.write_sample()
+            if self.tracer.full:
+                self.stop_trace()
+
+        self.tier = self._select_tier(action_flag)
+        self.set_poll_interval(_TIER_PERIODS[self.tier])
+        self.tier_ms[self.tier] += self.poll_interval
+        self.polls += 1
+        self._dispatch_events()
+
+    def _dispatch_events(self):
+        # Reads the state attributes directly rather than through read(), which builds a tuple for every pad
+        held = self._held
+        now = utime.ticks_ms()
+        for pad in self.touchpads:
+            state = pad.state
+            name = pad.name
+            if state == TouchpadState.PRESS or state == TouchpadState.PUSH:
+                if name not in held:
+                    held[name] = False
+                    self._publish(TouchEvent.PRESS, pad)
+                elif not held[name] and utime.ticks_diff(now, pad.event_start) >= constants.TOUCHPAD_HOLD_TIMEOUT_MS:
+                    held[name] = True
+                    self._publish(TouchEvent.HOLD, pad)
+            elif name in held:
+                del held[name]
+                self._publish(TouchEvent.RELEASE, pad)
+
+    def _publish(self, event: int, pad):
+        if self.calibrator is not None:
+            return
+        if len(self.events) >= constants.TOUCH_EVENT_QUEUE_SIZE:
+            self.events_dropped += 1
+            return
+        self.events.append((event, pad))
+        self.events_published += 1
+        self.event_flag.set()
+
+    async def next_event(self) -> tuple:
+        """
+        Waits until a touch event is available and returns it as a (TouchEvent, touchpad) tuple
+        """
+        while not self.events:
+            self.event_flag.clear()
+            await self.event_flag.wait()
+        return self.events.pop(0)
 
     async def async_loop(self):
         if not self.inited:
@@ -252,24 +763,18 @@ class TouchpadManager:
     def stop(self):
         self.running = False
 
-    @property
-    def active_touchpads(self) -> dict:
-        result = {}
-        for pad in self.touchpads:
-            if pad.acknowledged:
-                continue
-            state, duration = pad.read()
-            if state not in (TouchpadState.PRESS, TouchpadState.PUSH):
-                continue
-            result[pad.name] = pad
-        return result
-
 
 touchpad_mgr = TouchpadManager()
 
 for name in constants.TOUCHPADS:
     pin = constants.TOUCHPADS[name]
-    sensitivity = conf.touchpads_sensitivity[name]
+    sensitivity = touchcal.load_sensitivity(name, conf.touchpads_sensitivity[name])
     touchpad_mgr.load_touchpad(name, Pin(pin), sensitivity)
 
 touchpad_mgr.init()
+
+if conf.touch_calibration and not touchcal.is_calibrated():
+    try:
+        touchpad_mgr.start_calibration()
+    except OSError as e:
+        log.e(e)
@@ -0,0 +1,71 @@
+import ustruct
+import utime
+
+# Compact binary recording of raw touchpad samples, used to tune the touch filter offline. Traces are replayed under
+# CPython by upy_test_stubs/cpytouchpad.py.
+#
+# Layout (little endian):
+#   header:  magic "LTTR", version (B), pad count (B)
+#   per pad: pin number (B), name length (B), name (ASCII)
+#   samples: ms since previous sample (H), then raw reading (H) and filtered reading (H) for each pad, in header order
+
+TRACE_MAGIC = b"LTTR"
+TRACE_VERSION = 1
+
+_HEADER = "<4sBB"
+_PAD_HEADER = "<BB"
+
+
+class TracingTouchPad:
+    """
+    Wraps a machine.TouchPad and stores every value read from it into the current sample of a TraceWriter
+    """
+
+    def __init__(self, tp, writer: "TraceWriter", index: int):
+        self.tp = tp
+        self.writer = writer
+        self.index = index
+
+    def read(self) -> int:
+        value = self.tp.read()
+        self.writer.sample[2 * self.index] = value
+        return value
+
+    def read_filtered(self) -> int:
+        value = self.tp.read_filtered()
+        self.writer.sample[2 * self.index + 1] = value
+        return value
+
+
+class TraceWriter:
+    def __init__(self, path: str, pads: list, max_samples: int = 0):
+        """
+        pads is a list of (name, pin number) tuples. Recording stops by itself after max_samples samples if > 0.
+        """
+        self.file = open(path, "wb")
+        self.count = len(pads)
+        self.max_samples = max_samples
+        self.samples = 0
+        self.sample = [0] * (2 * self.count)
+        self.fmt = "<H" + "H" * (2 * self.count)
+        self.last_ms = utime.ticks_ms()
+
+        self.file.write(ustruct.pack(_HEADER, TRACE_MAGIC, TRACE_VERSION, self.count))
+        for name, pin in pads:
+            name = name.encode()
+            self.file.write(ustruct.pack(_PAD_HEADER, pin, len(name)))
+            self.file.write(name)
+
+    @property
+    def full(self) -> bool:
+        return 0 < self.max_samples <= self.samples
+
+    def write_sample(self):
+        now = utime.ticks_ms()
+        dt = utime.ticks_diff(now, self.last_ms)
+        self.last_ms = now
+        self.file.write(ustruct.pack(self.fmt, max(0, min(dt, 0xffff)), *self.sample))
+        self.samples += 1
+
+    def close(self):
+        self.file.close()
@@ -1,4 +1,10 @@
-from leviot.utils.usyslog import UDPClient as SyslogClient, SyslogClient as DummyClient
+import gc
+
+import uasyncio as asyncio
+from micropython import const
+
+from leviot.utils import usyslog
+from leviot.utils.usyslog import AsyncUDPClient, SyslogClient as DummyClient
 from leviot import conf
 
 mqtt = None
@@ -36,60 +42,241 @@ def exception_value(e):
         return e
 
 
-class Logger:
-    def __init__(self, tag):
-        self.tag = tag
-        self.syslog = DummyClient()
+## Log levels
+DEBUG = const(10)
+INFO = const(20)
+WARNING = const(30)
+ERROR = const(40)
+# Above every level, suppresses all messages
+OFF = const(50)
+
+LEVEL_NAMES = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR, "off": OFF}
+
+_LABELS = {DEBUG: "DEBUG", INFO: "INFO ", WARNING: "WARN ", ERROR: "ERROR"}
+_SYSLOG_SEVERITIES = {DEBUG: usyslog.S_DEBUG, INFO: usyslog.S_INFO, WARNING: usyslog.S_WARN, ERROR: usyslog.S_ERR}
+# RFC 3164 limit for a syslog datagram
+_SYSLOG_MAX_DATAGRAM = const(1024)
+
+# Global threshold and per tag overrides, set with set_levels()
+_level = INFO
+_tag_levels = {}
+# Every logger, so their thresholds can be updated at runtime
+_loggers = []
+
+
+def _parse_level(name: str) -> int:
+    try:
+        return LEVEL_NAMES[name.strip().lower()]
+    except KeyError:
+        raise ValueError("Unknown log level: {}".format(name))
+
+
+def set_levels(spec: str):
+    """
+    Sets the log thresholds from a spec like "info,persistence=debug,mqtt=warning": a bare level is the global threshold,
+    tag=level overrides it for one tag. The global threshold is info if not given, and tags that aren't mentioned go
+    back to it.
+    """
+    global _level
+    level = INFO
+    tag_levels = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        if "=" in item:
+            tag, name = item.split("=", 1)
+            tag_levels[tag.strip()] = _parse_level(name)
+        else:
+            level = _parse_level(item)
 
-    @staticmethod
-    def _print_and_mqtt(message: str):
-        print("$$  " + message)
+    _level = level
+    _tag_levels.clear()
+    _tag_levels.update(tag_levels)
+    for logger in _loggers:
+        logger.level = _tag_levels.get(logger.tag, _level)
+
+
+def levels() -> str:
+    """
+    Returns the current thresholds in the format accepted by set_levels()
+    """
+    names = {value: name for name, value in LEVEL_NAMES.items()}
+    items = [names[_level]]
+    for tag in sorted(_tag_levels):
+        items.append("{}={}".format(tag, names[_tag_levels[tag]]))
+    return ",".join(items)
+
+
+class LogShipper:
+    """
+    Ships log lines to MQTT and syslog from a single task, started with run(). Lines wait in a fixed-size ring buffer:
+    when it's full the oldest line is dropped and counted. Lines queued while a batch is being shipped go out together in
+    the next one, as a single MQTT publish and one syslog datagram per run of lines with the same level.
+    """
+
+    def __init__(self, size: int, batch_lines: int):
+        self.size = size
+        self.batch_lines = batch_lines
+        self.levels = bytearray(size)
+        self.lines = [None] * size
+        # Position of the oldest line and number of lines queued
+        self.head = 0
+        self.depth = 0
+        self.event = asyncio.Event()
+        # Shared by every logger, never blocks: see AsyncUDPClient
+        self.syslog = AsyncUDPClient(conf.syslog) if conf.syslog else DummyClient()
+
+        self.max_depth = 0
+        self.dropped = 0
+        self.reported_drops = 0
+        self.shipped = 0
+        self.batches = 0
+        self.failed = 0
+
+    def put(self, level: int, line: str):
+        if self.depth == self.size:
+            self.lines[self.head] = None
+            self.head = (self.head + 1) % self.size
+            self.depth -= 1
+            self.dropped += 1
+        i = (self.head + self.depth) % self.size
+        self.levels[i] = level
+        self.lines[i] = line
+        self.depth += 1
+        if self.depth > self.max_depth:
+            self.max_depth = self.depth
+        self.event.set()
+
+    def _take(self):
+        n = min(self.depth, self.batch_lines)
+        levels, lines = [], []
+        for _ in range(n):
+            levels.append(self.levels[self.head])
+            lines.append(self.lines[self.head])
+            self.lines[self.head] = None
+            self.head = (self.head + 1) % self.size
+        self.depth -= n
+        if self.dropped != self.reported_drops:
+            levels.insert(0, WARNING)
+            lines.insert(0, "ulog: {} log lines dropped".format(self.dropped - self.reported_drops))
+            self.reported_drops = self.dropped
+        return levels, lines
+
+    async def run(self):
+        if isinstance(self.syslog, AsyncUDPClient):
+            asyncio.create_task(self.syslog.maintain())
+        while True:
+            await self.event.wait()
+            self.event.clear()
+            while self.depth:
+                levels, lines = self._take()
+                await self._ship(levels, lines)
+                self.shipped += len(lines)
+                self.batches += 1
+
+    async def _ship(self, levels: list, lines: list):
+        # Errors are only printed: logging them would queue more lines to ship
         if mqtt is not None:
-            mqtt.log(message)
+            try:
+                await mqtt.log_async("\n".join(_LABELS[levels[i]] + " " + lines[i] for i in range(len(lines))))
+            except Exception as e:
+                self.failed += 1
+                print("$$  Cannot ship logs to MQTT: {}".format(e))
 
-    def syslog_reconnect(self):
-        if not conf.syslog or type(self.syslog) is SyslogClient:
+        if not conf.syslog:
             return
-
         try:
-            self.syslog = SyslogClient(ip=conf.syslog)
-            self._print_and_mqtt("Syslog Connected at {}".format(conf.syslog))
-        except:
-            self._print_and_mqtt("DEBUG: Cannot connect to {} SysLog server".format(conf.syslog))
+            start = 0
+            size = 0
+            for i in range(len(lines) + 1):
+                if start < i and (i == len(lines) or levels[i] != levels[start] or
+                                  size + len(lines[i]) + 1 > _SYSLOG_MAX_DATAGRAM):
+                    self.syslog.log(_SYSLOG_SEVERITIES[levels[start]], "\n".join(lines[start:i]))
+                    start = i
+                    size = 0
+                if i < len(lines):
+                    size += len(lines[i]) + 1
+        except Exception as e:
+            self.failed += 1
+            print("$$  Cannot ship logs to SysLog: {}".format(e))
 
-    def d(self, m):
-        message = exception_value(m)
-        self._print_and_mqtt("DEBUG {}: {}".format(self.tag, message))
-        try:
-            self.syslog_reconnect()
-            self.syslog.debug("{}: {}".format(self.tag, message))
-        except:
-            self.syslog = DummyClient()
+    def as_dict(self) -> dict:
+        stats = {
+            "size": self.size,
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "dropped": self.dropped,
+            "shipped": self.shipped,
+            "batches": self.batches,
+            "failed": self.failed,
+        }
+        if isinstance(self.syslog, AsyncUDPClient):
+            stats["syslog_connected"] = self.syslog.connected
+            stats["syslog_dropped"] = self.syslog.dropped
+            stats["syslog_failures"] = self.syslog.failures
+        if hasattr(gc, "mem_free"):
+            stats["heap_free"] = gc.mem_free()
+            stats["heap_alloc"] = gc.mem_alloc()
+        return stats
 
-    def i(self, m):
-        message = exception_value(m)
-        self._print_and_mqtt("INFO  {}: {}".format(self.tag, message))
-        try:
-            self.syslog_reconnect()
-            self.syslog.info("{}: {}".format(self.tag, message))
-        except:
-            self.syslog = DummyClient()
 
+shipper = LogShipper(conf.log_queue_lines, conf.log_batch_lines)
 
-    def w(self, m):
-        message = exception_value(m)
-        self._print_and_mqtt("WARN  {}: {}".format(self.tag, str(message)))
-        try:
-            self.syslog_reconnect()
-            self.syslog.warning("{}: {}".format(self.tag, message))
-        except:
-            self.syslog = DummyClient()
 
-    def e(self, m):
+def link_up():
+    """
+    Called by leviot.network right after connecting, when syslog can resolve its server
+    """
+    if isinstance(shipper.syslog, AsyncUDPClient):
+        shipper.syslog.link_up()
+
+
+class Logger:
+    """
+    Messages below the threshold of the logger's tag are dropped before any formatting. Format arguments can be passed
+    after the message, e.g. log.d("Speed {}", speed), so that they're only formatted if the message is logged.
+
+    Messages are printed right away, and queued to the shipper for MQTT and syslog.
+    """
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.level = _tag_levels.get(tag, _level)
+        _loggers.append(self)
+
+    def enabled(self, level: int) -> bool:
+        return level >= self.level
+
+    def _emit(self, level: int, m, args):
         message = exception_value(m)
-        self._print_and_mqtt("ERROR {}: {}".format(self.tag, str(message)))
-        try:
-            self.syslog_reconnect()
-            self.syslog.error("{}: {}".format(self.tag, message))
-        except:
-            self.syslog = DummyClient()
\ No newline at end of file
+        if args:
+            message = message.format(*args)
+        line = "{}: {}".format(self.tag, message)
+        print("$$  " + _LABELS[level] + " " + line)
+        shipper.put(level, line)
+
+    def d(self, m, *args):
+        if DEBUG < self.level:
+            return
+        self._emit(DEBUG, m, args)
+
+    def i(self, m, *args):
+        if INFO < self.level:
+            return
+        self._emit(INFO, m, args)
+
+    def w(self, m, *args):
+        if WARNING < self.level:
+            return
+        self._emit(WARNING, m, args)
+
+    def e(self, m, *args):
+        if ERROR < self.level:
+            return
+        self._emit(ERROR, m, args)
+
+
+try:
+    set_levels(conf.log_level)
+except ValueError as e:
+    print("$$  ERROR ulog: Invalid log_level in leviot_conf: {}".format(e))
@@ -0,0 +1,43 @@
+"""
+Cache of resolved host addresses, shared by the clients that need to reach a server by name.
+
+usocket.getaddrinfo() blocks until the name is resolved or the lookup times out. Resolving each name once per TTL keeps
+those stalls rare, and lookup() never blocks.
+"""
+import usocket
+import utime
+from micropython import const
+
+# getaddrinfo() doesn't report record TTLs, so the same one is used for every name
+DEFAULT_TTL_MS = const(60 * 60 * 1000)
+
+# (host, port) -> (address, expiry ticks_ms)
+_cache = {}
+
+
+def lookup(host: str, port: int):
+    """
+    Returns the cached address of host, None if it isn't cached or it expired
+    """
+    entry = _cache.get((host, port), None)
+    if entry is None or utime.ticks_diff(entry[1], utime.ticks_ms()) <= 0:
+        return None
+    return entry[0]
+
+
+def resolve(host: str, port: int, ttl_ms: int = DEFAULT_TTL_MS):
+    """
+    Returns the address of host, resolving it if it isn't cached. Blocks while resolving, raises OSError on failure.
+    """
+    addr = lookup(host, port)
+    if addr is None:
+        addr = usocket.getaddrinfo(host, port)[0][-1]
+        _cache[(host, port)] = (addr, utime.ticks_add(utime.ticks_ms(), ttl_ms))
+    return addr
+
+
+def forget(host: str, port: int):
+    """
+    Drops the cached address of host, so it's resolved again next time
+    """
+    _cache.pop((host, port), None)
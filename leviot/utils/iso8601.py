@@ -1,5 +1,6 @@
 import micropython
 import ure
+import utime
 from micropython import const
 
 
@@ -23,6 +24,11 @@ def number_to_duration(value: int) -> str:
     return "PT{}{}{}".format(hours, mins, secs)
 
 
+def timestamp_to_datetime(value: int) -> str:
+    tm = utime.gmtime(value)
+    return "{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}Z".format(tm[0], tm[1], tm[2], tm[3], tm[4], tm[5])
+
+
 @micropython.native
 def _parse_next_number(string: str):
     match = ure.match(r"^(\d+\.?\d*)", string)
@@ -3,7 +3,12 @@ This syslog client can send UDP packets to a remote syslog server.
 Timestamps are not supported for simplicity.
 For more information, see RFC 3164.
 """
+import uasyncio as asyncio
 import usocket
+import utime
+from uerrno import EAGAIN, ENOMEM
+
+from leviot.utils import dnscache
 
 # Facility constants
 F_KERN = const(0)
@@ -80,4 +85,103 @@ class UDPClient(SyslogClient):
         self._sock.sendto(data.encode(), self._addr)
         
     def close(self):
-        self._sock.close()
\ No newline at end of file
+        self._sock.close()
+
+
+# Retry delays of AsyncUDPClient after a failure, doubling each time
+RETRY_MIN_MS = const(5 * 1000)
+RETRY_MAX_MS = const(10 * 60 * 1000)
+
+
+class AsyncUDPClient(SyslogClient):
+    """
+    UDP client that never blocks while logging. The server address is resolved through the shared DNS cache, which
+    blocks the event loop until usocket.getaddrinfo() returns, so it's only done at start, right after the network
+    comes up (see link_up()), and after a failure, retried with exponential backoff by the maintain() task. The address
+    is kept as long as sending works. Messages are dropped and counted while the address is unknown, or if the socket
+    can't send them right away. Other send errors close the socket and resolve the address again.
+    """
+    def __init__(self, host, port=514, facility=F_USER, ttl_ms=dnscache.DEFAULT_TTL_MS):
+        super().__init__(facility)
+        self.host = host
+        self.port = port
+        self.ttl_ms = ttl_ms
+        self._addr = None
+        self._sock = None
+        self._next_ms = utime.ticks_ms()
+        self._retry_ms = RETRY_MIN_MS
+        self._wake = asyncio.Event()
+        self.dropped = 0
+        self.failures = 0
+
+    @property
+    def connected(self):
+        return self._sock is not None
+
+    def log(self, severity, msg):
+        if self._sock is None:
+            self.dropped += 1
+            return
+        data = "<%d>%s" % (severity + (self._facility << 3), msg)
+        try:
+            self._sock.sendto(data.encode(), self._addr)
+        except OSError as e:
+            self.dropped += 1
+            # The send buffer is full or out of memory: only this message is lost, the server is still reachable
+            if e.args[0] not in (EAGAIN, ENOMEM):
+                self._fail()
+
+    def _retry_later(self):
+        self.failures += 1
+        self._next_ms = utime.ticks_add(utime.ticks_ms(), self._retry_ms)
+        self._retry_ms = min(self._retry_ms * 2, RETRY_MAX_MS)
+        self._wake.set()
+
+    def _fail(self):
+        self.close()
+        dnscache.forget(self.host, self.port)
+        self._retry_later()
+
+    def _connect(self):
+        try:
+            addr = dnscache.resolve(self.host, self.port, self.ttl_ms)
+            if self._sock is None:
+                self._sock = usocket.socket(usocket.AF_INET, usocket.SOCK_DGRAM)
+                self._sock.setblocking(False)
+        except OSError:
+            # If the name was resolved before, keep sending to the previous address until it resolves again
+            self._retry_later()
+            return
+        self._addr = addr
+        self._retry_ms = RETRY_MIN_MS
+        self._next_ms = None
+
+    def link_up(self):
+        """
+        Resolves the address right away, through the cache, as the network just came up
+        """
+        self._retry_ms = RETRY_MIN_MS
+        self._connect()
+        self._wake.set()
+
+    async def maintain(self):
+        while True:
+            self._wake.clear()
+            if self._next_ms is None:
+                # Nothing to do until a failure or link_up()
+                await self._wake.wait()
+                continue
+            delay = utime.ticks_diff(self._next_ms, utime.ticks_ms())
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay / 1000)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._connect()
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+        self._sock = None
+        self._addr = None
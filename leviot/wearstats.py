@@ -0,0 +1,118 @@
+from array import array
+
+import esp32
+import utime
+from micropython import const
+
+from leviot import ulog
+
+log = ulog.Logger("wearstats")
+
+# Persistence write counters, to check the flash wear estimate in leviot.persistence against what units actually do.
+# Counters are kept in RAM and checkpointed to their own NVS namespace every few hours, so they survive reboots without
+# adding noticeable wear themselves.
+
+WEAR_NAMESPACE = "LevIoTWear"
+
+## Per storage key counters: "W" (value writes) or "B" (flash bytes) followed by the key's position
+## Other counters
+COMMITS = "Commits"
+# Flash bytes that can't be attributed to a single key, such as sector headers
+OVERHEAD_BYTES = "Overhead"
+# Seconds of uptime covered by the counters
+COVERED_SECONDS = "Seconds"
+
+# Erase cycles each flash sector is rated for
+FLASH_ENDURANCE_CYCLES = const(10000)
+
+_SECONDS_PER_YEAR = const(365 * 24 * 60 * 60)
+
+
+class WearStats:
+    """
+    Counts writes per storage key, commits and flash bytes. A storage backend reports each value it programs into flash
+    with wrote() and each commit with committed().
+    """
+
+    def __init__(self, keys: tuple, erase_unit_bytes: int, sectors: int):
+        """
+        A sector is erased every erase_unit_bytes written, and writes are spread evenly across sectors
+        """
+        self.keys = keys
+        self.erase_unit_bytes = erase_unit_bytes
+        self.sectors = sectors
+        self.nvs = esp32.NVS(WEAR_NAMESPACE)
+
+        self.writes = array("I", [self._load("W{}".format(i)) for i in range(len(keys))])
+        self.bytes = array("I", [self._load("B{}".format(i)) for i in range(len(keys))])
+        self.overhead_bytes = self._load(OVERHEAD_BYTES)
+        self.commits = self._load(COMMITS)
+        self.seconds = self._load(COVERED_SECONDS)
+        self.last_checkpoint = utime.ticks_ms()
+
+    def _load(self, key: str) -> int:
+        try:
+            return self.nvs.get_i32(key)
+        except OSError:
+            return 0
+
+    def wrote(self, key: int, nbytes: int):
+        """
+        Reports nbytes programmed for the key at position key, or for no key in particular if it's None
+        """
+        if key is None:
+            self.overhead_bytes += nbytes
+        else:
+            self.writes[key] += 1
+            self.bytes[key] += nbytes
+
+    def committed(self):
+        self.commits += 1
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self.bytes) + self.overhead_bytes
+
+    @property
+    def covered_seconds(self) -> int:
+        return self.seconds + utime.ticks_diff(utime.ticks_ms(), self.last_checkpoint) // 1000
+
+    @property
+    def erases_per_sector(self) -> float:
+        return self.total_bytes / self.erase_unit_bytes / self.sectors
+
+    @property
+    def endurance_years(self) -> float:
+        """
+        Projected years until the flash sectors reach their rated erase cycles at the rate measured so far, -1 if
+        nothing has been written yet
+        """
+        erases = self.erases_per_sector
+        if erases <= 0:
+            return -1
+        remaining = FLASH_ENDURANCE_CYCLES - erases
+        return max(remaining, 0) / erases * self.covered_seconds / _SECONDS_PER_YEAR
+
+    def checkpoint(self):
+        now = utime.ticks_ms()
+        self.seconds += utime.ticks_diff(now, self.last_checkpoint) // 1000
+        self.last_checkpoint = now
+
+        for i in range(len(self.keys)):
+            self.nvs.set_i32("W{}".format(i), self.writes[i])
+            self.nvs.set_i32("B{}".format(i), self.bytes[i])
+        self.nvs.set_i32(OVERHEAD_BYTES, self.overhead_bytes)
+        self.nvs.set_i32(COMMITS, self.commits)
+        self.nvs.set_i32(COVERED_SECONDS, self.seconds)
+        self.nvs.commit()
+        log.d("Checkpointed wear stats, projected endurance {} years", self.endurance_years)
+
+    def as_dict(self) -> dict:
+        return {
+            "keys": {self.keys[i]: {"writes": self.writes[i], "bytes": self.bytes[i]} for i in range(len(self.keys))},
+            "overhead_bytes": self.overhead_bytes,
+            "commits": self.commits,
+            "seconds": self.covered_seconds,
+            "erases_per_sector": self.erases_per_sector,
+            "endurance_years": self.endurance_years,
+        }
@@ -1,9 +1,96 @@
 import os
+import struct
 
 import utime
 
 mock_tp_dir = "/tmp/cpytouch"
 
+# Touch trace being replayed, see load_trace()
+trace = None
+
+
+class TraceReader:
+    """
+    Loads a whole trace recorded by leviot.touchtrace.TraceWriter in memory. samples is a list of (dt_ms, values) where
+    values holds the raw and filtered readings of each pad interleaved, in pads order.
+
+    This can't use anything from the leviot package, since importing it sets up the touchpads, which must already
+    read from the trace.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+
+        magic, version, count = struct.unpack_from("<4sBB", data, 0)
+        if magic != b"LTTR" or version != 1:
+            raise ValueError("Not a touchpad trace or unsupported version: {}".format(path))
+        offset = struct.calcsize("<4sBB")
+
+        # List of (name, pin number) tuples
+        self.pads = []
+        for i in range(count):
+            pin, length = struct.unpack_from("<BB", data, offset)
+            offset += 2
+            self.pads.append((data[offset:offset + length].decode(), pin))
+            offset += length
+
+        fmt = "<H" + "H" * (2 * count)
+        # Drop a truncated last sample, in case the device was reset while recording
+        end = offset + (len(data) - offset) // struct.calcsize(fmt) * struct.calcsize(fmt)
+        self.samples = [(sample[0], sample[1:]) for sample in struct.iter_unpack(fmt, data[offset:end])]
+
+
+class TracePlayer:
+    """
+    Replays a trace recorded with TouchpadManager.start_trace(). Sample timing comes from the trace, so it runs on a
+    virtual clock and can go as fast as the filters can process samples.
+    """
+
+    def __init__(self, path):
+        self.reader = TraceReader(path)
+        if not self.reader.samples:
+            raise ValueError("Empty touch trace: {}".format(path))
+        self.pins = {pin: i for i, (name, pin) in enumerate(self.reader.pads)}
+        self.index = 0
+        self.clock_ms = 0
+
+    def __len__(self):
+        return len(self.reader.samples)
+
+    @property
+    def duration_ms(self):
+        return sum(dt for dt, _ in self.reader.samples)
+
+    def values(self, pin):
+        _, values = self.reader.samples[min(self.index, len(self) - 1)]
+        i = self.pins[pin]
+        return values[2 * i], values[2 * i + 1]
+
+    def advance(self) -> bool:
+        """
+        Moves to the next sample and advances the virtual clock. Returns False at the end of the trace.
+        """
+        if self.index + 1 >= len(self):
+            return False
+        self.index += 1
+        self.clock_ms += self.reader.samples[self.index][0]
+        return True
+
+    def ticks_ms(self):
+        return self.clock_ms
+
+
+def load_trace(path) -> TracePlayer:
+    """
+    Feed a recorded touch trace to machine.TouchPad instead of using marker files. Must be called before importing
+    leviot.touchpad.
+    """
+    global trace
+    trace = TracePlayer(path)
+    utime.ticks_ms = trace.ticks_ms
+    return trace
+
 
 class FakeTouchpad:
     def __init__(self, name, *a):
@@ -26,6 +113,11 @@ class FakeTouchpad:
     def acknowledged(self) -> bool:
         return False
 
+    @property
+    def state(self):
+        self.update(False)
+        return os.path.exists(self.fpath) and 3 or 0
+
     def read(self):
         self.update(False)
         return (
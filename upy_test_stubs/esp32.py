@@ -41,6 +41,8 @@ class NVS:
     def set_i32(self, key, value):
         if len(key) > 15:
             raise OSError("NVS key too long")
+        if not -0x80000000 <= value <= 0x7fffffff:
+            raise OverflowError("overflow converting long int to machine word")
         print(f"NVS set i32 [{self.ns}] {key}={value}")
         self.transaction[key] = value
         self.nvs[key] = value
@@ -53,6 +55,29 @@ class NVS:
             raise OSError
         return v
 
+    def set_blob(self, key, value):
+        if len(key) > 15:
+            raise OSError("NVS key too long")
+        print(f"NVS set blob [{self.ns}] {key}={bytes(value).hex()}")
+        self.transaction[key] = bytes(value)
+        self.nvs[key] = bytes(value)
+
+    def get_blob(self, key, buffer):
+        if len(key) > 15:
+            raise OSError("NVS key too long")
+        v = self.nvs.get(key, None)
+        if not isinstance(v, bytes) or len(v) > len(buffer):
+            raise OSError
+        buffer[:len(v)] = v
+        return len(v)
+
+    def erase_key(self, key):
+        print(f"NVS erase [{self.ns}] {key}")
+        if key not in self.nvs:
+            raise OSError
+        self.transaction[key] = None
+        del self.nvs[key]
+
     def commit(self):
         print(f"NVS commit {self.ns}")
 
@@ -63,3 +88,62 @@ class NVS:
             history[datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")] = self.transaction
             shelf["history"] = history
             self.transaction = {}
+
+
+class Partition:
+    """
+    Raw flash partition backed by a file. Programming can only clear bits, like NOR flash, and erases are counted per
+    block so flash wear can be measured.
+    """
+    TYPE_APP = 0
+    TYPE_DATA = 1
+
+    BLOCK_SIZE = 4096
+    # Size of the partitions that can be found, by label
+    sizes = {"nvs": 0x6000, "journal": 64 * 1024}
+
+    def __init__(self, label, size, path=None):
+        self.label = label
+        self.path = path
+        self.data = bytearray(b"\xff" * size)
+        self.erases = [0] * (size // self.BLOCK_SIZE)
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                self.data[:] = f.read()[:size].ljust(size, b"\xff")
+
+    @classmethod
+    def find(cls, type=TYPE_APP, subtype=0xff, label=None):
+        if type != cls.TYPE_DATA or label not in cls.sizes:
+            return []
+        return [cls(label, cls.sizes[label], os.path.join(tempfile.gettempdir(), label + ".partition"))]
+
+    def _save(self):
+        if self.path:
+            with open(self.path, "wb") as f:
+                f.write(self.data)
+
+    def readblocks(self, block, buf, offset=0):
+        start = block * self.BLOCK_SIZE + offset
+        buf[:] = self.data[start:start + len(buf)]
+
+    def writeblocks(self, block, buf, offset=None):
+        if offset is None:
+            self.ioctl(6, block)
+            offset = 0
+        start = block * self.BLOCK_SIZE + offset
+        for i, b in enumerate(buf):
+            self.data[start + i] &= b
+        self._save()
+
+    def ioctl(self, op, arg):
+        if op == 4:
+            return len(self.data) // self.BLOCK_SIZE
+        if op == 5:
+            return self.BLOCK_SIZE
+        if op == 6:
+            start = arg * self.BLOCK_SIZE
+            self.data[start:start + self.BLOCK_SIZE] = b"\xff" * self.BLOCK_SIZE
+            self.erases[arg] += 1
+            self._save()
+            return 0
+        return None
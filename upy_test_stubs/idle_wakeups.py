@@ -0,0 +1,130 @@
+"""
+Counts how often the timer service wakes the event loop on an idle device, powered on and off, over simulated hours,
+and the CPU time spent doing so. The current deadline-driven persistence tracking and backing-off Wi-Fi check are
+compared with what they replaced: tracking the persistence state and checking the Wi-Fi link every second.
+
+Run from the main project directory:
+
+    PYTHONPATH="$(pwd):$(pwd)/upy_test_stubs" python upy_test_stubs/idle_wakeups.py [HOURS]
+
+The device is in station mode with the link up. CPU time is measured on the host running the simulation, so only the
+ratio between both is meaningful; it includes the simulated event loop's own overhead for each wakeup. The time spent
+committing to NVS, once a minute while on either way and slow with the stubs, is left out and reported as a count.
+"""
+import asyncio
+import contextlib
+import os
+import sys
+import time
+
+import simclock
+
+
+clock = simclock.SimClock()
+
+
+def poll_track():
+    # Persistence.track() as it was called every second, without scheduling its next run
+    from leviot.persistence import persistence, LIFETIME_UPDATE_INTERVAL_SEC
+    from leviot.state import state_tracker
+    changed = persistence._persist_settings()
+    if state_tracker.power and clock.time() - persistence.last_update >= LIFETIME_UPDATE_INTERVAL_SEC:
+        persistence._persist_lifetime()
+        changed = True
+    if changed:
+        persistence.stats()
+        persistence._commit()
+
+
+def poll_wifi():
+    # The Wi-Fi check as it was called every second
+    from leviot import network
+    network.get_wlan().isconnected()
+
+
+async def simulate(polling, power, hours):
+    from leviot import constants, network
+    from leviot.persistence import persistence
+    from leviot.state import state_tracker
+    from leviot.timers import timer_service
+
+    timer_service.timers.clear()
+    timer_service.wakeups = 0
+    timer_service.fired = 0
+    state_tracker.power = power
+    persistence._track_timer = None
+    persistence.last_update = clock.time()
+    persistence._last_persist_settings_time = clock.time() - 10
+    timer_service.call_every(constants.WEAR_CHECKPOINT_INTERVAL_MS, persistence.wear.checkpoint)
+
+    commits = [0, 0]
+    commit = type(persistence)._commit
+
+    def timed_commit():
+        start = time.process_time()
+        commit(persistence)
+        commits[0] += 1
+        commits[1] += time.process_time() - start
+
+    persistence._commit = timed_commit
+
+    if polling:
+        timer_service.call_every(1000, poll_track)
+        timer_service.call_every(1000, poll_wifi)
+    else:
+        persistence._schedule_next()
+        await network.ensure_up()
+
+    cpu = time.process_time()
+    await clock.run(timer_service, hours * 60 * 60 * 1000)
+    cpu = time.process_time() - cpu - commits[1]
+    del persistence._commit
+    return timer_service.wakeups / hours, timer_service.fired / hours, commits[0] / hours, cpu * 1000 / hours
+
+
+def main(hours):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        from leviot import conf, constants, network
+        from leviot.timers import timer_service
+        conf.mqtt_enabled = False
+        conf.wifi_mode = "sta"
+        conf.ntp_host = None
+        # The stub link comes up after a few checks
+        network.get_wlan().conncheck_count = 100
+        clock.install(timer_service)
+
+        results = {}
+        for polling in (True, False):
+            for power in (True, False):
+                results[polling, power] = asyncio.run(simulate(polling, power, hours))
+
+    print("{} simulated hours per run, station mode, link up".format(hours))
+    print()
+    print("{:10} {:6} {:>14} {:>16} {:>14} {:>14}".format("tracking", "power", "wakeups/hour", "callbacks/hour",
+                                                         "commits/hour", "CPU ms/hour"))
+    for (polling, power), (wakeups, fired, commits, cpu_ms) in results.items():
+        print("{:10} {:6} {:>14.0f} {:>16.0f} {:>14.0f} {:>14.1f}".format(
+            "1 s poll" if polling else "deadlines", "on" if power else "off", wakeups, fired, commits, cpu_ms))
+    print()
+
+    failures = []
+    for power in (True, False):
+        before = results[True, power][0]
+        after = results[False, power][0]
+        # Lifetime updates every minute when on, and a Wi-Fi check at most every minute
+        expected = (2 if power else 1) * 60 * 60 * 1000 // constants.WIFI_CHECK_MAX_INTERVAL_MS + 5
+        if after > expected:
+            failures.append("{} wakeups/hour while {}, expected at most {}".format(after, "on" if power else "off",
+                                                                              expected))
+        if after >= before:
+            failures.append("no fewer wakeups than polling while {}".format("on" if power else "off"))
+    for failure in failures:
+        print("FAIL: " + failure)
+    if failures:
+        sys.exit(1)
+    print("OK: the idle device wakes up {:.0f}x less often when on and {:.0f}x less often when off".format(
+        results[True, True][0] / results[False, True][0], results[True, False][0] / results[False, False][0]))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 24)
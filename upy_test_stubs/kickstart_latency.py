@@ -0,0 +1,168 @@
+"""
+Measures how long commands submitted during a fan kickstart take to be applied, and checks the speed the kickstart
+ends at.
+
+Run from the main project directory:
+
+    PYTHONPATH="$(pwd):$(pwd)/upy_test_stubs" python upy_test_stubs/kickstart_latency.py
+
+Each latency run powers the fan on, then DELAY_MS into the kickstart submits a speed change followed by one command
+of another kind, and times that command from submission until its effect shows in the state. The speed change only
+updates the kickstart's final speed, so the other command should be applied after the usual COMMAND_COALESCE_MS
+instead of waiting for the kickstart to end.
+
+The end state runs power the fan on from speed 1, previous speed 2, in the ways the controller can be driven and check
+the final speed and previous speed.
+"""
+import asyncio
+import contextlib
+import os
+import sys
+
+import utime
+
+DELAY_MS = 10
+# Allowed on top of COMMAND_COALESCE_MS
+MARGIN_MS = 50
+
+
+class FakePad:
+    event_start = 0
+
+    def __init__(self, name):
+        self.name = name
+
+    def ack(self):
+        pass
+
+
+def reset_state():
+    from leviot.state import state_tracker
+    state_tracker.power = False
+    state_tracker.lock = False
+    state_tracker.lights = True
+    state_tracker.speed = 1
+    state_tracker.prev_speed = 2
+    state_tracker.timer_left = 0
+
+
+async def start(leviot):
+    from leviot.state import Command
+    leviot.submit(Command.POWER, True, "mqtt")
+    while not leviot.is_kickstarting:
+        await asyncio.sleep(0.001)
+    await asyncio.sleep(DELAY_MS / 1000)
+
+
+async def measure(kind, value, applied):
+    from leviot import constants
+    from leviot.controller import LevIoT
+    from leviot.state import state_tracker, Command
+
+    reset_state()
+    leviot = LevIoT()
+    task = asyncio.get_event_loop().create_task(leviot.command_loop())
+    await start(leviot)
+
+    leviot.submit(Command.SPEED, 2, "mqtt")
+    submitted = utime.ticks_ms()
+    leviot.submit(kind, value, "mqtt")
+    while not applied(state_tracker):
+        if utime.ticks_diff(utime.ticks_ms(), submitted) > 2 * constants.KICKSTART_MS:
+            break
+        await asyncio.sleep(0.001)
+    latency = utime.ticks_diff(utime.ticks_ms(), submitted)
+    kickstarting = leviot.is_kickstarting
+
+    await leviot.kickstart_done.wait()
+    await asyncio.sleep(2 * constants.COMMAND_COALESCE_MS / 1000)
+    task.cancel()
+    return latency, kickstarting
+
+
+async def end_state(drive):
+    from leviot import constants
+    from leviot.controller import LevIoT
+    from leviot.state import state_tracker, Command
+
+    reset_state()
+    leviot = LevIoT()
+    task = asyncio.get_event_loop().create_task(leviot.command_loop())
+    await drive(leviot, Command)
+    await asyncio.sleep(constants.COMMAND_COALESCE_MS / 1000)
+    await leviot.kickstart_done.wait()
+    await asyncio.sleep(2 * constants.COMMAND_COALESCE_MS / 1000)
+    task.cancel()
+    return state_tracker.speed, state_tracker.prev_speed
+
+
+async def schedule(leviot, Command):
+    leviot.on_schedule(True, 3)
+
+
+async def mqtt(leviot, Command):
+    leviot.submit(Command.POWER, True, "mqtt")
+    leviot.submit(Command.SPEED, 2, "mqtt")
+
+
+async def direct(leviot, Command):
+    await leviot.set_power(True, "mqtt")
+    await leviot.set_fan_speed(2, "mqtt")
+
+
+async def night_taps(leviot, Command):
+    from leviot.touchpad import TouchEvent
+    await start(leviot)
+    await leviot.on_touch_event(TouchEvent.PRESS, FakePad("NIGHT"))
+    await leviot.on_touch_event(TouchEvent.PRESS, FakePad("NIGHT"))
+
+
+def main():
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        from leviot import conf, constants
+        from leviot.state import Command
+        conf.mqtt_enabled = False
+
+    commands = (
+        ("lights off", Command.LIGHTS, False, lambda state: not state.lights),
+        ("timer 120", Command.TIMER, 120, lambda state: state.timer_left == 120),
+        ("lock", Command.LOCK, True, lambda state: state.lock),
+        ("power off", Command.POWER, False, lambda state: not state.power),
+    )
+    scenarios = (
+        ("schedule on at 3", schedule, (3, 1)),
+        ("MQTT on, speed 2", mqtt, (2, 1)),
+        ("direct on, speed 2", direct, (2, 1)),
+        ("2 NIGHT taps", night_taps, (1, 0)),
+    )
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        latencies = [asyncio.run(measure(kind, value, applied)) for _, kind, value, applied in commands]
+        states = [asyncio.run(end_state(drive)) for _, drive, _ in scenarios]
+
+    limit = constants.COMMAND_COALESCE_MS + MARGIN_MS
+    print("Kickstart {} ms, at least {} ms, commands coalesced for {} ms".format(
+        constants.KICKSTART_MS, constants.KICKSTART_MIN_MS, constants.COMMAND_COALESCE_MS))
+    print()
+    print("{:22} {:>12} {:>22}".format("after speed 2", "latency ms", "applied in kickstart"))
+    failures = 0
+    for (name, _, _, _), (latency, kickstarting) in zip(commands, latencies):
+        print("{:22} {:>12} {:>22}".format(name, latency, "yes" if kickstarting else "no"))
+        if latency > limit:
+            failures += 1
+    print()
+    print("{:22} {:>12} {:>12}".format("end state", "speed/prev", "expected"))
+    for (name, _, expected), actual in zip(scenarios, states):
+        print("{:22} {:>12} {:>12}".format(name, "{}/{}".format(*actual), "{}/{}".format(*expected)))
+        if actual != expected:
+            failures += 1
+    print()
+
+    if failures:
+        print("FAIL: {} commands took over {} ms or kickstarts ended in the wrong state".format(failures, limit))
+        sys.exit(1)
+    print("OK: commands don't wait for the kickstart, which ends at the requested speed")
+
+
+if __name__ == "__main__":
+    main()
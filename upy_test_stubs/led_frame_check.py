@@ -0,0 +1,150 @@
+"""
+Checks that LevIoT.update_leds(), which builds the shift register LED word with led_frame(), stages the same LEDs as the
+previous implementation setting each LED with its own gpio.value() call, then times both.
+
+Run from the main project directory:
+
+    PYTHONPATH="$(pwd):$(pwd)/upy_test_stubs" python upy_test_stubs/led_frame_check.py [CALLS]
+
+Every combination of power, speed, lock, lights, cause and filter maintenance flags is checked, with timer values at
+the edges of each 2-hour bucket, starting from several staged words including fan control bits.
+"""
+import contextlib
+import itertools
+import os
+import sys
+import time
+
+TIMER_VALUES = (0, 1, 2, 119, 120, 121, 239, 240, 241, 359, 360, 361, 479, 480, 481, 600, 0xffff)
+CAUSES = ("touchpad", "kickstart", "mqtt")
+INITIAL_WORDS = (0, 0xffff, 0b1010101010101010, 0b0000000000001111)
+
+
+class Controller:
+    """
+    Stands in for LevIoT: update_leds() only needs _led_feedback()
+    """
+
+    async def _led_feedback(self):
+        pass
+
+
+def run(coro):
+    # Neither implementation suspends with the _led_feedback() above
+    try:
+        coro.send(None)
+    except StopIteration:
+        pass
+
+
+# update_leds() before the LED frame was computed from mask tables
+async def update_leds_reference(self, cause="unknown"):
+    from leviot import constants
+    from leviot.extgpio import gpio
+    from leviot.persistence import persistence
+    from leviot.state import state_tracker
+
+    if cause not in ("touchpad", "kickstart") and not state_tracker.lights:
+        gpio.leds(False)
+    else:
+        gpio.value(constants.LED_POWER, state_tracker.power)
+        # Provide feedback on poweroff when lights are off
+        if cause in ("touchpad", "kickstart") and not state_tracker.power and not state_tracker.lights:
+            gpio.on(constants.LED_POWER)
+
+        gpio.value(constants.LED_FAN, state_tracker.speed > 0 and state_tracker.power)
+
+        gpio.value(constants.LED_NIGHT, state_tracker.speed == 0 and state_tracker.power)
+        gpio.value(constants.LED_V1, state_tracker.speed == 1 and state_tracker.power)
+        gpio.value(constants.LED_V2, state_tracker.speed == 2 and state_tracker.power)
+        gpio.value(constants.LED_V3, state_tracker.speed == 3 and state_tracker.power)
+
+        gpio.value(constants.LED_TIMER, state_tracker.timer_left > 0)
+        gpio.value(constants.LED_2H, 0 < state_tracker.timer_left <= 2 * 60)
+        gpio.value(constants.LED_4H, 2 * 60 < state_tracker.timer_left <= 4 * 60)
+        gpio.value(constants.LED_6H, 4 * 60 < state_tracker.timer_left <= 6 * 60)
+        gpio.value(constants.LED_8H, 6 * 60 < state_tracker.timer_left)
+
+        if persistence.replacement_due or state_tracker.user_maint:
+            gpio.value(constants.LED_FILTER, "blink")
+        else:
+            gpio.value(constants.LED_FILTER, persistence.dusting_due)
+
+        if cause in ("touchpad", "kickstart") and not state_tracker.lights:
+            await self._led_feedback()
+
+    gpio.value(constants.LED_LOCK, state_tracker.lock and state_tracker.power)
+
+
+def staged(gpio, update_leds, controller, cause, word):
+    gpio.sr_staging = word
+    gpio.filter_led_staging = None
+    run(update_leds(controller, cause))
+    return gpio.sr_staging, gpio.filter_led_staging
+
+
+def bench(update_leds, controller, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        run(update_leds(controller, "mqtt"))
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main(calls):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        from leviot.controller import LevIoT
+        from leviot.extgpio import gpio
+        from leviot.persistence import Persistence
+        from leviot.state import state_tracker
+
+    # Only the LEDs are under test
+    state_tracker._subscribers = []
+    due = {"dusting": False, "replacement": False}
+    Persistence.dusting_due = property(lambda self: due["dusting"])
+    Persistence.replacement_due = property(lambda self: due["replacement"])
+
+    controller = Controller()
+    checked = 0
+    mismatches = 0
+    for power, speed, lock, lights, user_maint, dusting, replacement, timer_left, cause, word in itertools.product(
+            (False, True), range(4), (False, True), (False, True), (False, True), (False, True), (False, True),
+            TIMER_VALUES, CAUSES, INITIAL_WORDS):
+        state_tracker.power = power
+        state_tracker.speed = speed
+        state_tracker.lock = lock
+        state_tracker.lights = lights
+        state_tracker.user_maint = user_maint
+        state_tracker.timer_left = timer_left
+        due["dusting"] = dusting
+        due["replacement"] = replacement
+
+        expected = staged(gpio, update_leds_reference, controller, cause, word)
+        actual = staged(gpio, LevIoT.update_leds, controller, cause, word)
+        checked += 1
+        if actual != expected:
+            mismatches += 1
+            if mismatches <= 10:
+                print("Mismatch: power={} speed={} lock={} lights={} timer_left={} cause={} word={:#06x}: "
+                      "staged {:#06x}/{}, expected {:#06x}/{}".format(power, speed, lock, lights, timer_left, cause,
+                                                                     word, actual[0], actual[1], expected[0],
+                                                                     expected[1]))
+
+    state_tracker.power = True
+    state_tracker.lights = True
+    state_tracker.speed = 2
+    state_tracker.timer_left = 300
+    reference_us = bench(update_leds_reference, controller, calls)
+    frame_us = bench(LevIoT.update_leds, controller, calls)
+    print("{:12} {:>16}".format("update_leds", "us per call"))
+    print("{:12} {:>16.2f}".format("per LED", reference_us))
+    print("{:12} {:>16.2f}".format("led_frame", frame_us))
+    print()
+
+    if mismatches:
+        print("FAIL: {} of {} states staged different LEDs".format(mismatches, checked))
+        sys.exit(1)
+    print("OK: led_frame() stages the same LEDs as before in all {} states".format(checked))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,47 @@
+"""
+Measures the cost of log calls that are suppressed by the log level, compared with calls that are logged.
+
+Run from the main project directory:
+
+    PYTHONPATH="$(pwd):$(pwd)/upy_test_stubs" python upy_test_stubs/log_bench.py [CALLS]
+
+Logged messages are printed to /dev/null and syslog is disabled, so they only show the cost of formatting and printing.
+"""
+import contextlib
+import os
+import sys
+import time
+
+
+def bench(calls, fn):
+    start = time.perf_counter()
+    for i in range(calls):
+        fn(i)
+    return (time.perf_counter() - start) / calls * 1e9
+
+
+def main(calls):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        from leviot import conf, ulog
+    conf.syslog = None
+    log = ulog.Logger("bench")
+
+    cases = (
+        ("lazy args", lambda i: log.d("Value {} of {}", i, calls)),
+        ("eager format", lambda i: log.d("Value {} of {}".format(i, calls))),
+        ("constant", lambda i: log.d("Persistence._persist_lifetime()")),
+    )
+
+    print("{:14} {:>16} {:>16}".format("call", "suppressed ns", "logged ns"))
+    for name, fn in cases:
+        ulog.set_levels("info")
+        suppressed = bench(calls, fn)
+        ulog.set_levels("debug")
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            logged = bench(calls, fn)
+        print("{:14} {:>16.0f} {:>16.0f}".format(name, suppressed, logged))
+    ulog.set_levels(conf.log_level)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,99 @@
+"""
+Floods the logger and compares heap usage of the log shipper with spawning one MQTT publish task per line, like
+MQTTController.log used to do.
+
+Run from the main project directory:
+
+    PYTHONPATH="$(pwd):$(pwd)/upy_test_stubs" python upy_test_stubs/log_storm.py [LINES] [PUBLISH_MS]
+
+MQTT publishes are simulated: they are serialized by a lock like in mqtt_as and take PUBLISH_MS each. Heap usage is
+measured with tracemalloc, so absolute numbers are CPython's, not MicroPython's.
+"""
+import asyncio
+import contextlib
+import os
+import sys
+import tracemalloc
+
+BURST_LINES = 100
+
+
+class FakeMQTT:
+    def __init__(self, publish_ms):
+        self.publish_ms = publish_ms
+        self.lock = asyncio.Lock()
+        self.publishes = 0
+        self.lines = 0
+
+    async def log_async(self, message):
+        async with self.lock:
+            await asyncio.sleep(self.publish_ms / 1000)
+            self.publishes += 1
+            self.lines += message.count("\n") + 1
+
+
+async def storm(lines, emit):
+    for i in range(lines):
+        emit(i)
+        if i % BURST_LINES == BURST_LINES - 1:
+            await asyncio.sleep(0)
+
+
+async def run_tasks(lines, mqtt):
+    tasks = set()
+
+    def emit(i):
+        task = asyncio.get_event_loop().create_task(mqtt.log_async("INFO  storm: line {} of a log storm".format(i)))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    await storm(lines, emit)
+    queued = len(tasks)
+    _, peak = tracemalloc.get_traced_memory()
+    await asyncio.gather(*tasks)
+    return queued, peak, 0
+
+
+async def run_shipper(lines, mqtt):
+    from leviot import ulog
+    log = ulog.Logger("storm")
+    ulog.set_mqtt(mqtt)
+    shipper_task = asyncio.get_event_loop().create_task(ulog.shipper.run())
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        await storm(lines, lambda i: log.i("line {} of a log storm", i))
+    queued = ulog.shipper.depth
+    _, peak = tracemalloc.get_traced_memory()
+    while ulog.shipper.depth:
+        await asyncio.sleep(0.01)
+    shipper_task.cancel()
+    return queued, peak, ulog.shipper
+
+
+def measure(name, run, lines, publish_ms):
+    mqtt = FakeMQTT(publish_ms)
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    queued, peak, shipper = asyncio.run(run(lines, mqtt))
+    tracemalloc.stop()
+    print("{:8} {:>14} {:>14} {:>10} {:>14}".format(name, queued, (peak - base) // 1024, mqtt.publishes, mqtt.lines))
+    return shipper
+
+
+def main(lines, publish_ms):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        from leviot import conf, ulog
+    conf.syslog = None
+    ulog.set_levels("info")
+
+    print("{} lines in bursts of {}, {} ms per publish".format(lines, BURST_LINES, publish_ms))
+    print()
+    print("{:8} {:>14} {:>14} {:>10} {:>14}".format("method", "queued", "peak heap KB", "publishes", "lines shipped"))
+    measure("tasks", run_tasks, lines, publish_ms)
+    shipper = measure("shipper", run_shipper, lines, publish_ms)
+    print()
+    print("Shipper counters: {}".format(shipper.as_dict()))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000, float(sys.argv[2]) if len(sys.argv) > 2 else 20)
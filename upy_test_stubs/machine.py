@@ -45,6 +45,26 @@ class PWM:
         pass
 
 
+class SPI:
+    MSB = 0
+    LSB = 1
+
+    def __init__(self, id, **kwargs):
+        self.id = id
+        self.init(**kwargs)
+
+    def init(self, **kwargs):
+        #print(f"STUB: machine.SPI({self.id}).init({kwargs})")
+        self.kwargs = kwargs
+
+    def deinit(self):
+        print(f"STUB: machine.SPI({self.id}).deinit()")
+
+    def write(self, buf):
+        #print(f"STUB: machine.SPI({self.id}).write({bytes(buf)})")
+        return None
+
+
 class UART:
     def __init__(self, *a):
         pass
@@ -59,11 +79,18 @@ class UART:
 class TouchPad:
     def __init__(self, pin: Pin):
         print(f"STUB: machine.TouchPad({pin})")
+        self.pin = pin.args[0]
 
     def read(self):
+        import cpytouchpad
+        if cpytouchpad.trace is not None:
+            return cpytouchpad.trace.values(self.pin)[0]
         return 10000
 
     def read_filtered(self):
+        import cpytouchpad
+        if cpytouchpad.trace is not None:
+            return cpytouchpad.trace.values(self.pin)[1]
         return 10000
 
 
@@ -0,0 +1,5 @@
+host = "pool.ntp.org"
+
+
+def settime():
+    print(f"STUB ntptime.settime() from {host}")
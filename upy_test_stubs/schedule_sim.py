@@ -0,0 +1,82 @@
+"""
+Runs a weekly schedule for a whole year in virtual time and checks every transition against a minute-by-minute
+evaluation of the rules.
+
+Run from the main project directory:
+
+    PYTHONPATH="$(pwd):$(pwd)/upy_test_stubs" python upy_test_stubs/schedule_sim.py [RULES] [UTC_OFFSET_MIN]
+"""
+import contextlib
+import os
+import sys
+import time
+
+import utime
+
+DEFAULT_RULES = "mon-fri@08:30=on,mon-fri@08:30=3,mon-fri@18:00=1,*@23:00=0,sat+sun@10:00=on,fri-sun@01:00=off"
+
+YEAR_SEC = 365 * 24 * 60 * 60
+
+# Saturday 2021-03-27 00:00 UTC
+START = 1616803200
+
+
+def main(rules, utc_offset_min):
+    now = [START]
+    utime.time = lambda: now[0]
+    utime.ticks_ms = lambda: now[0] * 1000
+    utime.localtime = time.gmtime
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        from leviot import conf
+        from leviot.schedule import Scheduler, compile_rules, decode_action, MINUTES_PER_DAY
+        from leviot.timers import timer_service
+
+    conf.schedule_utc_offset_min = utc_offset_min
+    minutes, actions = compile_rules(rules)
+    table = dict(zip(minutes, actions))
+
+    # A transition due right when the scheduler starts is considered past
+    expected = []
+    for t in range(START + 60, START + YEAR_SEC, 60):
+        local = time.gmtime(t + utc_offset_min * 60)
+        minute = local.tm_wday * MINUTES_PER_DAY + local.tm_hour * 60 + local.tm_min
+        if minute in table:
+            expected.append((t, decode_action(table[minute])))
+
+    applied = []
+    scheduler = Scheduler()
+    timer_service.timers.clear()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        scheduler.load(rules, save=False)
+        scheduler.start(lambda power, speed: applied.append((now[0], (power, speed))))
+        if timer_service.timers:
+            print("FAIL: the schedule was armed before the clock was set", file=sys.__stdout__)
+            sys.exit(1)
+        scheduler.clock_changed()
+
+        wakeups = 0
+        start = time.perf_counter()
+        while timer_service.timers and timer_service.timers[0].deadline < (START + YEAR_SEC) * 1000:
+            timer = timer_service.timers.pop(0)
+            now[0] = timer.deadline // 1000
+            wakeups += 1
+            timer_service._fire(timer)
+        elapsed = time.perf_counter() - start
+
+    print("Schedule: {}".format(scheduler.rules))
+    print("{} transitions per week, {} applied in a year".format(len(minutes), len(applied)))
+    print("Wakeups: {} ({:.1f}/day), simulated in {:.3f} s".format(wakeups, wakeups / 365, elapsed))
+
+    if applied != expected:
+        for a, e in zip(applied, expected):
+            if a != e:
+                print("MISMATCH: applied {} expected {}".format(a, e))
+                break
+        print("FAIL: {} applied, {} expected".format(len(applied), len(expected)))
+        sys.exit(1)
+    print("OK: every transition applied at the right minute")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_RULES, int(sys.argv[2]) if len(sys.argv) > 2 else 0)
@@ -0,0 +1,77 @@
+"""
+Simulated clock to run the timer service faster than real time, used by the timer scripts.
+
+install() makes utime.ticks_ms() and the persistence clock read the simulated time, and replaces the uasyncio module
+seen by leviot.timers so that TimerService.run() waiting for its next deadline advances the clock instead of sleeping.
+Everything else runs on the real event loop, in zero simulated time unless the caller advances the clock.
+"""
+import asyncio
+import random
+
+import utime
+
+# Simulated time starts at this UNIX time, in seconds
+START_TIME = 1700000000
+
+
+class SimAsyncio:
+    """
+    Stands in for uasyncio in leviot.timers: wait_for() lets other tasks run, then moves the clock to the end of the
+    timeout, plus up to jitter_ms late, unless the service was woken up meanwhile
+    """
+
+    def __init__(self, clock, service):
+        self.clock = clock
+        self.service = service
+
+    def __getattr__(self, name):
+        return getattr(asyncio, name)
+
+    async def wait_for(self, awaitable, timeout):
+        awaitable.close()
+        # Tasks created by fired coroutine callbacks run here
+        for _ in range(3):
+            await asyncio.sleep(0)
+        if self.service.wake.is_set():
+            return
+        self.clock.advance(int(timeout * 1000) + self.clock.jitter())
+        if self.clock.ms >= self.clock.end_ms:
+            raise asyncio.CancelledError()
+        raise asyncio.TimeoutError()
+
+
+class SimClock:
+    def __init__(self, jitter_ms=0, seed=1):
+        self.ms = 0
+        self.end_ms = 0
+        self.jitter_ms = jitter_ms
+        self.rand = random.Random(seed)
+
+    def ticks_ms(self):
+        return self.ms
+
+    def time(self):
+        return START_TIME + self.ms // 1000
+
+    def advance(self, ms):
+        self.ms += ms
+
+    def jitter(self):
+        return self.rand.randint(0, self.jitter_ms) if self.jitter_ms else 0
+
+    def install(self, service):
+        import leviot.persistence
+        import leviot.timers
+        utime.ticks_ms = self.ticks_ms
+        leviot.persistence.time = self.time
+        leviot.timers.uasyncio = SimAsyncio(self, service)
+
+    async def run(self, service, duration_ms):
+        """
+        Runs the service until duration_ms of simulated time have passed
+        """
+        self.end_ms = self.ms + duration_ms
+        try:
+            await service.run()
+        except asyncio.CancelledError:
+            pass
@@ -0,0 +1,127 @@
+"""
+Compares the shift register backends: checks that the SPI backend shifts out the same bit sequence as bit-banging, then
+times a full latch (GPIOManager.commit()) with each of them. The filter LED breathing loop run by the same manager is
+also played for BLINK_S simulated seconds, counting how many times it wakes the event loop, against the previous loop
+stepping the PWM duty by 1 every 2 ms.
+
+Run from the main project directory:
+
+    PYTHONPATH="$(pwd):$(pwd)/upy_test_stubs" python upy_test_stubs/sr_bench.py [COMMITS] [BLINK_S]
+
+It can also be copied to the device and run from the REPL (import sr_bench; sr_bench.main(1000)), which gives the
+actual latch times: on CPython the pins are stubs, so only the Python overhead of each backend is measured.
+"""
+import sys
+
+import uasyncio
+import utime
+
+
+def bitbang_bits(word):
+    # BitBangSRBackend shifts bit 0 out first
+    return [(word >> bit) & 1 for bit in range(16)]
+
+
+def spi_bits(buf):
+    # SPI sends each byte most significant bit first
+    return [(byte >> (7 - bit)) & 1 for byte in buf for bit in range(8)]
+
+
+def check_bit_order(backend):
+    for word in range(1 << 16):
+        backend.buf[0] = 0
+        backend.buf[1] = 0
+        sent = []
+        backend.spi.write = lambda buf: sent.extend(spi_bits(buf))
+        backend.write(word)
+        if sent != bitbang_bits(word):
+            print("FAIL: SPI backend sends {} for word {:#06x}, expected {}".format(sent, word, bitbang_bits(word)))
+            sys.exit(1)
+
+
+def bench(gpio, backend, commits):
+    gpio.sr_backend = backend
+    start = utime.ticks_us()
+    for i in range(commits):
+        gpio.sr_staging = i & 0xffff
+        gpio.commit()
+    return utime.ticks_diff(utime.ticks_us(), start) / commits
+
+
+class SleepCounter:
+    """
+    Replaces uasyncio.sleep_ms(): advances a simulated clock instead of sleeping, and stops the blink loop by clearing
+    the filter LED state once the clock reaches end_ms
+    """
+
+    def __init__(self, gpio, end_ms):
+        self.gpio = gpio
+        self.end_ms = end_ms
+        self.clock_ms = 0
+        self.wakeups = 0
+
+    async def sleep_ms(self, ms):
+        self.clock_ms += ms
+        self.wakeups += 1
+        if self.clock_ms >= self.end_ms:
+            self.gpio.filter_led_cur = False
+
+
+# blink_loop() before the duty table
+async def blink_loop_reference(self):
+    from machine import PWM
+    pwm = PWM(self.s_filter_led)
+    increment = 1
+    duty = 0
+    while self.filter_led_cur == "blink":
+        while self.filter_led_cur == "blink" and 0 <= duty <= 1023:
+            pwm.duty(duty)
+            duty += increment
+            await uasyncio.sleep_ms(2)
+        increment *= -1
+        duty += increment
+    pwm.deinit()
+    self.s_filter_led.value(self.filter_led_cur)
+
+
+def blink_wakeups(gpio, blink_loop, seconds):
+    counter = SleepCounter(gpio, seconds * 1000)
+    sleep_ms = uasyncio.sleep_ms
+    uasyncio.sleep_ms = counter.sleep_ms
+    gpio.filter_led_cur = "blink"
+    try:
+        # The loop never suspends with the sleep above, it returns once the simulated time is up
+        blink_loop(gpio).send(None)
+    except StopIteration:
+        pass
+    finally:
+        uasyncio.sleep_ms = sleep_ms
+    return counter.wakeups / seconds
+
+
+def main(commits, blink_s):
+    from leviot.extgpio import gpio, BitBangSRBackend, SPISRBackend, GPIOManager
+
+    spi = SPISRBackend()
+    if sys.implementation.name != "micropython":
+        check_bit_order(SPISRBackend())
+        print("OK: the SPI backend shifts out the same bits as bit-banging for all 65536 words")
+
+    bitbang_us = bench(gpio, BitBangSRBackend(), commits)
+    spi_us = bench(gpio, spi, commits)
+    print("{:10} {:>14}".format("backend", "us per latch"))
+    print("{:10} {:>14.1f}".format("bitbang", bitbang_us))
+    print("{:10} {:>14.1f}".format("spi", spi_us))
+    print("SPI latch is {:.1f}x faster".format(bitbang_us / spi_us))
+    print()
+
+    reference_wps = blink_wakeups(gpio, blink_loop_reference, blink_s)
+    table_wps = blink_wakeups(gpio, GPIOManager.blink_loop, blink_s)
+    print("{:10} {:>14}".format("blink loop", "wakeups/s"))
+    print("{:10} {:>14.1f}".format("step", reference_wps))
+    print("{:10} {:>14.1f}".format("table", table_wps))
+    print("The breathing filter LED wakes the event loop {:.0f}x less often".format(reference_wps / table_wps))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000, int(sys.argv[2]) if len(sys.argv) > 2 else 60)
@@ -0,0 +1,237 @@
+"""
+Micro-benchmarks of the state tracking paths:
+
+- a StateTracker field write, against a plain attribute, with 0, 1 and 5 change subscribers and for an unchanged value
+- the persistence settings tracking, comparing the packed state word against building it field by field like before
+  the state was packed, after checking that both words match
+- the filter maintenance due checks, answered from the cached deadlines against recomputing the relative filter
+  lifetime like before they were cached, after checking that both agree over a range of states and instants
+
+Run from the main project directory:
+
+    PYTHONPATH="$(pwd):$(pwd)/upy_test_stubs" python upy_test_stubs/state_bench.py [CALLS]
+
+Times are in ns per call, measured under CPython, including the benchmark loop itself. The script also checks that
+timer values which don't fit the 16-bit field are rejected instead of being truncated.
+"""
+import contextlib
+import os
+import random
+import sys
+import time
+
+
+class Plain:
+    def __init__(self):
+        self.speed = 0
+
+
+def per_call_ns(fn, calls):
+    start = time.perf_counter()
+    fn(calls)
+    return (time.perf_counter() - start) / calls * 1e9
+
+
+def bench_plain(calls):
+    state = Plain()
+
+    def run(n):
+        for i in range(n):
+            state.speed = i & 3
+
+    return per_call_ns(run, calls)
+
+
+def bench_tracker(calls, subscribers, changed=True):
+    from leviot.state import StateTracker
+
+    tracker = StateTracker()
+    for _ in range(subscribers):
+        tracker.subscribe(lambda field, old, new, cause: None)
+
+    def run(n):
+        for i in range(n):
+            tracker.speed = i & 3 if changed else 1
+
+    return per_call_ns(run, calls)
+
+
+def settings_word(state):
+    # Persistence._persist_settings() before the state was packed, with the BIT_* globals it had, see main()
+    _settings = 0
+    _settings |= 1 << BIT_POWER if state.power else 0
+    _settings |= 1 << BIT_LIGHTS if state.lights else 0
+    _settings |= 1 << BIT_LOCK if state.lock else 0
+    _settings |= 1 << BIT_USERMAINT if state.user_maint else 0
+    _settings |= (state.speed & BMASK_SPEED) << BIT_SPEED
+    _settings |= (state.prev_speed & BMASK_SPEED) << BIT_PREV_SPEED
+    _settings |= ((state.timer_left & BMASK_TIMER_LEFT) << BIT_TIMER_LEFT) if state.timer_left else 0
+    return _settings
+
+
+def check_settings(states):
+    """
+    Returns the number of random states whose packed word differs from the one built field by field
+    """
+    from leviot.state import StateTracker, BMASK_TIMER_LEFT
+
+    rand = random.Random(1)
+    mismatches = 0
+    for _ in range(states):
+        state = StateTracker()
+        state.power = rand.random() < 0.5
+        state.lights = rand.random() < 0.5
+        state.lock = rand.random() < 0.5
+        state.user_maint = rand.random() < 0.5
+        state.speed = rand.randint(0, 3)
+        state.prev_speed = rand.randint(0, 3)
+        state.timer_left = rand.choice((0, 1, 0x7fff, 0x8000, BMASK_TIMER_LEFT, rand.randint(0, BMASK_TIMER_LEFT)))
+        if state.bits != settings_word(state):
+            mismatches += 1
+    return mismatches
+
+
+def bench_settings(calls, packed):
+    from leviot.state import StateTracker
+
+    state = StateTracker()
+    state.power = True
+    state.timer_left = 120
+    prev = 0
+
+    def run(n):
+        for _ in range(n):
+            if (state.bits if packed else settings_word(state)) != prev:
+                pass
+
+    return per_call_ns(run, calls)
+
+
+def check_range():
+    """
+    Returns the out of range timer values that were accepted
+    """
+    from leviot.controller import LevIoT
+    from leviot.state import StateTracker, Command, BMASK_TIMER_LEFT
+
+    accepted = []
+    # Like MQTT P100D, which the 16-bit field used to store as 12928
+    for minutes in (BMASK_TIMER_LEFT + 1, 100 * 24 * 60):
+        state = StateTracker()
+        try:
+            state.timer_left = minutes
+            accepted.append("timer_left = {} stored {}".format(minutes, state.timer_left))
+        except ValueError:
+            pass
+        leviot = LevIoT()
+        try:
+            leviot.submit(Command.TIMER, minutes, "mqtt")
+            accepted.append("submitted timer {}".format(minutes))
+        except ValueError:
+            pass
+    return accepted
+
+
+def due_recomputed(persistence):
+    # dusting_due and replacement_due before the deadlines were cached
+    from leviot.persistence import DUST_TIMEOUT, REPLACE_TIMEOUT
+    lifetime = persistence.relative_filter_lifetime
+    return lifetime - persistence.last_dust > DUST_TIMEOUT, lifetime > REPLACE_TIMEOUT
+
+
+def due_cached(persistence):
+    return persistence.dusting_due, persistence.replacement_due
+
+
+def check_due(persistence, clock, states):
+    """
+    Returns the number of (state, instant) pairs where the cached deadlines and the recomputed lifetime disagree
+    """
+    from leviot.persistence import DUST_TIMEOUT, REPLACE_TIMEOUT
+    from leviot.state import state_tracker
+
+    rand = random.Random(1)
+    mismatches = 0
+    for _ in range(states):
+        state_tracker.power = rand.random() < 0.8
+        state_tracker.speed = rand.randint(0, 3)
+        persistence.last_update = clock[0]
+        persistence._relative_filter_lifetime = rand.randint(0, REPLACE_TIMEOUT + 1000)
+        persistence.last_dust = max(persistence._relative_filter_lifetime - rand.randint(0, DUST_TIMEOUT + 1000), 0)
+        persistence._invalidate_deadlines()
+        start = clock[0]
+        for elapsed in range(0, 4 * 1000, 37):
+            clock[0] = start + elapsed
+            if due_cached(persistence) != due_recomputed(persistence):
+                mismatches += 1
+        clock[0] = start
+    return mismatches
+
+
+def bench_due(persistence, check, calls):
+    def run(n):
+        for _ in range(n):
+            check(persistence)
+
+    return per_call_ns(run, calls)
+
+
+def main(calls):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        from leviot import persistence as persistence_module
+        from leviot.persistence import persistence
+        from leviot import state
+        from leviot.state import state_tracker
+
+    for name in ("BIT_POWER", "BIT_LIGHTS", "BIT_LOCK", "BIT_USERMAINT", "BIT_SPEED", "BIT_PREV_SPEED",
+                 "BIT_TIMER_LEFT", "BMASK_SPEED", "BMASK_TIMER_LEFT"):
+        globals()[name] = getattr(state, name)
+
+    print("{:32} {:>12}".format("field write", "ns per call"))
+    print("{:32} {:>12.0f}".format("plain attribute", bench_plain(calls)))
+    for subscribers in (0, 1, 5):
+        print("{:32} {:>12.0f}".format("changed, {} subscribers".format(subscribers),
+                                       bench_tracker(calls, subscribers)))
+    print("{:32} {:>12.0f}".format("unchanged, 5 subscribers", bench_tracker(calls, 5, changed=False)))
+    print()
+
+    settings_mismatches = check_settings(10000)
+    print("{:32} {:>12}".format("settings tracking", "ns per call"))
+    print("{:32} {:>12.0f}".format("word built from fields", bench_settings(calls, False)))
+    print("{:32} {:>12.0f}".format("packed word", bench_settings(calls, True)))
+    print()
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        accepted = check_range()
+
+    # The persistence clock only moves when told to, so that the instants checked are exact
+    clock = [1700000000]
+    persistence_module.time = lambda: clock[0]
+    # Change notifications would schedule persistence tracking
+    state_tracker._subscribers = [persistence._on_state_change]
+    mismatches = check_due(persistence, clock, 500)
+
+    state_tracker.power = True
+    state_tracker.speed = 2
+    persistence._invalidate_deadlines()
+    print("{:32} {:>12}".format("filter due checks", "ns per call"))
+    print("{:32} {:>12.0f}".format("recomputed lifetime", bench_due(persistence, due_recomputed, calls)))
+    print("{:32} {:>12.0f}".format("cached deadlines", bench_due(persistence, due_cached, calls)))
+    print()
+
+    failures = []
+    if settings_mismatches:
+        failures.append("the packed word differs from the one built from fields for {} states".format(
+            settings_mismatches))
+    failures += ["out of range value accepted: " + value for value in accepted]
+    if mismatches:
+        failures.append("the cached deadlines and the recomputed lifetime disagree at {} instants".format(mismatches))
+    for failure in failures:
+        print("FAIL: " + failure)
+    if failures:
+        sys.exit(1)
+    print("OK: the packed word and cached deadlines agree with what they replace, out of range timers are rejected")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
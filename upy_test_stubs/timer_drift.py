@@ -0,0 +1,108 @@
+"""
+Checks that periodic timers of the timer service don't drift: the service runs on a simulated clock for HOURS, with
+every sleep ending up to JITTER_MS late as if the event loop was busy, and each call of a periodic timer taking
+WORK_MS. The lateness of every call is measured from its ideal deadline, start + n * period. A loop sleeping for the
+period after each call, like the countdown used to do, is simulated in the same conditions for comparison.
+
+The persistence tracking, powered on, and the Wi-Fi link check run on the service too, as on the device, and the
+wakeups per hour of the whole service are reported.
+
+Run from the main project directory:
+
+    PYTHONPATH="$(pwd):$(pwd)/upy_test_stubs" python upy_test_stubs/timer_drift.py [HOURS] [PERIOD_MS]
+
+Lateness from the jitter is expected; the check fails if any call is later than JITTER_MS, which can only happen if
+lateness adds up over the run.
+"""
+import asyncio
+import contextlib
+import os
+import random
+import sys
+
+import simclock
+
+JITTER_MS = 10
+WORK_MS = 3
+
+clock = simclock.SimClock(JITTER_MS)
+
+
+async def run_timer_service(hours, period_ms):
+    from leviot import network
+    from leviot.persistence import persistence
+    from leviot.state import state_tracker
+    from leviot.timers import timer_service
+
+    timer_service.timers.clear()
+    state_tracker.power = True
+    persistence.last_update = clock.time()
+    persistence._schedule_next()
+    await network.ensure_up()
+
+    start = clock.ticks_ms()
+    lateness = []
+
+    def tick():
+        lateness.append(clock.ticks_ms() - (start + (len(lateness) + 1) * period_ms))
+        clock.advance(WORK_MS)
+
+    timer_service.call_every(period_ms, tick)
+    timer_service.wakeups = 0
+    # Half a period past the end, so that the last call isn't cut by the jitter
+    await clock.run(timer_service, hours * 60 * 60 * 1000 + period_ms // 2)
+    return lateness, timer_service.wakeups / hours
+
+
+def run_sleep_loop(hours, period_ms):
+    rand = random.Random(1)
+    now = 0
+    lateness = []
+    while now < hours * 60 * 60 * 1000:
+        now += period_ms + rand.randint(0, JITTER_MS)
+        lateness.append(now - (len(lateness) + 1) * period_ms)
+        now += WORK_MS
+    return lateness
+
+
+def report(name, lateness):
+    tenth = max(len(lateness) // 10, 1)
+    first = sum(lateness[:tenth]) / tenth
+    last = sum(lateness[-tenth:]) / tenth
+    print("{:14} {:>8} {:>16.1f} {:>16.1f} {:>10}".format(name, len(lateness), first, last, max(lateness)))
+
+
+def main(hours, period_ms):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        from leviot import conf, network
+        from leviot.timers import timer_service
+        conf.mqtt_enabled = False
+        conf.wifi_mode = "sta"
+        conf.ntp_host = None
+        # The stub link comes up after a few checks
+        network.get_wlan().conncheck_count = 100
+        clock.install(timer_service)
+        lateness, wakeups = asyncio.run(run_timer_service(hours, period_ms))
+
+    print("{} simulated hours, a call every {} ms taking {} ms, sleeps up to {} ms late".format(
+        hours, period_ms, WORK_MS, JITTER_MS))
+    print()
+    print("{:14} {:>8} {:>16} {:>16} {:>10}".format("method", "calls", "first 10% late", "last 10% late", "max late"))
+    report("timer service", lateness)
+    report("sleep loop", run_sleep_loop(hours, period_ms))
+    print()
+    print("Timer service wakeups with persistence tracking and the Wi-Fi check: {:.0f}/hour".format(wakeups))
+    print()
+
+    expected = hours * 60 * 60 * 1000 // period_ms
+    if len(lateness) != expected:
+        print("FAIL: the timer was called {} times, expected {}".format(len(lateness), expected))
+        sys.exit(1)
+    if max(lateness) > JITTER_MS or min(lateness) < 0:
+        print("FAIL: the timer service drifted, calls were up to {} ms late".format(max(lateness)))
+        sys.exit(1)
+    print("OK: the timer service doesn't drift")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 24, int(sys.argv[2]) if len(sys.argv) > 2 else 60 * 1000)
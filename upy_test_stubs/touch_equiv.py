@@ -0,0 +1,215 @@
+"""
+Checks that a touch filter engine follows the same state machine as FilteredTouchpad: both are fed the same readings
+and the state of every pad is compared after each poll. The time spent polling each of them, updating the filters and
+dispatching touch events like TouchpadManager does, is reported too, along with the heap allocated per poll where
+gc.mem_alloc() is available (MicroPython).
+
+Run from the main project directory, ENGINE being batched or fixed:
+
+    PYTHONPATH="$(pwd):$(pwd)/upy_test_stubs" python upy_test_stubs/touch_equiv.py ENGINE [POLLS] [SEED]
+
+Readings are synthetic: a slowly drifting baseline with noise, touches of random depth and length around each pad's
+thresholds, and the occasional upward spike that resets the baseline. Pad sensitivities include the low sensitivity
+threshold itself, where debouncing is skipped.
+
+Random readings rarely land exactly on a threshold, so the fixed engine's integer levels are also checked against the
+FilteredTouchpad float comparisons for every diff at every baseline from BASELINE_MIN to BASELINE_MAX.
+"""
+import contextlib
+import gc
+import os
+import random
+import sys
+import time
+
+import cpytouchpad
+import utime
+
+# Sensitivity of each pad, cycled over the pads
+SENSITIVITIES = (0.03, 0.05, 0.0299, 0.0301, 0.04085603112840467, 0.1, 0.02)
+BASELINE_MIN = 300
+BASELINE_MAX = 1500
+
+
+class SyntheticTrace:
+    """
+    Stands in for cpytouchpad.TracePlayer, generating readings on the fly
+    """
+
+    def __init__(self, pins, sensitivities, seed):
+        self.rand = random.Random(seed)
+        self.pins = {pin: i for i, pin in enumerate(pins)}
+        self.sensitivities = sensitivities
+        self.clock_ms = 0
+        self.level = [self.rand.uniform(400, 1200) for _ in pins]
+        # Remaining polls and depth, as a fraction of the level, of the current touch or spike of each pad
+        self.left = [0] * len(pins)
+        self.depth = [0.0] * len(pins)
+        self.readings = [(0, 0)] * len(pins)
+        self.advance()
+
+    def values(self, pin):
+        return self.readings[self.pins[pin]]
+
+    def _reading(self, i):
+        rand = self.rand
+        self.level[i] = min(max(self.level[i] + rand.uniform(-0.5, 0.5), 300), 1500)
+        if self.left[i] == 0 and rand.random() < 0.01:
+            touch_thr = self.sensitivities[i] * 0.75
+            if rand.random() < 0.1:
+                self.depth[i] = -rand.uniform(0, 0.5) * touch_thr
+            else:
+                self.depth[i] = rand.uniform(0, 1.5) * touch_thr
+            self.left[i] = rand.randint(1, 300)
+        depth = 0.0
+        if self.left[i]:
+            self.left[i] -= 1
+            depth = self.depth[i]
+        level = self.level[i]
+        raw = int(level * (1 - depth) + rand.gauss(0, 1.5))
+        return raw, int(level)
+
+    def advance(self) -> bool:
+        self.readings = [self._reading(i) for i in range(len(self.readings))]
+        self.clock_ms += 10
+        return True
+
+    def ticks_ms(self):
+        return self.clock_ms
+
+
+class Poller:
+    """
+    Polls a set of pads the way TouchpadManager.update() does, timing it and counting the heap it allocates
+    """
+
+    def __init__(self, manager, update):
+        self.manager = manager
+        self.update = update
+        self.seconds = 0
+        self.alloc_bytes = 0
+
+    def poll(self):
+        alloc = gc.mem_alloc() if hasattr(gc, "mem_alloc") else 0
+        start = time.perf_counter()
+        self.update()
+        self.manager._dispatch_events()
+        self.seconds += time.perf_counter() - start
+        if alloc:
+            # A collection during the poll makes the delta meaningless
+            self.alloc_bytes += max(gc.mem_alloc() - alloc, 0)
+        self.manager.events.clear()
+
+
+def update_all(touchpads):
+    action_flag = None
+    for tp in touchpads:
+        action_flag = tp.update(action_flag)
+    return action_flag
+
+
+def check_levels(touchpads):
+    """
+    Returns the number of (baseline, diff) pairs where a FixedPointTouchpad comparison disagrees with FilteredTouchpad
+    """
+    mismatches = 0
+    for tp in touchpads:
+        for baseline in range(BASELINE_MIN, BASELINE_MAX + 1):
+            tp.baseline = baseline
+            tp._update_levels()
+            for diff in range(-baseline // 10, baseline // 10):
+                diff_rate = diff / baseline
+                checks = (
+                    (abs(diff_rate) <= tp.noise_thr, -tp.noise_lvl <= diff <= tp.noise_lvl),
+                    (diff_rate >= tp.touch_thr + tp.hyst_thr, diff >= tp.push_lvl),
+                    (diff_rate <= 0 - tp.baseline_reset_thr, diff <= -tp.baseline_reset_lvl),
+                    (diff_rate > tp.touch_thr - tp.hyst_thr, diff > tp.hold_lvl),
+                    (abs(diff_rate) < tp.noise_thr, -tp.release_noise_lvl <= diff <= tp.release_noise_lvl),
+                )
+                for expected, actual in checks:
+                    if expected != actual:
+                        mismatches += 1
+                        if mismatches <= 10:
+                            print("Mismatch: sensitivity {} baseline {} diff {}".format(tp.touch_change, baseline, diff))
+    return mismatches
+
+
+def main(engine_name, polls, seed):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        from machine import Pin
+        from leviot import constants
+        from leviot.touchpad import FilteredTouchpad, FixedPointTouchpad, BatchedTouchpadEngine, TouchpadState, \
+            TouchpadManager
+
+    pins = list(constants.TOUCHPADS.values())
+    names = list(constants.TOUCHPADS)
+    sensitivities = [SENSITIVITIES[i % len(SENSITIVITIES)] for i in range(len(pins))]
+
+    cpytouchpad.trace = SyntheticTrace(pins, sensitivities, seed)
+    utime.ticks_ms = cpytouchpad.trace.ticks_ms
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        reference = [FilteredTouchpad(names[i], Pin(pins[i]), sensitivities[i]) for i in range(len(pins))]
+        if engine_name == "batched":
+            engine = BatchedTouchpadEngine()
+            candidate = [engine.add(names[i], Pin(pins[i]), sensitivities[i]) for i in range(len(pins))]
+            update_candidate = engine.update
+        else:
+            candidate = [FixedPointTouchpad(names[i], Pin(pins[i]), sensitivities[i]) for i in range(len(pins))]
+            update_candidate = lambda: update_all(candidate)
+        pollers = []
+        for pads, update in ((reference, lambda: update_all(reference)), (candidate, update_candidate)):
+            manager = TouchpadManager()
+            manager.touchpads = pads
+            pollers.append(Poller(manager, update))
+        reference_poller, candidate_poller = pollers
+
+    mismatches = [0] * len(pins)
+    pushes = [0] * len(pins)
+    states = [TouchpadState.IDLE] * len(pins)
+    gc.collect()
+    for _ in range(polls):
+        cpytouchpad.trace.advance()
+        reference_poller.poll()
+        candidate_poller.poll()
+
+        for i in range(len(pins)):
+            expected = reference[i].read()
+            if expected[0] == TouchpadState.PUSH and states[i] != TouchpadState.PUSH:
+                pushes[i] += 1
+            states[i] = expected[0]
+            if candidate[i].read() != expected:
+                mismatches[i] += 1
+
+    print("{} polls, seed {}".format(polls, seed))
+    print()
+    print("{:8} {:>12} {:>8} {:>12}".format("pad", "sensitivity", "pushes", "mismatches"))
+    for i in range(len(pins)):
+        print("{:8} {:>12.4f} {:>8} {:>12}".format(names[i], sensitivities[i], pushes[i], mismatches[i]))
+    print()
+    print("{:8} {:>12} {:>16}".format("engine", "us per poll", "bytes per poll"))
+    for name, poller in (("object", reference_poller), (engine_name, candidate_poller)):
+        alloc = "{:.1f}".format(poller.alloc_bytes / polls) if hasattr(gc, "mem_alloc") else "n/a"
+        print("{:8} {:>12.1f} {:>16}".format(name, poller.seconds / polls * 1e6, alloc))
+    print()
+
+    if engine_name == "fixed":
+        level_mismatches = check_levels(candidate)
+        if level_mismatches:
+            print("FAIL: {} threshold comparisons of the fixed engine disagree with FilteredTouchpad".format(
+                level_mismatches))
+            sys.exit(1)
+        print("OK: the fixed engine levels match FilteredTouchpad at every baseline from {} to {}".format(
+            BASELINE_MIN, BASELINE_MAX))
+
+    if any(mismatches):
+        print("FAIL: {} polls where the {} engine disagrees with FilteredTouchpad".format(sum(mismatches), engine_name))
+        sys.exit(1)
+    print("OK: the {} engine matches FilteredTouchpad on every poll".format(engine_name))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("batched", "fixed"):
+        print("Usage: {} batched|fixed [POLLS] [SEED]".format(sys.argv[0]))
+        sys.exit(1)
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 200000, int(sys.argv[3]) if len(sys.argv) > 3 else 1)
@@ -0,0 +1,142 @@
+"""
+Replays a touch trace recorded on the device through the touch filters, faster than real time.
+
+Record a trace from the device REPL:
+
+    from leviot.touchpad import touchpad_mgr
+    touchpad_mgr.start_trace("/touch.trace", max_samples=20000)
+
+then copy it over and run from the main project directory:
+
+    PYTHONPATH="$(pwd):$(pwd)/upy_test_stubs" python upy_test_stubs/touch_replay.py touch.trace
+
+The touch filter engine is picked from `touchpad_engine` in leviot_conf.py as usual.
+
+Press latency is measured from the first sample whose raw reading drops below the pad's noise threshold, relative to
+the last reading seen while the pad was idle, to the PRESS event. Events are handled by LevIoT.touchpad_loop() as on
+the device, and the press to command latency adds the time it records in touch_latency_ms, from the push to the
+command being submitted, to the press latency. Polls take no time on the trace clock, so that part only shows events
+waiting behind earlier ones.
+"""
+import asyncio
+import contextlib
+import os
+import sys
+import time
+
+import cpytouchpad
+
+
+async def replay(trace, stats, noise, pins):
+    from leviot.controller import LevIoT
+    from leviot.touchpad import touchpad_mgr, TouchEvent
+
+    leviot = LevIoT()
+    ref = {name: trace.values(pins[name])[0] for name in noise}
+    onset = {name: None for name in noise}
+    pressed_at = {}
+    event_names = {TouchEvent.PRESS: "PRESS", TouchEvent.HOLD: "HOLD", TouchEvent.RELEASE: "RELEASE"}
+    done = asyncio.Event()
+
+    handle = leviot.on_touch_event
+
+    async def on_touch_event(event, pad):
+        await handle(event, pad)
+        if event == TouchEvent.PRESS:
+            stats[pad.name]["command"].append(stats[pad.name]["latency"][-1] + leviot.touch_latency_ms)
+
+    leviot.on_touch_event = on_touch_event
+
+    # Replaces TouchpadManager.async_loop(), polling once per trace sample
+    async def poll():
+        while True:
+            now = trace.ticks_ms()
+            for name in noise:
+                raw = trace.values(pins[name])[0]
+                if ref[name] - raw > ref[name] * noise[name]:
+                    if onset[name] is None:
+                        onset[name] = now
+                elif name not in pressed_at:
+                    ref[name] = raw
+                    onset[name] = None
+
+            touchpad_mgr.update()
+
+            for event, pad in touchpad_mgr.events:
+                pad_stats = stats[pad.name]
+                pad_stats[event_names[event]] += 1
+                if event == TouchEvent.PRESS:
+                    pressed_at[pad.name] = now
+                    pad_stats["latency"].append(now - (onset[pad.name] if onset[pad.name] is not None else now))
+                elif event == TouchEvent.RELEASE and pad.name in pressed_at:
+                    pad_stats["duration"].append(now - pressed_at.pop(pad.name))
+
+            # Let the controller handle the events
+            while touchpad_mgr.events:
+                await asyncio.sleep(0)
+            # Nothing applies the submitted commands
+            leviot.commands.clear()
+
+            if not trace.advance():
+                break
+        done.set()
+
+    touchpad_mgr.async_loop = poll
+    task = asyncio.get_event_loop().create_task(leviot.touchpad_loop())
+    await done.wait()
+    task.cancel()
+    return leviot.touch_latency_max_ms
+
+
+def main(path):
+    trace = cpytouchpad.load_trace(path)
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        from leviot import conf
+        from leviot.touchpad import touchpad_mgr, TPConsts, PollTier
+        conf.mqtt_enabled = False
+
+    noise = {}
+    for name, _ in trace.reader.pads:
+        noise[name] = conf.touchpads_sensitivity[name] * TPConsts.TOUCH_THRESHOLD_PERCENT * \
+                      TPConsts.NOISE_THRESHOLD_PERCENT
+    pins = {name: pin for name, pin in trace.reader.pads}
+
+    stats = {name: {"PRESS": 0, "HOLD": 0, "RELEASE": 0, "latency": [], "command": [], "duration": []}
+             for name in noise}
+
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        touch_latency_max_ms = asyncio.run(replay(trace, stats, noise, pins))
+    elapsed = time.perf_counter() - start
+
+    samples = len(trace)
+    print("Replayed {} samples ({:.1f} s of trace) in {:.3f} s".format(samples, trace.duration_ms / 1000, elapsed))
+    print("Throughput: {:.0f} polls/s, {:.1f} us/poll, {:.0f}x real time".format(
+        samples / elapsed, elapsed / samples * 1e6, trace.duration_ms / 1000 / elapsed))
+    total_ms = sum(touchpad_mgr.tier_ms) or 1
+    for tier, tier_name in ((PollTier.TOUCH, "touch"), (PollTier.IDLE, "idle"), (PollTier.DEEP_IDLE, "deep idle")):
+        print("Polling tier {:9}: {:.1f} s ({:.1f}%)".format(
+            tier_name, touchpad_mgr.tier_ms[tier] / 1000, touchpad_mgr.tier_ms[tier] * 100 / total_ms))
+    print("Filter wakeups on device: {:.1f}/s".format(touchpad_mgr.wakeups_per_sec))
+    print()
+    print("Push to command handled (touch_latency_ms): {} ms max".format(touch_latency_max_ms))
+    print()
+    print("{:8} {:>6} {:>6} {:>8} {:>12} {:>12} {:>12} {:>12} {:>14}".format(
+        "pad", "press", "hold", "release", "lat avg ms", "lat max ms", "cmd avg ms", "cmd max ms", "press avg ms"))
+    for name, pad_stats in stats.items():
+        latency = pad_stats["latency"]
+        command = pad_stats["command"]
+        duration = pad_stats["duration"]
+        print("{:8} {:>6} {:>6} {:>8} {:>12.1f} {:>12} {:>12.1f} {:>12} {:>14.1f}".format(
+            name, pad_stats["PRESS"], pad_stats["HOLD"], pad_stats["RELEASE"],
+            sum(latency) / len(latency) if latency else 0, max(latency) if latency else 0,
+            sum(command) / len(command) if command else 0, max(command) if command else 0,
+            sum(duration) / len(duration) if duration else 0))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: {} TRACE_FILE".format(sys.argv[0]))
+        sys.exit(1)
+    main(sys.argv[1])
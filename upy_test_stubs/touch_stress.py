@@ -0,0 +1,227 @@
+"""
+Taps the FAN, NIGHT, TIMER and LIGHT touchpads in rapid random bursts and checks that the state reached through the
+coalescing command queue is the one each tap would have led to if it had been applied on its own.
+
+Then submits bursts mixing every command kind, as HTTP and MQTT would, along with POWER, FAN and LIGHT taps, with
+immediate and then deferred shift register commits. Commands of different kinds can legitimately end up applied in
+another order than submitted, so only what holds either way is checked: the lights and fan speed end up at the last
+value submitted, the timer is cleared when the power is off, every command is either merged or applied, and none fails.
+The shift register commits requested and latched per command are reported for both commit modes.
+
+Run from the main project directory:
+
+    PYTHONPATH="$(pwd):$(pwd)/upy_test_stubs" python upy_test_stubs/touch_stress.py [BURSTS] [SEED]
+
+Commands are coalesced for COALESCE_MS instead of COMMAND_COALESCE_MS, and kickstarts are shortened to KICKSTART_MS, to
+run faster. Inputs in a burst are up to 1.5 * COALESCE_MS apart, so some are merged into pending commands and some are
+applied between them.
+"""
+import asyncio
+import contextlib
+import os
+import random
+import sys
+
+COALESCE_MS = 10
+KICKSTART_MS = 30
+PADS = ("FAN", "NIGHT", "TIMER", "LIGHT")
+MIXED_PADS = ("POWER", "FAN", "LIGHT")
+CAUSES = ("http", "mqtt", "schedule")
+TIMER_VALUES = (0, 30, 120, 540)
+
+
+class FakePad:
+    def __init__(self, name):
+        self.name = name
+        self.event_start = 0
+
+    def ack(self):
+        pass
+
+    def read(self):
+        return 0, 0
+
+
+class Model:
+    """
+    Applies each tap right away, the way on_touch_event() would if no command was ever pending
+    """
+
+    def __init__(self, speed, prev_speed, lights, timer_left):
+        self.speed = speed
+        self.prev_speed = prev_speed
+        self.lights = lights
+        self.timer_left = timer_left
+
+    def set_speed(self, speed):
+        if speed != self.speed:
+            self.prev_speed = self.speed
+        self.speed = speed
+
+    def tap(self, name):
+        if name == "FAN":
+            self.set_speed((self.prev_speed or 1) if self.speed == 0 else 1 + (self.speed % 3))
+        elif name == "NIGHT":
+            self.set_speed(self.prev_speed if self.speed == 0 else 0)
+        elif name == "TIMER":
+            self.timer_left = self.timer_left + 2 * 60 if self.timer_left + 2 * 60 <= 9 * 60 else 0
+        elif name == "LIGHT":
+            self.lights = not self.lights
+
+    def state(self):
+        return self.speed, self.prev_speed, self.lights, self.timer_left
+
+
+async def settle(leviot):
+    while leviot.commands or leviot.is_kickstarting:
+        await asyncio.sleep(COALESCE_MS / 1000)
+    await asyncio.sleep(2 * COALESCE_MS / 1000)
+
+
+async def run_mixed(bursts, seed, deferred):
+    from leviot import controller
+    from leviot.controller import LevIoT
+    from leviot.extgpio import gpio
+    from leviot.state import state_tracker, Command
+
+    state_tracker.power = True
+    state_tracker.lock = False
+    state_tracker.lights = True
+    state_tracker.speed = 2
+    state_tracker.timer_left = 0
+
+    leviot = LevIoT()
+    command_loop = asyncio.get_event_loop().create_task(leviot.command_loop())
+    pads = {name: FakePad(name) for name in MIXED_PADS}
+    rand = random.Random(seed)
+
+    # Last value submitted for each command kind, whatever the input
+    last = {}
+    submit = leviot.submit
+
+    def record(kind, value, cause="unknown"):
+        last[kind] = value
+        submit(kind, value, cause)
+
+    leviot.submit = record
+    errors = []
+    controller.log.e = errors.append
+
+    await settle(leviot)
+    gpio.deferred = deferred
+    gpio.commits_requested = 0
+    gpio.commits_latched = 0
+
+    failures = []
+    for burst in range(bursts):
+        last.clear()
+        for _ in range(rand.randint(1, 12)):
+            kind = rand.choice((Command.POWER, Command.SPEED, Command.TIMER, Command.LIGHTS, Command.LOCK, None))
+            if kind is None:
+                await leviot.on_touch_event(0, pads[rand.choice(MIXED_PADS)])
+            elif kind == Command.SPEED:
+                leviot.submit(kind, rand.randint(0, 3), rand.choice(CAUSES))
+            elif kind == Command.TIMER:
+                leviot.submit(kind, rand.choice(TIMER_VALUES), rand.choice(CAUSES))
+            else:
+                leviot.submit(kind, rand.random() < 0.5, rand.choice(CAUSES))
+            await asyncio.sleep(rand.uniform(0, 1.5 * COALESCE_MS) / 1000)
+        await settle(leviot)
+
+        problems = []
+        if Command.LIGHTS in last and state_tracker.lights != last[Command.LIGHTS]:
+            problems.append("lights {}, last submitted {}".format(state_tracker.lights, last[Command.LIGHTS]))
+        if Command.SPEED in last and state_tracker.speed != last[Command.SPEED]:
+            problems.append("speed {}, last submitted {}".format(state_tracker.speed, last[Command.SPEED]))
+        if not state_tracker.power and state_tracker.timer_left:
+            problems.append("timer {} while off".format(state_tracker.timer_left))
+        if problems:
+            failures.append((burst, ", ".join(problems)))
+
+    gpio.deferred = False
+    command_loop.cancel()
+    if leviot.commands_merged + leviot.commands_applied != leviot.commands_submitted:
+        failures.append((bursts, "{} commands submitted, {} merged and {} applied".format(
+            leviot.commands_submitted, leviot.commands_merged, leviot.commands_applied)))
+    for error in errors:
+        failures.append((bursts, "error {}".format(error)))
+    return leviot.commands_submitted, gpio.commits_requested, gpio.commits_latched, failures
+
+
+async def run(bursts, seed):
+    from leviot import constants
+    from leviot.controller import LevIoT
+    from leviot.state import state_tracker
+    from leviot.touchpad import TouchEvent
+
+    constants.COMMAND_COALESCE_MS = COALESCE_MS
+    constants.KICKSTART_MS = KICKSTART_MS
+    constants.KICKSTART_MIN_MS = KICKSTART_MS // 3
+    state_tracker.power = True
+    state_tracker.lock = False
+    state_tracker.lights = True
+    state_tracker.speed = 2
+    state_tracker.prev_speed = 1
+    state_tracker.timer_left = 0
+
+    leviot = LevIoT()
+    command_loop = asyncio.get_event_loop().create_task(leviot.command_loop())
+    model = Model(state_tracker.speed, state_tracker.prev_speed, state_tracker.lights, state_tracker.timer_left)
+    pads = {name: FakePad(name) for name in PADS}
+    rand = random.Random(seed)
+
+    taps = 0
+    failures = []
+    for burst in range(bursts):
+        for _ in range(rand.randint(1, 8)):
+            name = rand.choice(PADS)
+            await leviot.on_touch_event(TouchEvent.PRESS, pads[name])
+            model.tap(name)
+            taps += 1
+            await asyncio.sleep(rand.uniform(0, 1.5 * COALESCE_MS) / 1000)
+
+        while leviot.commands:
+            await asyncio.sleep(COALESCE_MS / 1000)
+        await asyncio.sleep(2 * COALESCE_MS / 1000)
+
+        state = (state_tracker.speed, state_tracker.prev_speed, state_tracker.lights, state_tracker.timer_left)
+        if state != model.state():
+            failures.append((burst, state, model.state()))
+            # Carry on from the actual state
+            model = Model(*state)
+
+    command_loop.cancel()
+    return taps, leviot.commands_merged, leviot.commands_applied, failures
+
+
+def main(bursts, seed):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        from leviot import conf
+        conf.mqtt_enabled = False
+        taps, merged, applied, failures = asyncio.run(run(bursts, seed))
+        mixed = [asyncio.run(run_mixed(bursts, seed, deferred)) for deferred in (False, True)]
+
+    print("{} bursts, {} taps, {} commands merged, {} applied".format(bursts, taps, merged, applied))
+    for burst, state, expected in failures[:10]:
+        print("Burst {}: (speed, prev speed, lights, timer) is {}, expected {}".format(burst, state, expected))
+    if failures:
+        print("FAIL: {} of {} bursts ended in the wrong state".format(len(failures), bursts))
+        sys.exit(1)
+    print("OK: every burst ended in the state reached by applying each tap on its own")
+    print()
+
+    print("{:10} {:>10} {:>18} {:>18} {:>20}".format(
+        "commits", "commands", "commits requested", "commits latched", "latched / commands"))
+    for mode, (commands, requested, latched, _) in zip(("immediate", "deferred"), mixed):
+        print("{:10} {:>10} {:>18} {:>18} {:>20.2f}".format(mode, commands, requested, latched, latched / commands))
+    mixed_failures = mixed[0][3] + mixed[1][3]
+    for burst, problem in mixed_failures[:10]:
+        print("Mixed burst {}: {}".format(burst, problem))
+    if mixed_failures:
+        print("FAIL: {} problems with mixed commands".format(len(mixed_failures)))
+        sys.exit(1)
+    print("OK: mixed command bursts from every input ended consistently")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500, int(sys.argv[2]) if len(sys.argv) > 2 else 1)
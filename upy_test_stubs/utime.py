@@ -23,3 +23,7 @@ def ticks_us():
 
 def ticks_diff(t1, t2):
     return t1 - t2
+
+
+def ticks_add(ticks, delta):
+    return ticks + delta